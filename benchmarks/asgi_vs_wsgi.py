@@ -0,0 +1,121 @@
+"""
+Compare how many concurrent validations the WSGI app (gunicorn, sync workers) and the ASGI app
+(uvicorn, one process) can serve while SA is slow to respond
+
+A local fake SA server stands in for the real one. Requires a running Redis server:
+
+    $> REDIS_URL=redis://localhost:6379 pipenv run python -m benchmarks.asgi_vs_wsgi
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# How long the fake SA server takes to respond to each request
+SA_LATENCY_SECS = float(os.getenv("SA_LATENCY_SECS", 0.5))
+CONCURRENCY = int(os.getenv("CONCURRENCY", 200))
+REQUESTS = int(os.getenv("REQUESTS", 1000))
+WSGI_WORKERS = int(os.getenv("WSGI_WORKERS", 4))
+
+SA_PORT = 8901
+WSGI_PORT = 8902
+ASGI_PORT = 8903
+
+
+class FakeSAServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeSAHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(SA_LATENCY_SECS)
+        body = b"<html>" + b"x" * 50000 + b"</html>"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def post(port: int, path: str, payload: dict) -> float:
+    started = time.monotonic()
+    request = urllib.request.Request(
+        "http://127.0.0.1:{}{}".format(port, path),
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    urllib.request.urlopen(request).read()
+    return time.monotonic() - started
+
+
+def wait_for(port: int):
+    for _ in range(100):
+        try:
+            post(port, "/v1/generate_hash", {"username": "benchmark"})
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Server on port {} didn't start".format(port))
+
+
+def run(name: str, command: list, port: int):
+    env = dict(
+        os.environ,
+        SA_PROFILE_URL="http://127.0.0.1:{}/member.php?username=".format(SA_PORT),
+        SA_POOL_SIZE=str(CONCURRENCY),
+        RESULT_CACHE_POSITIVE_SECS="0",
+        RESULT_CACHE_NEGATIVE_SECS="0",
+    )
+    process = subprocess.Popen(command, env=env, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(port)
+        usernames = ["benchmark{}".format(number) for number in range(REQUESTS)]
+        for username in usernames:
+            post(port, "/v1/generate_hash", {"username": username})
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+            latencies = list(executor.map(
+                lambda username: post(port, "/v1/validate_user", {"username": username}),
+                usernames,
+            ))
+        elapsed = time.monotonic() - started
+
+        latencies.sort()
+        print("{:<6} {:8.1f} req/s   p50 {:6.3f}s   p99 {:6.3f}s".format(
+            name,
+            REQUESTS / elapsed,
+            statistics.median(latencies),
+            latencies[int(len(latencies) * 0.99) - 1],
+        ))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == "__main__":
+    sa_server = FakeSAServer(("127.0.0.1", SA_PORT), FakeSAHandler)
+    threading.Thread(target=sa_server.serve_forever, daemon=True).start()
+
+    run("wsgi", [
+        sys.executable, "-m", "gunicorn", "src.server:app",
+        "--workers", str(WSGI_WORKERS),
+        "--bind", "127.0.0.1:{}".format(WSGI_PORT),
+    ], WSGI_PORT)
+    run("asgi", [
+        sys.executable, "-m", "uvicorn", "src.asgi:app",
+        "--port", str(ASGI_PORT),
+    ], ASGI_PORT)
+
+    sa_server.shutdown()
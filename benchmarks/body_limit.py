@@ -0,0 +1,53 @@
+"""
+Compare the peak memory get_json allocates for an oversized request body with and without a
+MAX_BODY_BYTES limit, whether or not the body's length is declared up front
+
+    $> pipenv run python -m benchmarks.body_limit
+"""
+import io
+import os
+import tracemalloc
+
+import falcon
+
+from src import helpers
+
+BODY_BYTES = int(os.getenv("BODY_BYTES", 10 * 1024 * 1024))
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", 64 * 1024))
+
+
+class FakeRequest:
+    """
+    Just enough of falcon.Request for get_json
+    """
+    def __init__(self, body: bytes, declare_length: bool):
+        self.stream = io.BytesIO(body)
+        self.content_length = len(body) if declare_length else None
+
+
+def peak_bytes(body: bytes, declare_length: bool, max_bytes: int) -> int:
+    req = FakeRequest(body, declare_length)
+    tracemalloc.start()
+    try:
+        helpers.get_json(req, max_bytes)
+    except falcon.HTTPError:
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    body = b'{"username": "' + b"x" * BODY_BYTES + b'"}'
+    print("{:.1f} MiB body, {} byte limit".format(len(body) / 2 ** 20, MAX_BODY_BYTES))
+    for declare_length in (True, False):
+        for max_bytes in (None, MAX_BODY_BYTES):
+            print("{:<20} {:<12} {:10.1f} KiB peak".format(
+                "Content-Length" if declare_length else "no Content-Length",
+                "limited" if max_bytes else "unlimited",
+                peak_bytes(body, declare_length, max_bytes) / 1024,
+            ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Compare the CPU time spent serializing each fixed response on every request against writing out
+the responses pre-serialized in src.responses
+
+    $> pipenv run python -m benchmarks.constant_responses
+"""
+import os
+import timeit
+
+import falcon
+
+from src import codec
+from src.responses import VALIDATION_BODIES, HashMissing, JSONRequired
+
+ITERATIONS = int(os.getenv("ITERATIONS", 100000))
+
+
+def serialized_validation():
+    return codec.dumps({"validated": True, "cached": False})
+
+
+def constant_validation():
+    return VALIDATION_BODIES[True, False]
+
+
+def serialized_hash_missing():
+    return falcon.HTTPBadRequest(
+        "Hash Missing",
+        "A hash does not exist for this username. Run /generate_hash/ first",
+    ).to_json()
+
+
+def constant_hash_missing():
+    return HashMissing().to_json()
+
+
+def serialized_json_required():
+    return falcon.HTTPUnsupportedMediaType(
+        "This API only supports JSON-encoded requests"
+    ).to_json()
+
+
+def constant_json_required():
+    return JSONRequired().to_json()
+
+
+CASES = [
+    ("validate_user 200", serialized_validation, constant_validation),
+    ("validate_user 400", serialized_hash_missing, constant_hash_missing),
+    ("generate_hash 415", serialized_json_required, constant_json_required),
+]
+
+
+def main():
+    for name, serialized, constant in CASES:
+        timings = [
+            timeit.timeit(fn, number=ITERATIONS) / ITERATIONS * 1e6
+            for fn in (serialized, constant)
+        ]
+        print("{:<20} serialized {:6.2f} us/op   constant {:6.2f} us/op   saved {:6.2f} us".format(
+            name,
+            timings[0],
+            timings[1],
+            timings[0] - timings[1],
+        ))
+
+
+if __name__ == "__main__":
+    main()
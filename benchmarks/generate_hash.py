@@ -0,0 +1,61 @@
+"""
+Compare the latency of issuing a hash with separate GET/SETEX calls against the single
+MULTI/EXEC round trip used by GenerateHashResource
+
+Requires a running Redis server:
+
+    $> REDIS_URL=redis://localhost:6379 pipenv run python -m benchmarks.generate_hash
+"""
+import os
+import timeit
+
+import redis
+
+from src import helpers
+
+ITERATIONS = int(os.getenv("ITERATIONS", 10000))
+LIFESPAN_SECS = 300
+
+redis_db = redis.StrictRedis.from_url(
+    helpers.get_redis_url(os.getenv("REDIS_URL", "")),
+    decode_responses=True,
+)
+
+
+def two_calls(username: str) -> str:
+    user_hash = redis_db.get(username)
+    if not user_hash:
+        user_hash = helpers.get_hash()
+        redis_db.setex(username, LIFESPAN_SECS, user_hash)
+    return user_hash
+
+
+def single_round_trip(username: str) -> str:
+    pipe = redis_db.pipeline()
+    pipe.set(username, helpers.get_hash(), ex=LIFESPAN_SECS, nx=True)
+    pipe.get(username)
+    return pipe.execute()[1]
+
+
+def run(name: str, issue, new_users: bool):
+    counter = iter(range(ITERATIONS))
+
+    def step():
+        suffix = next(counter) if new_users else "existing"
+        issue("benchmark:{}:{}".format(name, suffix))
+
+    seconds = timeit.timeit(step, number=ITERATIONS)
+    print("{:<20} {:<10} {:8.1f} us/op".format(
+        name,
+        "new" if new_users else "existing",
+        seconds / ITERATIONS * 1e6,
+    ))
+
+
+if __name__ == "__main__":
+    for new_users in [True, False]:
+        run("two_calls", two_calls, new_users)
+        run("single_round_trip", single_round_trip, new_users)
+
+    for key in redis_db.scan_iter("benchmark:*"):
+        redis_db.delete(key)
@@ -0,0 +1,80 @@
+"""
+Compare how much memory Redis uses per million pending users with each HASH_FORMAT
+
+Uses database 15 of the Redis server at REDIS_URL, which is flushed first. "bucketed" needs Redis
+7.4 or later, and is skipped on older servers:
+
+    $> REDIS_URL=redis://localhost:6379 pipenv run python -m benchmarks.hash_memory
+"""
+import os
+
+import redis
+
+from src import helpers
+from src.storage import BucketedStorage
+
+USERS = int(os.getenv("USERS", 1000000))
+# Aim for ~100 hashes per bucket, like the README suggests
+BUCKETS = int(os.getenv("HASH_BUCKETS", max(USERS // 100, 1)))
+LIFESPAN_SECS = 300
+BATCH_SIZE = 10000
+# Only used to work out where each hash goes
+BUCKETED = BucketedStorage(None, BUCKETS)
+
+
+def fill_text(redis_db, pipe, username: str):
+    pipe.set(helpers.get_hash_key(username), helpers.get_hash(), ex=LIFESPAN_SECS)
+
+
+def fill_binary(redis_db, pipe, username: str):
+    pipe.set(helpers.get_hash_key(username), helpers.get_token(), ex=LIFESPAN_SECS)
+
+
+def fill_bucketed(redis_db, pipe, username: str):
+    bucket, field = BUCKETED.locate(helpers.get_hash_key(username))
+    pipe.hset(bucket, field, helpers.get_token())
+    pipe.execute_command("HEXPIRE", bucket, LIFESPAN_SECS, "FIELDS", 1, field)
+
+
+LAYOUTS = {
+    "text": fill_text,
+    "binary": fill_binary,
+    "bucketed": fill_bucketed,
+}
+
+
+def measure(redis_db, fill) -> int:
+    """
+    Return the number of bytes Redis uses to store USERS pending hashes
+    """
+    redis_db.flushdb()
+    before = redis_db.info("memory")["used_memory"]
+    pipe = redis_db.pipeline(transaction=False)
+    for number in range(USERS):
+        fill(redis_db, pipe, "goon{}".format(number))
+        if number % BATCH_SIZE == BATCH_SIZE - 1:
+            pipe.execute()
+    pipe.execute()
+    used = redis_db.info("memory")["used_memory"] - before
+    redis_db.flushdb()
+    return used
+
+
+def main():
+    redis_db = redis.StrictRedis.from_url(helpers.get_redis_url(os.getenv("REDIS_URL", ""), db=15))
+    print("{} pending users, {} buckets".format(USERS, BUCKETS))
+    for name, fill in LAYOUTS.items():
+        try:
+            used = measure(redis_db, fill)
+        except redis.ResponseError as e:
+            print("{:<8} skipped: {}".format(name, e))
+            continue
+        print("{:<8} {:6.1f} bytes per user   {:8.1f} MiB per million users".format(
+            name,
+            used / USERS,
+            used / USERS * 1000000 / 2 ** 20,
+        ))
+
+
+if __name__ == "__main__":
+    main()
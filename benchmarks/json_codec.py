@@ -0,0 +1,78 @@
+"""
+Compare the time each endpoint spends parsing its request and serializing its response with the
+standard library (decoding to str first, as get_json used to) against src.codec
+
+Install orjson or ujson to see the difference:
+
+    $> pipenv run python -m benchmarks.json_codec
+"""
+import json
+import os
+import timeit
+
+from src import codec
+
+ITERATIONS = int(os.getenv("ITERATIONS", 100000))
+
+USERNAMES = ["goon{}".format(number) for number in range(50)]
+
+# (request body, response payload) for each endpoint
+ENDPOINTS = {
+    "generate_hash": (
+        {"username": "foobar"},
+        {"hash": "hMPAtkx6xIEtVfqqP0X9bvEG8lU4Yypb"},
+    ),
+    "validate_user": (
+        {"username": "foobar"},
+        {"validated": True, "cached": False},
+    ),
+    "validate_users": (
+        {"usernames": USERNAMES},
+        {"results": [
+            {"username": username, "validated": True, "cached": False}
+            for username in USERNAMES
+        ]},
+    ),
+    "stats": (
+        None,
+        {
+            "sa_pool": {"opened": 1, "reused": 41, "waits": 0},
+            "result_cache": {"hits": 12, "misses": 30, "hit_ratio": 0.2857},
+            "local_flights": {"leaders": 30, "followers": 2},
+            "sa_breaker": {"trips": 0, "rejected": 0, "state": "closed"},
+        },
+    ),
+}
+
+
+def stdlib(body: bytes, payload: dict):
+    if body is not None:
+        json.loads(body.decode("utf-8"))
+    return json.dumps(payload).encode("utf-8")
+
+
+def fast(body: bytes, payload: dict):
+    if body is not None:
+        codec.loads(body)
+    return codec.dumps(payload)
+
+
+def main():
+    print("src.codec is using {}".format(codec.NAME))
+    for endpoint, (request, payload) in ENDPOINTS.items():
+        body = json.dumps(request).encode("utf-8") if request is not None else None
+        timings = [
+            timeit.timeit(lambda: run(body, payload), number=ITERATIONS) / ITERATIONS * 1e6
+            for run in (stdlib, fast)
+        ]
+        print("{:<16} json {:8.2f} us/op   {:<6} {:8.2f} us/op   {:5.1f}x".format(
+            endpoint,
+            timings[0],
+            codec.NAME,
+            timings[1],
+            timings[0] / timings[1],
+        ))
+
+
+if __name__ == "__main__":
+    main()
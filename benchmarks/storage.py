@@ -0,0 +1,85 @@
+"""
+Compare the latency of issuing and looking up hashes, and the memory used per million live
+hashes, between MemoryStorage and RedisStorage
+
+The Redis comparison only runs when REDIS_URL is set, and uses that server's database 15, which is
+flushed first:
+
+    $> REDIS_URL=redis://localhost:6379 pipenv run python -m benchmarks.storage
+"""
+import os
+import timeit
+import tracemalloc
+
+import redis
+
+from src import helpers
+from src.storage import MemoryStorage, RedisStorage
+
+HASHES = int(os.getenv("HASHES", 1000000))
+ITERATIONS = int(os.getenv("ITERATIONS", 10000))
+LIFESPAN_SECS = 300
+
+
+def fill(storage, count: int):
+    for number in range(count):
+        storage.add("goon{}".format(number), helpers.get_hash(), LIFESPAN_SECS)
+
+
+def latency(storage) -> tuple:
+    counter = iter(range(ITERATIONS))
+    add_secs = timeit.timeit(
+        lambda: storage.add("bench{}".format(next(counter)), helpers.get_hash(), LIFESPAN_SECS),
+        number=ITERATIONS,
+    )
+    get_secs = timeit.timeit(lambda: storage.get("goon1"), number=ITERATIONS)
+    return add_secs / ITERATIONS * 1e6, get_secs / ITERATIONS * 1e6
+
+
+def memory_storage():
+    storage = MemoryStorage()
+    tracemalloc.start()
+    fill(storage, HASHES)
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return storage, used
+
+
+def redis_storage():
+    redis_db = redis.StrictRedis.from_url(
+        helpers.get_redis_url(os.getenv("REDIS_URL", ""), db=15),
+        decode_responses=True,
+    )
+    redis_db.flushdb()
+    before = redis_db.info("memory")["used_memory"]
+    storage = RedisStorage(lambda: redis_db)
+    # Pipeline the fill so it doesn't take all day
+    pipe = redis_db.pipeline(transaction=False)
+    for number in range(HASHES):
+        pipe.set("goon{}".format(number), helpers.get_hash(), ex=LIFESPAN_SECS)
+        if number % 10000 == 0:
+            pipe.execute()
+    pipe.execute()
+    used = redis_db.info("memory")["used_memory"] - before
+    return storage, used
+
+
+def report(name: str, storage, used: int):
+    add_us, get_us = latency(storage)
+    print("{:<8} add {:7.2f} us/op   get {:7.2f} us/op   {:8.1f} MiB per million hashes".format(
+        name,
+        add_us,
+        get_us,
+        used / HASHES * 1000000 / 2 ** 20,
+    ))
+
+
+def main():
+    print("{} live hashes".format(HASHES))
+    report("memory", *memory_storage())
+    if os.getenv("REDIS_URL"):
+        report("redis", *redis_storage())
+
+
+if __name__ == "__main__":
+    main()
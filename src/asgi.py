@@ -0,0 +1,505 @@
+"""
+An asyncio (ASGI) version of the API, for serving many slow validations from a single process
+
+Shares its settings, helpers, circuit breaker, rate limit and SA credentials with the WSGI app in
+server.py. Requires the optional `httpx` and `redis>=4.2` packages, and an ASGI server:
+
+    $> pipenv run uvicorn src.asgi:app
+"""
+import asyncio
+import http.cookiejar
+import io
+import logging
+import time
+
+import falcon
+import httpx
+import redis.asyncio
+
+from . import codec
+from . import helpers
+from . import server
+from .credentials import LOGGED_OUT_MARKER, Credential, NoCredentialsAvailable
+from .responses import VALIDATION_BODIES, HashMissing
+from .singleflight import AsyncSingleFlight
+from .upstream import DeadlineExceeded, LoggedOut, StreamScanner, UpstreamError
+
+logger = logging.getLogger(__name__)
+
+
+class Request:
+    """
+    Just enough of falcon.Request for the helpers and resources to work with
+    """
+    def __init__(self, scope: dict, body: bytes = b""):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.context = {}
+        # Set once the request has been routed
+        self.uri_template = None
+        self.headers = {
+            name.decode("latin-1").upper(): value.decode("latin-1")
+            for name, value in scope["headers"]
+        }
+        self.content_type = self.headers.get("CONTENT-TYPE", "")
+        content_length = self.headers.get("CONTENT-LENGTH", "")
+        self.content_length = int(content_length) if content_length.isdigit() else None
+        self.stream = io.BytesIO(body)
+
+
+class Response:
+    """
+    Just enough of falcon.Response for the resources to work with
+    """
+    def __init__(self):
+        self.status = falcon.HTTP_200
+        self.content_type = "application/json; charset=UTF-8"
+        self.body = None
+        self.data = None
+        self.headers = {}
+
+
+class App:
+    """
+    A minimal ASGI application that routes requests to resources the same way falcon.API does
+    """
+    def __init__(self, middleware: list = None, max_body_bytes: int = None):
+        self.middleware = middleware or []
+        self.max_body_bytes = max_body_bytes
+        self.routes = {}
+
+    def add_route(self, uri_template: str, resource):
+        self.routes[uri_template] = resource
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+
+        req = Request(scope)
+        resp = Response()
+        resource = None
+        succeeded = True
+        try:
+            for middleware in self.middleware:
+                await middleware.process_request(req, resp)
+            resource = self._route(req)
+            await self._receive(req, receive)
+            await self._respond(req, resp, resource)
+        except falcon.HTTPError as ex:
+            succeeded = False
+            self._set_error(resp, ex)
+        except Exception:
+            logger.exception("Couldn't respond to %s %s", req.method, req.path)
+            succeeded = False
+            self._set_error(resp, falcon.HTTPInternalServerError())
+
+        for middleware in reversed(self.middleware):
+            process_response = getattr(middleware, "process_response", None)
+            if process_response is not None:
+                await process_response(req, resp, resource, succeeded)
+
+        payload = resp.data
+        if payload is None:
+            payload = resp.body.encode("utf-8") if resp.body is not None else b""
+        headers = [
+            (b"content-type", resp.content_type.encode("latin-1")),
+            (b"content-length", str(len(payload)).encode("latin-1")),
+        ]
+        headers.extend(
+            (name.lower().encode("latin-1"), str(value).encode("latin-1"))
+            for name, value in resp.headers.items()
+        )
+
+        await send({
+            "type": "http.response.start",
+            "status": int(resp.status.split(" ", 1)[0]),
+            "headers": headers,
+        })
+        await send({"type": "http.response.body", "body": payload})
+
+    def _set_error(self, resp: Response, error: falcon.HTTPError):
+        resp.status = error.status
+        resp.content_type = "application/json; charset=UTF-8"
+        resp.body = error.to_json()
+        resp.data = None
+        resp.headers.update(error.headers or {})
+
+    def _route(self, req: Request):
+        """
+        Return the resource for the request's path, and note the route it matched
+        """
+        # Like falcon, ignore trailing slashes
+        uri_template = req.path.rstrip("/") or "/"
+        resource = self.routes.get(uri_template)
+        if resource is None:
+            raise falcon.HTTPNotFound()
+        req.uri_template = uri_template
+        return resource
+
+    async def _receive(self, req: Request, receive):
+        """
+        Read the request body, rejecting it as soon as it's known to be more than max_body_bytes
+        """
+        if self.max_body_bytes is not None and (req.content_length or 0) > self.max_body_bytes:
+            raise helpers.get_body_too_large(self.max_body_bytes)
+
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if self.max_body_bytes is not None and size > self.max_body_bytes:
+                raise helpers.get_body_too_large(self.max_body_bytes)
+            chunks.append(chunk)
+            more_body = message.get("more_body", False)
+
+        req.stream = io.BytesIO(b"".join(chunks))
+
+    async def _respond(self, req: Request, resp: Response, resource):
+        responder = getattr(resource, "on_" + req.method.lower(), None)
+        if responder is None:
+            raise falcon.HTTPMethodNotAllowed([
+                name[3:].upper() for name in dir(resource) if name.startswith("on_")
+            ])
+
+        await responder(req, resp)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await sa_client.close()
+                # The client was handed its pool, so it won't close the pool unless it's told to
+                await redis_db.close(close_connection_pool=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+class AsyncProfileClient:
+    """
+    The same as upstream.ProfileClient, but using a pooled httpx.AsyncClient
+    """
+    def __init__(
+        self,
+        profile_url: str,
+        credentials,
+        pool_size: int = 10,
+        keep_alive: bool = True,
+        chunk_size: int = 8192,
+        max_bytes: int = 1024 * 1024,
+        connect_timeout: float = None,
+        read_timeout: float = None,
+        deadline_secs: float = None,
+        transport: httpx.AsyncBaseTransport = None,
+    ):
+        self.profile_url = profile_url
+        self.credentials = credentials
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.deadline_secs = deadline_secs
+        self.limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size if keep_alive else 0,
+        )
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.transport = transport
+        self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            # Each request brings its own credential's cookies, so don't let SA's responses set any
+            # that would then be sent along with another credential's
+            cookies = http.cookiejar.CookieJar(
+                http.cookiejar.DefaultCookiePolicy(allowed_domains=[]),
+            )
+            self._client = httpx.AsyncClient(
+                limits=self.limits,
+                timeout=self.timeout,
+                cookies=cookies,
+                transport=self.transport,
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def profile_contains(self, username: str, user_hashes: list) -> bool:
+        """
+        Check whether the user's profile page contains any of their hashes
+        """
+        for _ in range(len(self.credentials)):
+            credential = self.credentials.acquire()
+            try:
+                found = await asyncio.wait_for(
+                    self._search_profile(username, user_hashes, credential),
+                    self.deadline_secs,
+                )
+            except LoggedOut:
+                self.credentials.report_logged_out(credential)
+                continue
+            except asyncio.TimeoutError:
+                self.credentials.report_error(credential)
+                raise DeadlineExceeded("Profile took too long to download")
+            except UpstreamError:
+                self.credentials.report_error(credential)
+                raise
+            except httpx.HTTPError as ex:
+                self.credentials.report_error(credential)
+                raise UpstreamError(str(ex))
+
+            self.credentials.report_success(credential)
+            return found
+
+        raise NoCredentialsAvailable("Every set of SA cookies has been logged out")
+
+    async def _search_profile(
+        self,
+        username: str,
+        user_hashes: list,
+        credential: Credential,
+    ) -> bool:
+        needles = [user_hash.encode("utf-8") for user_hash in user_hashes]
+        needles.append(LOGGED_OUT_MARKER)
+        scanner = StreamScanner(needles, self.max_bytes)
+        found = None
+
+        request = self.client.build_request(
+            "GET",
+            self.profile_url + username,
+            cookies=credential.cookies,
+        )
+        raw_profile = await self.client.send(request, stream=True)
+        try:
+            # An error page isn't the user's profile, so it's a failure rather than a miss
+            if not raw_profile.is_success:
+                raise UpstreamError("SA responded with HTTP {}".format(raw_profile.status_code))
+            async for chunk in raw_profile.aiter_bytes(self.chunk_size):
+                found = scanner.feed(chunk)
+                if found is not None or scanner.exhausted:
+                    break
+        finally:
+            # Don't bother reading the rest of the page
+            await raw_profile.aclose()
+
+        if found == LOGGED_OUT_MARKER:
+            raise LoggedOut("SA's cookies have been logged out")
+        return found is not None
+
+
+"""
+Begin Server
+"""
+
+if server.HASH_FORMAT != "text":
+    raise RuntimeError("The ASGI app only supports HASH_FORMAT \"text\"")
+# Otherwise we'd be reading and writing a different store than the WSGI app
+if server.STORAGE_BACKEND != "redis":
+    raise RuntimeError("The ASGI app only supports STORAGE_BACKEND \"redis\"")
+if server.REDIS_REPLICA_URLS:
+    raise RuntimeError("The ASGI app doesn't support REDIS_REPLICA_URLS")
+# Profile fetches can only be shared within this process
+if server.COALESCE_MODE == "redis":
+    raise RuntimeError("The ASGI app doesn't support COALESCE_MODE \"redis\"")
+
+# Connect to the Redis DB (and automatically decode values because they're all going to be strings)
+# with a pool configured by the same settings as server.py's
+redis_db = redis.asyncio.StrictRedis(
+    connection_pool=redis.asyncio.BlockingConnectionPool.from_url(
+        server.REDIS_URL,
+        decode_responses=True,
+        max_connections=server.REDIS_MAX_CONNECTIONS,
+        timeout=server.REDIS_POOL_WAIT_SECS,
+        socket_connect_timeout=server.REDIS_CONNECT_TIMEOUT or None,
+        socket_timeout=server.REDIS_READ_TIMEOUT or None,
+        health_check_interval=server.REDIS_HEALTH_CHECK_SECS,
+    ),
+)
+
+sa_client = AsyncProfileClient(
+    server.SA_PROFILE_URL,
+    server.sa_credentials,
+    pool_size=server.SA_POOL_SIZE,
+    keep_alive=server.SA_KEEP_ALIVE,
+    max_bytes=server.SA_MAX_PROFILE_BYTES,
+    connect_timeout=server.SA_CONNECT_TIMEOUT,
+    read_timeout=server.SA_READ_TIMEOUT,
+    deadline_secs=server.SA_DEADLINE_SECS,
+)
+# Share in-flight profile fetches between concurrent validations of the same hash
+local_flights = AsyncSingleFlight()
+
+
+async def issue_hash(username: str) -> str:
+    """
+    The same as server.issue_hash()
+    """
+    if server.STATELESS_HASHES:
+        if server.record_statuses:
+            status = await server.auto_verifier.get_status_async(redis_db, username)
+            if server.needs_tracking(status):
+                pipe = redis_db.pipeline()
+                server.track_hash(username, pipe)
+                await pipe.execute()
+        return server.get_stateless_hash(username)
+
+    hash_key = helpers.get_hash_key(username)
+    pipe = redis_db.pipeline()
+    pipe.set(hash_key, server.get_new_hash(), ex=server.HASH_LIFESPAN_MINS * 60, nx=True)
+    pipe.get(hash_key)
+    created, user_hash = await pipe.execute()
+
+    if created:
+        pipe = redis_db.pipeline()
+        server.announce_hash(username, hash_key, pipe)
+        await pipe.execute()
+    return server.render_hash(user_hash)
+
+
+async def lookup_hashes(username: str) -> list:
+    """
+    Return the list of hashes that would currently validate the user
+    """
+    if server.STATELESS_HASHES:
+        return [server.get_stateless_hash(username), server.get_stateless_hash(username, 1)]
+
+    user_hash = await redis_db.get(helpers.get_hash_key(username))
+    return [user_hash] if user_hash else []
+
+
+async def request_profile(username: str, user_hashes: list) -> bool:
+    """
+    Search the user's profile for their hashes once it's our turn to make a request to SA
+    """
+    if server.sa_limiter is not None:
+        await server.sa_limiter.acquire_async(redis_db)
+
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        found = await sa_client.profile_contains(username, user_hashes)
+        outcome = "found" if found else "not_found"
+        return found
+    finally:
+        server.metrics.sa_fetch_seconds.labels(outcome).observe(time.perf_counter() - started)
+
+
+async def search_profile(username: str, user_hashes: list) -> bool:
+    """
+    Search the user's profile for their hashes, unless SA has been failing
+    """
+    return await server.sa_breaker.call_async(request_profile, username, user_hashes)
+
+
+async def fetch_profile(key: str, username: str, user_hashes: list) -> bool:
+    """
+    The same as server.fetch_profile(), but fetches are only ever shared within this process
+    """
+    if server.COALESCE_MODE == "local":
+        return await local_flights.do(key, search_profile, username, user_hashes)
+    return await search_profile(username, user_hashes)
+
+
+async def check_profile(username: str, user_hashes: list) -> tuple:
+    """
+    The same as server.check_profile()
+    """
+    cache_key = helpers.get_result_key(username, user_hashes[0])
+    caching = server.RESULT_CACHE_POSITIVE_SECS or server.RESULT_CACHE_NEGATIVE_SECS
+
+    if caching:
+        result = server.get_cached_result(await redis_db.get(cache_key))
+        if result is not None:
+            return result
+
+    validated = await fetch_profile(cache_key, username, user_hashes)
+
+    value, ttl = server.get_result_to_cache(validated)
+    if ttl:
+        await redis_db.setex(cache_key, ttl, value)
+
+    if validated and server.record_statuses:
+        await server.auto_verifier.record_validated_async(redis_db, username)
+
+    return validated, False
+
+
+class AsyncRequireJSON:
+    """
+    The API is only intended to handle application/json requests
+    """
+    async def process_request(self, req, resp):
+        server.RequireJSON().process_request(req, resp)
+
+
+class AsyncMetricsMiddleware:
+    """
+    Count every request by route and status, and time how long each took
+    """
+    async def process_request(self, req, resp):
+        server.MetricsMiddleware().process_request(req, resp)
+
+    async def process_response(self, req, resp, resource, req_succeeded):
+        server.MetricsMiddleware().process_response(req, resp, resource, req_succeeded)
+
+
+class AsyncGenerateHashResource:
+    """
+    Generate a unique identifier that a goon can post to their profile to verify their identity
+    """
+    async def on_post(self, req, resp):
+        body = helpers.get_json(req, server.MAX_BODY_BYTES or None)
+        username = helpers.get_username(body)
+
+        user_hash = await issue_hash(username)
+
+        resp.status = falcon.HTTP_200
+        resp.data = codec.dumps({"hash": user_hash})
+
+
+class AsyncValidateUserResource:
+    """
+    Check the goon's profile page for the presence of their hash
+    """
+    async def on_post(self, req, resp):
+        body = helpers.get_json(req, server.MAX_BODY_BYTES or None)
+        username = helpers.get_username(body)
+
+        user_hashes = await lookup_hashes(username)
+        if not user_hashes:
+            raise HashMissing()
+
+        # Search the user's profile page for their hash
+        try:
+            validated, cached = await check_profile(username, user_hashes)
+        except server.UPSTREAM_ERRORS as ex:
+            raise server.get_upstream_error(ex)
+
+        resp.status = falcon.HTTP_200
+        resp.data = VALIDATION_BODIES[validated, cached]
+
+
+class AsyncMetricsResource:
+    """
+    Report metrics in Prometheus' text format
+    """
+    async def on_get(self, req, resp):
+        server.MetricsResource().on_get(req, resp)
+
+
+app = App(
+    middleware=[AsyncMetricsMiddleware(), AsyncRequireJSON()],
+    max_body_bytes=server.MAX_BODY_BYTES or None,
+)
+generate_hash = AsyncGenerateHashResource()
+validate_user = AsyncValidateUserResource()
+metrics_report = AsyncMetricsResource()
+app.add_route("/v1/generate_hash", generate_hash)
+app.add_route("/v1/validate_user", validate_user)
+app.add_route("/metrics", metrics_report)
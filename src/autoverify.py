@@ -0,0 +1,256 @@
+import json
+import logging
+import time
+
+import requests
+
+from . import helpers
+from .breaker import CircuitOpenError
+from .ratelimit import RateLimited
+from .stats import Counters
+
+logger = logging.getLogger(__name__)
+
+
+class AutoVerifyStats(Counters):
+    """
+    How many pending profiles were checked, and how those checks turned out
+    """
+    names = ("checks", "validated", "expired", "deferred", "errors")
+
+
+class AutoVerifier:
+    """
+    Keep re-checking the profiles of users who've generated a hash until their hash turns up
+
+    Users are kept in a Redis sorted set scored by the time they're next due to be checked. Each
+    check that doesn't find the hash doubles the wait before the next one, from `base_secs` up to
+    `max_secs`, until the user's hash expires after `lifespan_secs`. The last check is made
+    `base_secs` before then, while the hash can still be looked up. The outcome is recorded under
+    a status key for clients to read, and kept for `status_secs` once it's final. Every change to
+    the status is also published to a pub/sub channel of the same name.
+
+    Every check is taken out of the `limiter`'s budget (when one's provided) first. Checks that
+    don't fit in the budget are put off until they do.
+    """
+    PENDING = "pending"
+    VALIDATED = "validated"
+    EXPIRED = "expired"
+
+    def __init__(
+        self,
+        get_redis,
+        key: str,
+        lookup_hashes,
+        check_profile,
+        lifespan_secs: int,
+        base_secs: float = 5,
+        max_secs: float = 60,
+        status_secs: int = 3600,
+        batch_size: int = 10,
+        limiter=None,
+        clock=time.time,
+    ):
+        self.get_redis = get_redis
+        self.key = key
+        self.lookup_hashes = lookup_hashes
+        self.check_profile = check_profile
+        self.lifespan_secs = lifespan_secs
+        self.base_secs = base_secs
+        self.max_secs = max_secs
+        self.status_secs = status_secs
+        self.batch_size = batch_size
+        self.limiter = limiter
+        self.clock = clock
+        self.stats = AutoVerifyStats()
+
+    def schedule(self, username: str, pipe=None):
+        """
+        Start checking the user's profile, starting over if they were already being checked
+
+        Pass a pipeline to send the commands along with others.
+        """
+        self._start(username, pipe, check=True)
+
+    def track(self, username: str, pipe=None):
+        """
+        Record that the user is waiting for their hash to be found, without checking their profile
+        ourselves
+
+        Their status changes once one of our own checks validates them, and reads as expired once
+        their hash has. Pass a pipeline to send the commands along with others.
+        """
+        self._start(username, pipe, check=False)
+
+    def record_validated(self, username: str):
+        """
+        Record that the user's hash was found by a check of our own (like /v1/validate_user), and
+        stop checking them if they were still pending
+        """
+        status = self._to_validate(self.get_status(username))
+        if status is None:
+            return
+
+        redis_db = self.get_redis()
+        redis_db.zrem(self.key, username)
+        self._record(redis_db, username, status, self.VALIDATED)
+
+    async def record_validated_async(self, redis_db, username: str):
+        """
+        The same as record_validated(), but using an asyncio Redis client
+        """
+        status = self._to_validate(await self.get_status_async(redis_db, username))
+        if status is None:
+            return
+
+        pipe = redis_db.pipeline()
+        pipe.zrem(self.key, username)
+        self._finish(pipe, username, status, self.VALIDATED)
+        await pipe.execute()
+
+    def get_status(self, username: str) -> dict:
+        """
+        Return the user's auto-verification status, or None if they aren't being checked
+        """
+        return self._expire(self._load(self.get_redis(), username))
+
+    async def get_status_async(self, redis_db, username: str) -> dict:
+        """
+        The same as get_status(), but using an asyncio Redis client
+        """
+        status = await redis_db.get(helpers.get_status_key(username))
+        return self._expire(json.loads(status) if status is not None else None)
+
+    def run_once(self) -> int:
+        """
+        Check every user that's currently due (up to `batch_size` of them)
+
+        Returns the number of users that were due.
+        """
+        redis_db = self.get_redis()
+        due = redis_db.zrangebyscore(self.key, "-inf", self.clock(), start=0, num=self.batch_size)
+        for username in due:
+            # Whoever removes the user from the set gets to check them, so several schedulers can
+            # share the set
+            if redis_db.zrem(self.key, username):
+                try:
+                    self._check(redis_db, username)
+                except Exception:
+                    logger.exception("Couldn't check %s's profile", username)
+                    self.stats.incr("errors")
+                    # Put the user back, or nobody would ever check them again
+                    redis_db.zadd(self.key, {username: self.clock() + self.base_secs})
+        return len(due)
+
+    def run(self, stop, poll_secs: float = 1):
+        """
+        Check users as they fall due until `stop` (a threading.Event) is set
+        """
+        while not stop.is_set():
+            try:
+                due = self.run_once()
+            except Exception:
+                logger.exception("Couldn't check pending users' profiles")
+                due = 0
+            if due < self.batch_size:
+                stop.wait(poll_secs)
+
+    def _check(self, redis_db, username: str):
+        # Read the status as it's stored, so that an expiry is recorded (and published) here
+        status = self._load(redis_db, username)
+        if status is None or status["status"] != self.PENDING:
+            return
+
+        now = self.clock()
+        user_hashes = self.lookup_hashes([username])[username]
+        if not user_hashes or now >= status["expires_at"]:
+            self.stats.incr("expired")
+            return self._record(redis_db, username, status, self.EXPIRED)
+
+        if self.limiter is not None:
+            retry_after = self.limiter.try_acquire()
+            if retry_after:
+                self.stats.incr("deferred")
+                redis_db.zadd(self.key, {username: now + retry_after})
+                return
+
+        self.stats.incr("checks")
+        status["attempts"] += 1
+        try:
+            validated, _ = self.check_profile(username, user_hashes)
+        except (CircuitOpenError, RateLimited, requests.RequestException):
+            self.stats.incr("errors")
+            validated = False
+
+        if validated:
+            self.stats.incr("validated")
+            return self._record(redis_db, username, status, self.VALIDATED)
+
+        delay = min(self.base_secs * 2 ** status["attempts"], self.max_secs)
+        next_check = now + delay
+        # By the time the hash expires it's gone, so take one last look shortly before then and
+        # only come back afterwards to record that it expired
+        last_check = status["expires_at"] - self.base_secs
+        if next_check > last_check:
+            next_check = last_check if now < last_check else status["expires_at"]
+
+        pipe = redis_db.pipeline()
+        self._save(pipe, username, status, self.lifespan_secs + self.status_secs)
+        pipe.zadd(self.key, {username: next_check})
+        pipe.execute()
+
+    def _start(self, username: str, pipe, check: bool):
+        now = self.clock()
+        status = {
+            "status": self.PENDING,
+            "attempts": 0,
+            "expires_at": now + self.lifespan_secs,
+        }
+
+        execute = pipe is None
+        if execute:
+            pipe = self.get_redis().pipeline()
+        self._save(pipe, username, status, self.lifespan_secs + self.status_secs)
+        if check:
+            pipe.zadd(self.key, {username: now + self.base_secs})
+        if execute:
+            pipe.execute()
+
+    def _load(self, redis_db, username: str) -> dict:
+        status = redis_db.get(helpers.get_status_key(username))
+        return json.loads(status) if status is not None else None
+
+    def _expire(self, status: dict) -> dict:
+        # Users nobody is checking are never recorded as expired, so work it out when reading
+        if (
+            status is not None
+            and status["status"] == self.PENDING
+            and status["expires_at"] is not None
+            and self.clock() >= status["expires_at"]
+        ):
+            status["status"] = self.EXPIRED
+        return status
+
+    def _to_validate(self, status: dict) -> dict:
+        # The status to record as validated, or None if it already is
+        if status is not None and status["status"] == self.VALIDATED:
+            return None
+        if status is None:
+            return {"status": self.PENDING, "attempts": 0, "expires_at": None}
+        return status
+
+    def _record(self, redis_db, username: str, status: dict, outcome: str):
+        pipe = redis_db.pipeline()
+        self._finish(pipe, username, status, outcome)
+        pipe.execute()
+
+    def _finish(self, pipe, username: str, status: dict, outcome: str):
+        status["status"] = outcome
+        status["checked_at"] = self.clock()
+        self._save(pipe, username, status, self.status_secs)
+
+    def _save(self, pipe, username: str, status: dict, ttl: int):
+        status_key = helpers.get_status_key(username)
+        payload = json.dumps(status)
+        pipe.setex(status_key, ttl, payload)
+        pipe.publish(status_key, payload)
@@ -0,0 +1,133 @@
+import threading
+import time
+
+from .stats import Counters
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of making a call while the circuit breaker is open
+    """
+    def __init__(self, retry_after: float):
+        super().__init__("Circuit breaker is open")
+        self.retry_after = retry_after
+
+
+class BreakerStats(Counters):
+    """
+    How often the breaker has tripped, rejected calls, and changed state
+    """
+    names = ("trips", "rejected", "to_open", "to_half_open", "to_closed")
+
+
+class CircuitBreaker:
+    """
+    Stop calling a failing dependency for a while so we fail fast instead of piling up on it
+
+    After `failure_threshold` consecutive failures the breaker opens and rejects every call for
+    `recovery_secs`. It then goes half-open and lets up to `half_open_max_calls` trial calls
+    through: one success closes it again, one failure re-opens it.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        recovery_secs: float = 30,
+        half_open_max_calls: int = 1,
+        failure_exceptions: tuple = (Exception,),
+        clock=time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.recovery_secs = recovery_secs
+        self.half_open_max_calls = half_open_max_calls
+        self.failure_exceptions = failure_exceptions
+        self.clock = clock
+        self.stats = BreakerStats()
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._trial_calls = 0
+        self._lock = threading.Lock()
+
+    def call(self, fn, *args):
+        self._before_call()
+        try:
+            result = fn(*args)
+        except self.failure_exceptions:
+            self._on_failure()
+            raise
+        except BaseException:
+            self._on_release()
+            raise
+
+        self._on_success()
+        return result
+
+    async def call_async(self, fn, *args):
+        """
+        The same as call(), but for coroutine functions
+        """
+        self._before_call()
+        try:
+            result = await fn(*args)
+        except self.failure_exceptions:
+            self._on_failure()
+            raise
+        except BaseException:
+            self._on_release()
+            raise
+
+        self._on_success()
+        return result
+
+    def _set_state(self, state: str):
+        self.state = state
+        self.stats.incr("to_" + state)
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                remaining = self._opened_at + self.recovery_secs - self.clock()
+                if remaining > 0:
+                    self.stats.incr("rejected")
+                    raise CircuitOpenError(remaining)
+                self._set_state(self.HALF_OPEN)
+                self._trial_calls = 0
+
+            if self.state == self.HALF_OPEN:
+                if self._trial_calls >= self.half_open_max_calls:
+                    self.stats.incr("rejected")
+                    raise CircuitOpenError(self.recovery_secs)
+                self._trial_calls += 1
+
+    def _on_success(self):
+        with self._lock:
+            self._failures = 0
+            if self.state == self.HALF_OPEN:
+                self._set_state(self.CLOSED)
+
+    def _on_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.stats.incr("trips")
+                    self._set_state(self.OPEN)
+                self._opened_at = self.clock()
+                self._failures = 0
+
+    def _on_release(self):
+        """
+        The call failed for reasons that say nothing about the dependency's health
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial_calls -= 1
+
+    def as_dict(self) -> dict:
+        stats = self.stats.as_dict()
+        stats["state"] = self.state
+        return stats
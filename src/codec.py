@@ -0,0 +1,35 @@
+"""
+Encode and decode JSON with the fastest library that's installed
+
+orjson is preferred, then ujson, then the standard library's json module. Either way, loads()
+accepts bytes (no need to decode them first) and dumps() returns bytes, ready for `resp.data`.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+if orjson is not None:
+    NAME = "orjson"
+    loads = orjson.loads
+    dumps = orjson.dumps
+elif ujson is not None:
+    NAME = "ujson"
+    loads = ujson.loads
+
+    def dumps(obj) -> bytes:
+        return ujson.dumps(obj, escape_forward_slashes=False).encode("utf-8")
+else:
+    NAME = "json"
+    loads = json.loads
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
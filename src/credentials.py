@@ -0,0 +1,144 @@
+import json
+import threading
+import time
+
+import requests
+
+
+# The cookies we need from a logged-in SA user
+COOKIE_NAMES = ("sessionid", "sessionhash", "bbuserid", "bbpassword")
+
+# Part of the login form SA shows instead of a profile when the cookies aren't logged in. This
+# has to be markup: anyone can write "you must be a registered forums member" in their profile, but
+# SA escapes any HTML they write
+LOGGED_OUT_MARKER = b'<input type="hidden" name="action" value="login">'
+
+
+class NoCredentialsAvailable(requests.RequestException):
+    """
+    Raised when every set of SA cookies has been logged out
+    """
+
+
+def load_cookie_sets(environ, path: str = None) -> list:
+    """
+    Load every set of SA cookies we've been given
+
+    Sets are read from a JSON file at `path` containing a list of {cookie name: value} objects if
+    one is provided, or else from numbered environment variables (COOKIE_SESSIONID_1,
+    COOKIE_SESSIONHASH_1, etc...). Returns an empty list if neither are present.
+    """
+    if path:
+        with open(path) as cookie_file:
+            return json.load(cookie_file)
+
+    cookie_sets = []
+    number = 1
+    while "COOKIE_SESSIONID_{}".format(number) in environ:
+        cookie_sets.append({
+            name: environ.get("COOKIE_{}_{}".format(name.upper(), number))
+            for name in COOKIE_NAMES
+        })
+        number += 1
+
+    return cookie_sets
+
+
+class Credential:
+    """
+    A set of SA cookies and how well it's been working
+    """
+    def __init__(self, name: str, cookies: dict):
+        self.name = name
+        self.cookies = {k: v for k, v in cookies.items() if v is not None}
+        self.requests = 0
+        self.errors = 0
+        self.logged_out = 0
+        self.last_used = float("-inf")
+        # When this credential can be used again after being logged out
+        self.retry_at = None
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "logged_out": self.logged_out,
+            "error_rate": self.errors / self.requests if self.requests else 0.0,
+            "healthy": self.retry_at is None,
+        }
+
+
+class CredentialPool:
+    """
+    Spread requests to SA across several sets of cookies
+
+    Credentials are picked "round_robin" or least recently used ("lru"). One that turns out to be
+    logged out is taken out of rotation for `recheck_secs`, after which it's tried again.
+    """
+    def __init__(
+        self,
+        cookie_sets: list,
+        strategy: str = "round_robin",
+        recheck_secs: float = 300,
+        clock=time.monotonic,
+    ):
+        if strategy not in ("round_robin", "lru"):
+            raise ValueError("Unknown credential strategy: {}".format(strategy))
+
+        self.credentials = [
+            Credential(str(number), cookies)
+            for number, cookies in enumerate(cookie_sets, start=1)
+        ]
+        self.strategy = strategy
+        self.recheck_secs = recheck_secs
+        self.clock = clock
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.credentials)
+
+    def acquire(self) -> Credential:
+        with self._lock:
+            now = self.clock()
+            available = [
+                credential for credential in self.credentials
+                if credential.retry_at is None or credential.retry_at <= now
+            ]
+            if not available:
+                raise NoCredentialsAvailable("Every set of SA cookies has been logged out")
+
+            if self.strategy == "lru":
+                credential = min(available, key=lambda credential: credential.last_used)
+            else:
+                credential = self._next_round_robin(available)
+
+            credential.requests += 1
+            credential.last_used = now
+            return credential
+
+    def _next_round_robin(self, available: list) -> Credential:
+        count = len(self.credentials)
+        for offset in range(count):
+            credential = self.credentials[(self._next + offset) % count]
+            if credential in available:
+                self._next = (self._next + offset + 1) % count
+                return credential
+
+    def report_success(self, credential: Credential):
+        with self._lock:
+            credential.retry_at = None
+
+    def report_error(self, credential: Credential):
+        with self._lock:
+            credential.errors += 1
+
+    def report_logged_out(self, credential: Credential):
+        with self._lock:
+            credential.errors += 1
+            credential.logged_out += 1
+            credential.retry_at = self.clock() + self.recheck_secs
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {credential.name: credential.as_dict() for credential in self.credentials}
@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .stats import CacheStats
+
+logger = logging.getLogger(__name__)
+
+
+class HashCacheStats(CacheStats):
+    """
+    How often hashes were found in the cache, why they left it, and how long invalidations took to
+    arrive
+    """
+    names = ("hits", "misses", "evictions", "expirations", "invalidations")
+
+    def __init__(self):
+        super().__init__()
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def record_lag(self, lag: float):
+        with self._lock:
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+
+    def as_dict(self) -> dict:
+        stats = super().as_dict()
+        stats["invalidation_lag_secs"] = {"last": self.last_lag, "max": self.max_lag}
+        return stats
+
+
+class HashCache:
+    """
+    Remember recently looked-up hashes in this worker so most lookups don't need Redis
+
+    Up to `max_entries` hashes are kept, least recently used first out. Each is only kept until
+    the sooner of its expiry in Redis and `max_ttl_secs` from now, so an expired hash is never
+    served. Hashes that change in Redis some other way are invalidated by messages published to
+    `channel`: the cache is only used while this worker is subscribed to it, and is emptied
+    whenever the subscription drops in case it missed something.
+    """
+    def __init__(
+        self,
+        get_redis,
+        subscribe,
+        channel: str,
+        max_entries: int = 10000,
+        max_ttl_secs: float = 60,
+        poll_secs: float = 1,
+        retry_secs: float = 1,
+        clock=time.monotonic,
+    ):
+        self.get_redis = get_redis
+        self.subscribe = subscribe
+        self.channel = channel
+        self.max_entries = max_entries
+        self.max_ttl_secs = max_ttl_secs
+        self.poll_secs = poll_secs
+        self.retry_secs = retry_secs
+        self.clock = clock
+        self.stats = HashCacheStats()
+        self.listening = False
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_many(self, keys: list) -> dict:
+        """
+        Map each hash key to its hash, or None if there isn't one
+        """
+        self._ensure_listener()
+        hashes = {}
+        misses = []
+        now = self.clock()
+
+        with self._lock:
+            generation = self._generation
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(key)
+                    hashes[key] = entry[0]
+                    continue
+                if entry is not None:
+                    del self._entries[key]
+                    self.stats.incr("expirations")
+                misses.append(key)
+
+        self.stats.incr("hits", len(hashes))
+        self.stats.incr("misses", len(misses))
+        if not misses:
+            return hashes
+
+        # Fetch each hash along with how long it has left, all in a single round trip
+        pipe = self.get_redis().pipeline(transaction=False)
+        for key in misses:
+            pipe.get(key)
+            pipe.pttl(key)
+        replies = pipe.execute()
+
+        with self._lock:
+            # Don't cache anything if a hash was invalidated while we were reading from Redis
+            store = self.listening and self._generation == generation
+            for key, user_hash, pttl in zip(misses, replies[::2], replies[1::2]):
+                hashes[key] = user_hash
+                if store and user_hash is not None and pttl is not None and pttl > 0:
+                    self._store(key, user_hash, now + min(pttl / 1000, self.max_ttl_secs))
+
+        return hashes
+
+    def publish_invalidation(self, key: str, pipe=None):
+        """
+        Tell every worker to forget the hash they have cached under the key
+
+        Pass a pipeline to send the message along with other commands.
+        """
+        message = json.dumps({"key": key, "at": time.time()})
+        (pipe if pipe is not None else self.get_redis()).publish(self.channel, message)
+
+    def invalidate(self, key: str = None):
+        """
+        Forget the hash cached under the key, or every hash if no key is given
+        """
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._entries.clear()
+            elif self._entries.pop(key, None) is not None:
+                self.stats.incr("invalidations")
+
+    def _store(self, key: str, user_hash: str, expires_at: float):
+        self._entries[key] = (user_hash, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats.incr("evictions")
+
+    def _ensure_listener(self):
+        """
+        Start listening for invalidations, once per process (after gunicorn forks)
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self.listening = False
+            self._entries.clear()
+            threading.Thread(target=self._listen, name="hash-cache", daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.subscribe(self.channel)
+                self.listening = True
+                while True:
+                    message = pubsub.get_message(timeout=self.poll_secs)
+                    if message is not None:
+                        self._on_message(message["data"])
+            except Exception:
+                logger.exception("Lost the hash cache's invalidation subscription")
+                self.listening = False
+                self.invalidate()
+                time.sleep(self.retry_secs)
+
+    def _on_message(self, data: str):
+        try:
+            message = json.loads(data)
+            key, published_at = message["key"], message["at"]
+        except (ValueError, TypeError, KeyError):
+            # We can't tell which hash to forget, so forget them all
+            return self.invalidate()
+
+        self.invalidate(key)
+        self.stats.record_lag(max(time.time() - published_at, 0.0))
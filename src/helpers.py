@@ -1,15 +1,74 @@
 import falcon
+import hashlib
+import hmac
 import json
+import time
 import uuid
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
 
+from . import codec
 
-def get_json(req: falcon.Request) -> dict:
+
+# The number of bytes read from a request body at a time
+READ_CHUNK_BYTES = 8192
+# Falcon 2 renamed HTTPRequestEntityTooLarge to HTTPPayloadTooLarge
+HTTPPayloadTooLarge = (
+    getattr(falcon, "HTTPPayloadTooLarge", None) or falcon.HTTPRequestEntityTooLarge
+)
+
+
+def read_body(stream, max_bytes: int) -> bytes:
+    """
+    Read a request body, stopping as soon as it's more than `max_bytes` long
+    """
+    chunks = []
+    remaining = max_bytes + 1
+    while remaining > 0:
+        chunk = stream.read(min(remaining, READ_CHUNK_BYTES))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def get_body_too_large(max_bytes: int) -> HTTPPayloadTooLarge:
+    """
+    Return the error for a request body that's larger than `max_bytes`
+    """
+    return HTTPPayloadTooLarge(
+        "Request Body Too Large",
+        "Request bodies can't be larger than {} bytes".format(max_bytes),
+    )
+
+
+def get_json(req: falcon.Request, max_bytes: int = None) -> dict:
     """
     Turn a request stream into a JSON dictionary
+
+    The body is parsed straight from bytes by the fastest JSON library available. If that fails,
+    it's parsed again the old way so that clients get the same error messages whichever is used.
+
+    When `max_bytes` is provided, bodies larger than that are rejected with a 413: up front if
+    their Content-Length says so, or else as soon as that many bytes have been read.
     """
+    if max_bytes is not None and (req.content_length or 0) > max_bytes:
+        raise get_body_too_large(max_bytes)
+
     try:
-        body = req.stream.read()
-        raw_json = json.loads(body.decode("utf-8"))
+        if max_bytes is None:
+            body = req.stream.read()
+        else:
+            body = read_body(req.stream, max_bytes)
+            if len(body) > max_bytes:
+                raise get_body_too_large(max_bytes)
+
+        try:
+            raw_json = codec.loads(body)
+        except Exception:
+            raw_json = json.loads(body.decode("utf-8"))
+    except falcon.HTTPError:
+        raise
     except Exception as ex:
         ex_type = type(ex)
         str_error = str(ex)
@@ -38,8 +97,183 @@ def get_username(body: dict) -> str:
     return body["username"].replace(" ", "%20")
 
 
-def get_hash() -> str:
+def get_usernames(body: dict, max_count: int) -> list:
+    """
+    Pass in the request body (the output from json.loads()) and check for a list of usernames
+    """
+    if "usernames" not in body:
+        raise falcon.HTTPMissingParam("usernames")
+
+    usernames = body["usernames"]
+    if not isinstance(usernames, list) or not usernames:
+        raise falcon.HTTPInvalidParam(
+            "Usernames must be a non-empty list",
+            "usernames"
+        )
+
+    if len(usernames) > max_count:
+        raise falcon.HTTPInvalidParam(
+            "No more than {} usernames can be validated at once".format(max_count),
+            "usernames"
+        )
+
+    if not all(isinstance(username, str) for username in usernames):
+        raise falcon.HTTPInvalidParam(
+            "Usernames must be strings",
+            "usernames"
+        )
+
+    return [get_username({"username": username}) for username in usernames]
+
+
+def get_token() -> bytes:
+    """
+    Return 16 random bytes, the compact form of a hash
+    """
+    return uuid.uuid4().bytes
+
+
+def render_token(token: bytes) -> str:
+    """
+    Turn a token from get_token() into the 32-character hash users put in their profile
+    """
+    return token.hex()
+
+
+def get_hash(username: str = None, secret: str = None, bucket: int = None) -> str:
     """
     Return a 32-character long random string
+
+    When a `secret` is provided the string is instead an HMAC of the username and time bucket, so
+    the same hash can be recomputed later without having to store it anywhere
+    """
+    if secret is None:
+        return render_token(get_token())
+
+    message = "{}:{}".format(username.lower(), bucket)
+    digest = hmac.new(secret.encode("utf-8"), message.encode("utf-8"), hashlib.sha256)
+    return digest.hexdigest()[:32]
+
+
+# Every key we store in Redis starts with this
+KEY_PREFIX = "goonauth"
+
+
+def get_hash_key(username: str) -> str:
+    """
+    Return the Redis key the user's hash is stored under
+
+    Every key about a user wraps their username in a {hash tag}, so that Redis Cluster (and
+    ShardedStorage) keep them all on the same shard.
+    """
+    return "{}:hash:{{{}}}".format(KEY_PREFIX, username)
+
+
+def is_hash_key(key: str) -> bool:
+    """
+    Return whether the key is one that get_hash_key() returns
+    """
+    return key.startswith(KEY_PREFIX + ":hash:")
+
+
+def get_result_key(username: str, user_hash: str) -> str:
+    """
+    Return the Redis key a validation result for this username and hash is cached under
+    """
+    return "{}:validated:{{{}}}:{}".format(KEY_PREFIX, username, user_hash)
+
+
+def get_job_key(job_id: str) -> str:
+    """
+    Return the Redis key a queued validation and its result are stored under
+    """
+    return "{}:job:{}".format(KEY_PREFIX, job_id)
+
+
+def get_status_key(username: str) -> str:
+    """
+    Return the Redis key the user's auto-verification status is stored under
+    """
+    return "{}:status:{{{}}}".format(KEY_PREFIX, username)
+
+
+def get_rate_limit_key(name: str) -> str:
+    """
+    Return the Redis key a rate limit shared by every worker is tracked under
+    """
+    return "{}:rate_limit:{}".format(KEY_PREFIX, name)
+
+
+def get_queue_key(name: str) -> str:
+    """
+    Return the Redis key of a queue of work shared by every worker
+    """
+    return "{}:queue:{}".format(KEY_PREFIX, name)
+
+
+def get_channel(name: str) -> str:
+    """
+    Return the name of a pub/sub channel every worker listens on
+    """
+    return "{}:channel:{}".format(KEY_PREFIX, name)
+
+
+def get_hash_tag(key: str) -> str:
+    """
+    Return the part of the key that decides which shard it's stored on, the same way Redis
+    Cluster does: whatever's inside the first {...}, or else the whole key
+    """
+    start = key.find("{")
+    if start != -1:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def get_redis_url(url: str, db: int = None) -> str:
+    """
+    Return the Redis URL with DB 0 picked, unless it already picks a DB or is for a unix socket
+    (which picks one with `?db=`)
+
+    An empty URL means a local Redis server on its default port. Pass `db` to pick that DB
+    instead, whichever one the URL picks.
+    """
+    if not url:
+        url = "redis://localhost:6379"
+    parsed = urlparse(url)
+    if db is not None:
+        if parsed.scheme == "unix":
+            query = [(name, value) for name, value in parse_qsl(parsed.query) if name != "db"]
+            query.append(("db", str(db)))
+            return "{}?{}".format(url.split("?", 1)[0], urlencode(query))
+        return urlunparse(parsed._replace(path="/{}".format(db)))
+    if parsed.scheme == "unix" or parsed.path.strip("/"):
+        return url
+    return url.rstrip("/") + "/0"
+
+
+def get_shard_name(url: str) -> str:
+    """
+    Name a Redis server after its address and DB, leaving out any password in its URL
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "unix":
+        return parsed.path
+    return "{}:{}{}".format(parsed.hostname, parsed.port or 6379, parsed.path)
+
+
+def get_event(name: str, data: dict) -> bytes:
+    """
+    Encode a server-sent event
+    """
+    return "event: {}\ndata: {}\n\n".format(name, json.dumps(data)).encode("utf-8")
+
+
+def get_time_bucket(bucket_secs: int, now: float = None) -> int:
+    """
+    Return the number of the `bucket_secs`-long window of time that `now` falls into
     """
-    return str(uuid.uuid4()).replace("-", "")[:32]
+    if now is None:
+        now = time.time()
+    return int(now // bucket_secs)
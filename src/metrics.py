@@ -0,0 +1,62 @@
+"""
+Prometheus metrics, served at /metrics
+
+To add up every gunicorn worker's metrics, point PROMETHEUS_MULTIPROC_DIR at an empty directory
+before starting gunicorn. Each worker then keeps its metrics in files in that directory, and
+whichever worker handles /metrics reads them all.
+"""
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Most Redis commands take well under the default buckets' smallest 5ms
+REDIS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+requests_total = Counter(
+    "goonauth_requests_total",
+    "HTTP requests handled",
+    ["method", "route", "status"],
+)
+request_seconds = Histogram(
+    "goonauth_request_duration_seconds",
+    "Time spent handling HTTP requests",
+    ["method", "route"],
+)
+redis_seconds = Histogram(
+    "goonauth_redis_command_duration_seconds",
+    "Time spent on Redis commands, with each pipeline counted as one",
+    ["command"],
+    buckets=REDIS_BUCKETS,
+)
+sa_fetch_seconds = Histogram(
+    "goonauth_sa_fetch_duration_seconds",
+    "Time spent fetching and searching SA profiles",
+    ["outcome"],
+)
+
+
+def observe_redis(command: str, secs: float):
+    """
+    Record how long a Redis command took
+    """
+    redis_seconds.labels(command.upper()).observe(secs)
+
+
+def render() -> tuple:
+    """
+    Return a (content type, body) tuple with every metric in Prometheus' text format, added up
+    across processes if PROMETHEUS_MULTIPROC_DIR is set
+    """
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return CONTENT_TYPE_LATEST, generate_latest(registry)
@@ -0,0 +1,133 @@
+import asyncio
+import time
+
+from .stats import Counters
+
+
+# GCRA (generic cell rate algorithm) in a single atomic round trip. The key holds the "theoretical
+# arrival time" (TAT) of the next request in milliseconds, according to Redis' clock so that every
+# host agrees on the time. Redis 5+ replicates the script's writes rather than the script itself,
+# so reading TIME before writing is safe. Returns {allowed, milliseconds until a request would be
+# allowed}.
+GCRA_SCRIPT = """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local emission_ms = tonumber(ARGV[1])
+local burst_ms = tonumber(ARGV[2])
+
+local tat = tonumber(redis.call("GET", KEYS[1]) or now)
+if tat < now then
+    tat = now
+end
+
+local new_tat = tat + emission_ms
+local allow_at = new_tat - burst_ms
+if now < allow_at then
+    return {0, allow_at - now}
+end
+
+redis.call("SET", KEYS[1], new_tat, "PX", new_tat - now)
+return {1, 0}
+"""
+
+
+class RateLimited(Exception):
+    """
+    Raised when a request can't be made within the time we're willing to wait for one
+    """
+    def __init__(self, retry_after: float):
+        super().__init__("Rate limit exceeded")
+        self.retry_after = retry_after
+
+
+class LimiterStats(Counters):
+    names = ("allowed", "delayed", "rejected")
+
+
+class RateLimiter:
+    """
+    A token bucket shared by every worker on every host, stored in Redis
+
+    Allows `rate` requests every `period_secs` on average, with bursts of up to `burst` requests.
+    A request over the limit waits for up to `max_wait_secs` for its turn before giving up.
+    """
+    def __init__(
+        self,
+        get_redis,
+        key: str,
+        rate: int,
+        period_secs: float = 1,
+        burst: int = 1,
+        max_wait_secs: float = 0,
+    ):
+        self.get_redis = get_redis
+        self.key = key
+        self.emission_ms = max(int(period_secs * 1000 / rate), 1)
+        self.burst_ms = self.emission_ms * burst
+        self.max_wait_secs = max_wait_secs
+        self.stats = LimiterStats()
+        self._script = None
+        self._async_script = None
+
+    def try_acquire(self) -> float:
+        """
+        Take a request from the bucket if one is available
+
+        Returns 0 if the request is allowed, or else the number of seconds until one would be
+        """
+        redis_db = self.get_redis()
+        if self._script is None:
+            self._script = redis_db.register_script(GCRA_SCRIPT)
+        _, retry_after_ms = self._script(
+            keys=[self.key],
+            args=[self.emission_ms, self.burst_ms],
+            client=redis_db,
+        )
+        return int(retry_after_ms) / 1000
+
+    def acquire(self):
+        """
+        Wait until a request is allowed, or raise RateLimited if that would take too long
+        """
+        deadline = time.monotonic() + self.max_wait_secs
+        delayed = False
+
+        while True:
+            retry_after = self.try_acquire()
+            if not retry_after:
+                self.stats.incr("delayed" if delayed else "allowed")
+                return
+
+            if time.monotonic() + retry_after > deadline:
+                self.stats.incr("rejected")
+                raise RateLimited(retry_after)
+
+            delayed = True
+            time.sleep(retry_after)
+
+    async def acquire_async(self, redis_db):
+        """
+        The same as acquire(), but using an asyncio Redis client (which must support scripting)
+        """
+        if self._async_script is None:
+            self._async_script = redis_db.register_script(GCRA_SCRIPT)
+
+        deadline = time.monotonic() + self.max_wait_secs
+        delayed = False
+
+        while True:
+            _, retry_after_ms = await self._async_script(
+                keys=[self.key],
+                args=[self.emission_ms, self.burst_ms],
+            )
+            retry_after = int(retry_after_ms) / 1000
+            if not retry_after:
+                self.stats.incr("delayed" if delayed else "allowed")
+                return
+
+            if time.monotonic() + retry_after > deadline:
+                self.stats.incr("rejected")
+                raise RateLimited(retry_after)
+
+            delayed = True
+            await asyncio.sleep(retry_after)
@@ -0,0 +1,238 @@
+"""
+Redis connection pools sized for gunicorn's worker model
+"""
+import time
+from urllib.parse import urlparse
+
+import redis
+import redis.cluster
+
+from .stats import Counters
+
+
+class PoolStats(Counters):
+    """
+    How often connections were taken from a pool, and how long that took
+    """
+    names = ("checkouts", "waits", "timeouts")
+
+    def __init__(self):
+        super().__init__()
+        self.total_wait_secs = 0.0
+        self.max_wait_secs = 0.0
+
+    def record_checkout(self, wait_secs: float, waited: bool):
+        with self._lock:
+            self.checkouts += 1
+            self.waits += waited
+            self.total_wait_secs += wait_secs
+            self.max_wait_secs = max(self.max_wait_secs, wait_secs)
+
+    def as_dict(self) -> dict:
+        stats = super().as_dict()
+        with self._lock:
+            stats["avg_wait_ms"] = (
+                round(self.total_wait_secs / self.checkouts * 1000, 3) if self.checkouts else 0.0
+            )
+            stats["max_wait_ms"] = round(self.max_wait_secs * 1000, 3)
+        return stats
+
+
+class MeteredConnectionPool(redis.BlockingConnectionPool):
+    """
+    A pool of at most `max_connections` connections, which waits up to `timeout` seconds for one
+    to be free
+
+    A pool is created empty and only connects when it's first used, so one created at import time
+    doesn't open anything before gunicorn forks. If it's used in a forked child anyway, redis-py
+    has the child start afresh without closing the sockets the parent is still using.
+    """
+    def __init__(self, **kwargs):
+        self.stats = PoolStats()
+        super().__init__(**kwargs)
+
+    def get_connection(self, command_name, *keys, **options):
+        started = time.monotonic()
+        waited = self.pool.empty()
+        try:
+            connection = super().get_connection(command_name, *keys, **options)
+        except redis.ConnectionError:
+            if self.timeout is not None and time.monotonic() - started >= self.timeout:
+                self.stats.incr("timeouts")
+            raise
+        self.stats.record_checkout(time.monotonic() - started, waited)
+        return connection
+
+    def as_dict(self) -> dict:
+        stats = self.stats.as_dict()
+        idle = sum(1 for connection in list(self.pool.queue) if connection is not None)
+        parser_class = self.connection_kwargs.get("parser_class", redis.connection.DefaultParser)
+        stats.update({
+            "max_connections": self.max_connections,
+            "open": len(self._connections),
+            "in_use": len(self._connections) - idle,
+            # HiredisParser when hiredis is installed
+            "parser": parser_class.__name__,
+        })
+        return stats
+
+
+class TimedRedis(redis.StrictRedis):
+    """
+    A Redis client that calls `observe(command, secs)` with how long each command took
+
+    A pipeline is timed as a whole, as "MULTI" when it's a transaction or else "PIPELINE".
+    """
+    def __init__(self, observe, **kwargs):
+        super().__init__(**kwargs)
+        self.observe = observe
+
+    def execute_command(self, *args, **options):
+        return self._timed(args[0], super().execute_command, *args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        pipe = super().pipeline(transaction, shard_hint)
+        execute = pipe.execute
+        pipe.execute = lambda *args, **kwargs: self._timed(
+            "MULTI" if transaction else "PIPELINE",
+            execute,
+            *args,
+            **kwargs,
+        )
+        return pipe
+
+    def _timed(self, command: str, fn, *args, **kwargs):
+        return _timed(self.observe, command, fn, *args, **kwargs)
+
+
+class MeteredRedisCluster(redis.cluster.RedisCluster):
+    """
+    A Redis Cluster client that keeps its connections to each node in a MeteredConnectionPool,
+    built from `pool_kwargs`
+
+    If `observe` is provided, it's called with how long each command took, like TimedRedis (a
+    pipeline is always "PIPELINE", since a cluster can't run transactions).
+
+    redis-py connects to a node while the client is created to discover the rest of the cluster,
+    and has no way to be told which pool to use, so the pools it discovered the cluster with are
+    swapped for metered ones afterwards.
+    """
+    def __init__(self, pool_kwargs: dict = None, observe=None, **kwargs):
+        self.pool_kwargs = pool_kwargs or {}
+        self.observe = observe
+        super().__init__(**kwargs)
+
+        nodes = self.nodes_manager
+        # Nodes that turn up later (after a failover or resharding) get metered pools too
+        nodes.create_redis_node = self._create_node
+        for node in nodes.nodes_cache.values():
+            discovered_with = node.redis_connection
+            node.redis_connection = self._create_node(
+                node.host, node.port, **nodes.connection_kwargs
+            )
+            if discovered_with is not None:
+                discovered_with.connection_pool.disconnect()
+
+    def execute_command(self, *args, **kwargs):
+        return self._timed(args[0], super().execute_command, *args, **kwargs)
+
+    def pipeline(self, transaction=None, shard_hint=None):
+        pipe = super().pipeline(transaction, shard_hint)
+        execute = pipe.execute
+        pipe.execute = lambda *args, **kwargs: self._timed("PIPELINE", execute, *args, **kwargs)
+        return pipe
+
+    def connection_pools(self) -> dict:
+        """
+        Return the connection pool to each node, by the node's name
+        """
+        return {
+            node.name: node.redis_connection.connection_pool
+            for node in self.get_nodes()
+            if node.redis_connection is not None
+        }
+
+    def _create_node(self, host: str, port: int, **kwargs) -> redis.StrictRedis:
+        kwargs.update(self.pool_kwargs)
+        return redis.StrictRedis(
+            connection_pool=MeteredConnectionPool(host=host, port=port, **kwargs)
+        )
+
+    def _timed(self, command: str, fn, *args, **kwargs):
+        if self.observe is None:
+            return fn(*args, **kwargs)
+        return _timed(self.observe, command, fn, *args, **kwargs)
+
+
+def _timed(observe, command: str, fn, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        observe(command, time.perf_counter() - started)
+
+
+def connect(
+    url: str,
+    decode_responses: bool = True,
+    max_connections: int = 50,
+    wait_secs: float = 5,
+    connect_timeout: float = None,
+    read_timeout: float = None,
+    health_check_secs: float = 0,
+    observe=None,
+) -> redis.StrictRedis:
+    """
+    Return a Redis client for the URL that keeps its connections in a MeteredConnectionPool
+
+    The URL can point to a TCP server (redis:// or rediss://) or a unix socket (unix://). Replies
+    are parsed with hiredis whenever it's installed. A connection that has sat idle for more than
+    `health_check_secs` is PINGed by redis-py before it's used again. If `observe` is provided,
+    the client is a TimedRedis that reports to it.
+    """
+    kwargs = {}
+    # redis-py only accepts a connect timeout for TCP connections
+    if urlparse(url).scheme != "unix":
+        kwargs["socket_connect_timeout"] = connect_timeout
+    pool = MeteredConnectionPool.from_url(
+        url,
+        decode_responses=decode_responses,
+        max_connections=max_connections,
+        timeout=wait_secs,
+        socket_timeout=read_timeout,
+        health_check_interval=health_check_secs,
+        **kwargs,
+    )
+    if observe is not None:
+        return TimedRedis(observe, connection_pool=pool)
+    return redis.StrictRedis(connection_pool=pool)
+
+
+def connect_cluster(
+    url: str,
+    decode_responses: bool = True,
+    max_connections: int = 50,
+    wait_secs: float = 5,
+    connect_timeout: float = None,
+    read_timeout: float = None,
+    health_check_secs: float = 0,
+    observe=None,
+) -> MeteredRedisCluster:
+    """
+    Return a client for the Redis Cluster that any node's URL belongs to, with the same pool for
+    each node that `connect` would give a single server
+
+    Unlike `connect`, this contacts the cluster straight away to find its nodes.
+    """
+    return MeteredRedisCluster.from_url(
+        url,
+        decode_responses=decode_responses,
+        socket_connect_timeout=connect_timeout,
+        socket_timeout=read_timeout,
+        pool_kwargs={
+            "max_connections": max_connections,
+            "timeout": wait_secs,
+            "health_check_interval": health_check_secs,
+        },
+        observe=observe,
+    )
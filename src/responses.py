@@ -0,0 +1,40 @@
+"""
+Responses that are always the same, serialized once up front instead of on every request
+"""
+import falcon
+
+from . import codec
+
+# The body ValidateUserResource returns for each (validated, cached) outcome
+VALIDATION_BODIES = {
+    (validated, cached): codec.dumps({"validated": validated, "cached": cached})
+    for validated in (True, False)
+    for cached in (True, False)
+}
+
+
+class ConstantError:
+    """
+    Mix into a falcon error whose title and description never change so that it's only ever
+    serialized once
+    """
+    _json = None
+
+    def to_json(self) -> str:
+        cls = type(self)
+        if cls._json is None:
+            cls._json = super().to_json()
+        return cls._json
+
+
+class HashMissing(ConstantError, falcon.HTTPBadRequest):
+    def __init__(self):
+        super().__init__(
+            "Hash Missing",
+            "A hash does not exist for this username. Run /generate_hash/ first",
+        )
+
+
+class JSONRequired(ConstantError, falcon.HTTPUnsupportedMediaType):
+    def __init__(self):
+        super().__init__("This API only supports JSON-encoded requests")
@@ -0,0 +1,35 @@
+"""
+Keep checking the profiles of users who've generated a hash until their hash turns up
+
+Requires AUTO_VERIFY=1 on the API servers so they queue users up as they generate hashes. Clients
+can then read each user's status from `GET /v1/validation_status/<username>`:
+
+    $> pipenv run scheduler
+"""
+import logging
+import signal
+import threading
+
+from . import server
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    if not server.AUTO_VERIFY:
+        logger.warning("AUTO_VERIFY isn't set, so users won't be queued up for checking")
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+
+    logger.info("Checking pending users' profiles from %s", server.auto_verifier.key)
+    try:
+        server.auto_verifier.run(stop)
+    except KeyboardInterrupt:
+        pass
+    logger.info("Stopped with %s", server.auto_verifier.stats.as_dict())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+
+from .stats import Counters
+
+
+class FlightStats(Counters):
+    """
+    How many calls did the work themselves versus shared another call's result
+    """
+    names = ("leaders", "followers")
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key into a single call whose result is shared
+
+    Only calls made within the same process are coalesced.
+    """
+    def __init__(self):
+        self.stats = FlightStats()
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key: str, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            self.stats.incr("followers")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        self.stats.incr("leaders")
+        try:
+            call.result = fn(*args)
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+
+class AsyncSingleFlight:
+    """
+    The same as SingleFlight, but for coroutine functions running on one event loop
+    """
+    def __init__(self):
+        self.stats = FlightStats()
+        self._calls = {}
+
+    async def do(self, key: str, fn, *args):
+        call = self._calls.get(key)
+        if call is not None:
+            self.stats.incr("followers")
+            return await asyncio.shield(call)
+
+        self.stats.incr("leaders")
+        call = self._calls[key] = asyncio.ensure_future(fn(*args))
+        try:
+            return await asyncio.shield(call)
+        finally:
+            if call.done():
+                del self._calls[key]
+            else:
+                # The leader was cancelled, but followers may still be waiting on the call
+                call.add_done_callback(lambda _: self._calls.pop(key, None))
+
+
+class RedisSingleFlight:
+    """
+    Coalesce calls that share a key across every worker and host using a Redis lock
+
+    Whoever takes the lock makes the call and publishes its result, under its lock token, for
+    everyone else to pick up. Followers only read the result of the leader whose lock they found,
+    so a result that's still around from an earlier flight is never mistaken for the current one.
+    If the leader fails, or takes longer than `wait_secs`, followers give up and make the call
+    themselves. Results must be JSON-serializable.
+    """
+    def __init__(
+        self,
+        get_redis,
+        lock_ms: int = 10000,
+        wait_secs: float = 10,
+        poll_secs: float = 0.05,
+        result_secs: int = 5,
+    ):
+        self.get_redis = get_redis
+        self.lock_ms = lock_ms
+        self.wait_secs = wait_secs
+        self.poll_secs = poll_secs
+        self.result_secs = result_secs
+        self.stats = FlightStats()
+
+    def do(self, key: str, fn, *args):
+        redis_db = self.get_redis()
+        lock_key = key + ":lock"
+        token = uuid.uuid4().hex
+
+        if redis_db.set(lock_key, token, px=self.lock_ms, nx=True):
+            self.stats.incr("leaders")
+            try:
+                result = fn(*args)
+                redis_db.setex(
+                    self._result_key(key, token),
+                    self.result_secs,
+                    json.dumps(result),
+                )
+                return result
+            finally:
+                self._release(redis_db, lock_key, token)
+
+        self.stats.incr("followers")
+        leader = redis_db.get(lock_key)
+        deadline = time.monotonic() + self.wait_secs
+        while leader is not None and time.monotonic() < deadline:
+            result = redis_db.get(self._result_key(key, leader))
+            if result is not None:
+                return json.loads(result)
+            # The leader gave up without publishing a result
+            if redis_db.get(lock_key) != leader:
+                break
+            time.sleep(self.poll_secs)
+
+        return fn(*args)
+
+    @staticmethod
+    def _result_key(key: str, token: str) -> str:
+        return "{}:flight:{}".format(key, token)
+
+    def _release(self, redis_db, lock_key: str, token: str):
+        """
+        Delete the lock, but only if it's still ours and hasn't expired and been taken by another
+        """
+        def release(pipe):
+            if pipe.get(lock_key) == token:
+                pipe.multi()
+                pipe.delete(lock_key)
+
+        redis_db.transaction(release, lock_key)
@@ -0,0 +1,34 @@
+import threading
+
+
+class Counters:
+    """
+    A thread-safe set of named counters
+    """
+    names = ()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        for name in self.names:
+            setattr(self, name, 0)
+
+    def incr(self, name: str, amount: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {name: getattr(self, name) for name in self.names}
+
+
+class CacheStats(Counters):
+    """
+    Hit and miss counts for a cache
+    """
+    names = ("hits", "misses")
+
+    def as_dict(self) -> dict:
+        stats = super().as_dict()
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
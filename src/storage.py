@@ -0,0 +1,450 @@
+import bisect
+import hashlib
+import heapq
+import random
+import threading
+import time
+import zlib
+
+from . import helpers
+from .stats import Counters
+
+
+class Storage:
+    """
+    Somewhere to keep hashes and cached validation results until they expire
+    """
+    def get(self, key: str) -> str:
+        raise NotImplementedError
+
+    def get_many(self, keys: list) -> list:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl_secs: int):
+        raise NotImplementedError
+
+    def add(self, key: str, value: str, ttl_secs: int) -> tuple:
+        """
+        Store the value unless the key already has one
+
+        Returns an (added, stored value) tuple.
+        """
+        raise NotImplementedError
+
+    def as_dict(self) -> dict:
+        """
+        Report statistics about the storage
+        """
+        return {}
+
+
+class StorageStats(Counters):
+    """
+    How many commands were sent to a Redis server, and how long they took
+    """
+    names = ("commands", "errors")
+
+    def __init__(self):
+        super().__init__()
+        self.total_secs = 0.0
+
+    def record(self, secs: float):
+        with self._lock:
+            self.commands += 1
+            self.total_secs += secs
+
+    def as_dict(self) -> dict:
+        stats = super().as_dict()
+        with self._lock:
+            stats["avg_latency_ms"] = (
+                round(self.total_secs / self.commands * 1000, 3) if self.commands else 0.0
+            )
+        return stats
+
+
+class RedisStorage(Storage):
+    """
+    Keep everything in Redis, shared by every worker on every host
+
+    Works with a single Redis server, or with a Redis Cluster client (pass `cluster=True`).
+    """
+    def __init__(self, get_redis, cluster: bool = False):
+        self.get_redis = get_redis
+        self.cluster = cluster
+        # Cluster pipelines can't be transactions, but SET NX still settles races on its own
+        self.transaction = not cluster
+        self.stats = StorageStats()
+
+    def get(self, key: str) -> str:
+        return self._timed(lambda redis_db: redis_db.get(key))
+
+    def get_many(self, keys: list) -> list:
+        if self.cluster:
+            # MGET only works on keys in the same slot, so it's sent to each slot separately
+            return self._timed(lambda redis_db: redis_db.mget_nonatomic(keys))
+        return self._timed(lambda redis_db: redis_db.mget(keys))
+
+    def set(self, key: str, value: str, ttl_secs: int):
+        self._timed(lambda redis_db: redis_db.setex(key, ttl_secs, value))
+
+    def add(self, key: str, value: str, ttl_secs: int) -> tuple:
+        # SET NX and GET are sent together in a single round trip. SET NX alone decides which
+        # concurrent request's value is stored, so GET always returns the winner's
+        def add(redis_db):
+            pipe = redis_db.pipeline(transaction=self.transaction)
+            pipe.set(key, value, ex=ttl_secs, nx=True)
+            pipe.get(key)
+            return pipe.execute()
+
+        added, stored = self._timed(add)
+        return bool(added), stored
+
+    def as_dict(self) -> dict:
+        stats = self.stats.as_dict()
+        try:
+            # A cluster client adds up the keys on every node
+            stats["keys"] = self.get_redis().dbsize()
+        except Exception:
+            stats["keys"] = None
+        return stats
+
+    def _timed(self, command):
+        started = time.perf_counter()
+        try:
+            return command(self.get_redis())
+        except Exception:
+            self.stats.incr("errors")
+            raise
+        finally:
+            self.stats.record(time.perf_counter() - started)
+
+
+class BucketedStorage(RedisStorage):
+    """
+    Pack keys into `buckets` Redis hashes, as fields that expire on their own
+
+    Each key is stored as a field of the same name, in a bucket picked by its hash tag (so keys
+    that share a tag share a bucket). A Redis hash with no more than `hash-max-listpack-entries`
+    (128 by default) small fields is stored as a compact listpack, which costs far less per field
+    than a key of its own, so aim for about 100 pending hashes per bucket.
+
+    Requires Redis 7.4 or later for per-field expiry (HEXPIRE).
+    """
+    def __init__(self, get_redis, buckets: int = 1024, cluster: bool = False):
+        super().__init__(get_redis, cluster=cluster)
+        self.buckets = buckets
+
+    def get(self, key: str) -> str:
+        return self.get_many([key])[0]
+
+    def get_many(self, keys: list) -> list:
+        def get_many(redis_db):
+            pipe = redis_db.pipeline(transaction=False)
+            for key in keys:
+                pipe.hget(*self.locate(key))
+            return pipe.execute()
+
+        return self._timed(get_many)
+
+    def set(self, key: str, value: str, ttl_secs: int):
+        def set(redis_db):
+            bucket, field = self.locate(key)
+            pipe = redis_db.pipeline(transaction=self.transaction)
+            pipe.hset(bucket, field, value)
+            self._expire(pipe, bucket, field, ttl_secs)
+            pipe.execute()
+
+        self._timed(set)
+
+    def add(self, key: str, value: str, ttl_secs: int) -> tuple:
+        def add(redis_db):
+            bucket, field = self.locate(key)
+            pipe = redis_db.pipeline(transaction=self.transaction)
+            pipe.hsetnx(bucket, field, value)
+            # NX leaves the expiry of a field that was already there alone
+            self._expire(pipe, bucket, field, ttl_secs, "NX")
+            pipe.hget(bucket, field)
+            added, _, stored = pipe.execute()
+            return added, stored
+
+        added, stored = self._timed(add)
+        return bool(added), stored
+
+    def locate(self, key: str) -> tuple:
+        """
+        Return the bucket the key is kept in, and its field in that bucket
+        """
+        # The field has to be the whole key: different keys can share a hash tag (like the keys of
+        # users named "ab" and "ab}cd")
+        bucket = zlib.crc32(helpers.get_hash_tag(key).encode("utf-8")) % self.buckets
+        # The bucket number is the bucket's own hash tag, so each bucket stays whole on one shard
+        return "{}:buckets:{{{}}}".format(helpers.KEY_PREFIX, bucket), key
+
+    @staticmethod
+    def _expire(pipe, bucket: str, field: str, ttl_secs: int, *flags):
+        # redis-py doesn't have a method for HEXPIRE yet
+        pipe.execute_command("HEXPIRE", bucket, ttl_secs, *flags, "FIELDS", 1, field)
+
+
+class HashRing:
+    """
+    Consistently map keys to one of several nodes, so that adding or removing a node only moves
+    the keys on its share of the ring
+
+    Each node is placed on the ring `replicas` times to even out the shares. Keys are placed by
+    their hash tag, so keys that share one always map to the same node.
+    """
+    def __init__(self, nodes: list, replicas: int = 128):
+        points = sorted(
+            (self._point("{}-{}".format(node, replica)), index)
+            for index, node in enumerate(nodes)
+            for replica in range(replicas)
+        )
+        self._points = [point for point, _ in points]
+        self._nodes = [index for _, index in points]
+
+    def get_node(self, key: str) -> int:
+        """
+        Return the index of the node the key belongs to
+        """
+        position = bisect.bisect(self._points, self._point(helpers.get_hash_tag(key)))
+        return self._nodes[position % len(self._nodes)]
+
+    @staticmethod
+    def _point(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class ShardedStorage(Storage):
+    """
+    Spread keys across several storages (usually RedisStorages for separate Redis servers) using
+    a consistent hash of each key's hash tag
+    """
+    def __init__(self, shards: dict):
+        self.names = list(shards)
+        self.shards = [shards[name] for name in self.names]
+        self.ring = HashRing(self.names)
+
+    def shard_for(self, key: str) -> Storage:
+        return self.shards[self.ring.get_node(key)]
+
+    def get(self, key: str) -> str:
+        return self.shard_for(key).get(key)
+
+    def get_many(self, keys: list) -> list:
+        # Look up each shard's keys in a single round trip
+        by_shard = {}
+        for position, key in enumerate(keys):
+            by_shard.setdefault(self.ring.get_node(key), []).append(position)
+
+        values = [None] * len(keys)
+        for node, positions in by_shard.items():
+            found = self.shards[node].get_many([keys[position] for position in positions])
+            for position, value in zip(positions, found):
+                values[position] = value
+        return values
+
+    def set(self, key: str, value: str, ttl_secs: int):
+        self.shard_for(key).set(key, value, ttl_secs)
+
+    def add(self, key: str, value: str, ttl_secs: int) -> tuple:
+        return self.shard_for(key).add(key, value, ttl_secs)
+
+    def as_dict(self) -> dict:
+        return {"shards": {name: shard.as_dict() for name, shard in zip(self.names, self.shards)}}
+
+
+class ReplicaStats(Counters):
+    """
+    Where reads were sent, and why some of them ended up on the primary
+    """
+    names = ("replica_reads", "primary_reads", "miss_retries", "failures")
+
+
+class _Replica:
+    __slots__ = ("name", "storage", "latency", "down_until")
+
+    def __init__(self, name: str, storage: Storage):
+        self.name = name
+        self.storage = storage
+        self.latency = 0.0
+        self.down_until = 0.0
+
+
+class ReplicatedStorage(Storage):
+    """
+    Send reads to replicas of the primary, and writes to the primary
+
+    Each read goes to the faster of two randomly picked healthy replicas, going by a moving average
+    of their latency. A replica that fails is left alone for `retry_secs`, and the read is retried
+    on the primary. Replicas lag behind the primary, so keys that `retry_miss(key)` says must be
+    fresh (like a hash that may have just been issued) are also retried on the primary when a
+    replica doesn't have them.
+    """
+    def __init__(
+        self,
+        primary: Storage,
+        replicas: dict,
+        retry_miss=lambda key: True,
+        retry_secs: float = 5,
+        smoothing: float = 0.2,
+        clock=time.monotonic,
+    ):
+        self.primary = primary
+        self.replicas = [_Replica(name, replica) for name, replica in replicas.items()]
+        self.retry_miss = retry_miss
+        self.retry_secs = retry_secs
+        self.smoothing = smoothing
+        self.clock = clock
+        self.stats = ReplicaStats()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str:
+        return self.get_many([key])[0]
+
+    def get_many(self, keys: list) -> list:
+        replica = self._pick()
+        if replica is None:
+            self.stats.incr("primary_reads")
+            return self.primary.get_many(keys)
+
+        started = self.clock()
+        try:
+            values = replica.storage.get_many(keys)
+        except Exception:
+            self.stats.incr("failures")
+            with self._lock:
+                replica.down_until = self.clock() + self.retry_secs
+            self.stats.incr("primary_reads")
+            return self.primary.get_many(keys)
+        self._record(replica, self.clock() - started)
+        self.stats.incr("replica_reads")
+
+        missing = [
+            position for position, (key, value) in enumerate(zip(keys, values))
+            if value is None and self.retry_miss(key)
+        ]
+        if missing:
+            self.stats.incr("miss_retries")
+            found = self.primary.get_many([keys[position] for position in missing])
+            for position, value in zip(missing, found):
+                values[position] = value
+        return values
+
+    def set(self, key: str, value: str, ttl_secs: int):
+        self.primary.set(key, value, ttl_secs)
+
+    def add(self, key: str, value: str, ttl_secs: int) -> tuple:
+        return self.primary.add(key, value, ttl_secs)
+
+    def as_dict(self) -> dict:
+        stats = self.stats.as_dict()
+        stats["primary"] = self.primary.as_dict()
+        now = self.clock()
+        stats["replicas"] = {}
+        for replica in self.replicas:
+            stats["replicas"][replica.name] = replica.storage.as_dict()
+            stats["replicas"][replica.name].update({
+                "healthy": replica.down_until <= now,
+                "latency_ms": round(replica.latency * 1000, 3),
+            })
+        return stats
+
+    def _pick(self) -> _Replica:
+        """
+        Return the faster of two healthy replicas, or None if none are healthy
+        """
+        now = self.clock()
+        healthy = [replica for replica in self.replicas if replica.down_until <= now]
+        if len(healthy) <= 1:
+            return healthy[0] if healthy else None
+        return min(random.sample(healthy, 2), key=lambda replica: replica.latency)
+
+    def _record(self, replica: _Replica, secs: float):
+        with self._lock:
+            if replica.latency:
+                replica.latency += self.smoothing * (secs - replica.latency)
+            else:
+                replica.latency = secs
+
+
+class _Entry:
+    __slots__ = ("value", "expires_at")
+
+    def __init__(self, value: str, expires_at: float):
+        self.value = value
+        self.expires_at = expires_at
+
+
+class MemoryStorage(Storage):
+    """
+    Keep everything in this process, for single-process deployments that don't need Redis
+
+    Expired keys are never returned. They're swept up without scanning every key: keys are filed
+    into buckets by the `resolution_secs`-long window they expire in, and a min-heap of bucket
+    numbers says which buckets are due. Each key only costs one list slot in its bucket on top of
+    its entry.
+    """
+    def __init__(self, resolution_secs: float = 1, clock=time.monotonic):
+        self.resolution_secs = resolution_secs
+        self.clock = clock
+        self._entries = {}
+        self._buckets = {}
+        self._due = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def as_dict(self) -> dict:
+        return {"keys": len(self)}
+
+    def get(self, key: str) -> str:
+        return self.get_many([key])[0]
+
+    def get_many(self, keys: list) -> list:
+        now = self.clock()
+        values = []
+        for key in keys:
+            entry = self._entries.get(key)
+            values.append(entry.value if entry is not None and entry.expires_at > now else None)
+        return values
+
+    def set(self, key: str, value: str, ttl_secs: int):
+        with self._lock:
+            now = self.clock()
+            self._sweep(now)
+            self._store(key, value, now + ttl_secs)
+
+    def add(self, key: str, value: str, ttl_secs: int) -> tuple:
+        with self._lock:
+            now = self.clock()
+            self._sweep(now)
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at > now:
+                return False, entry.value
+            self._store(key, value, now + ttl_secs)
+            return True, value
+
+    def _store(self, key: str, value: str, expires_at: float):
+        self._entries[key] = _Entry(value, expires_at)
+
+        # The bucket is due once the whole window it covers has passed
+        bucket = int(expires_at // self.resolution_secs) + 1
+        keys = self._buckets.get(bucket)
+        if keys is None:
+            keys = self._buckets[bucket] = []
+            heapq.heappush(self._due, bucket)
+        keys.append(key)
+
+    def _sweep(self, now: float):
+        """
+        Delete the keys in every bucket that's due
+        """
+        current = now // self.resolution_secs
+        while self._due and self._due[0] <= current:
+            for key in self._buckets.pop(heapq.heappop(self._due)):
+                entry = self._entries.get(key)
+                # The key may have been stored again since, with a later expiry
+                if entry is not None and entry.expires_at <= now:
+                    del self._entries[key]
@@ -732,8 +732,10 @@ class MockRedis(object):
         # Return the length of the list after the push operation
         return len(redis_list)
 
-    def lrem(self, key, value, count=0):
+    def lrem(self, key, count, value):
         """Emulate lrem."""
+        # Like redis-py 3.0+, take the count before the value, so that calls using the older
+        # (value, count) order fail here as they would against redis-py
         value = self._encode(value)
         redis_list = self._get_list(key, 'LREM')
         removed_count = 0
@@ -1100,27 +1102,16 @@ class MockRedis(object):
 
     # SORTED SET COMMANDS #
 
-    def zadd(self, name, *args, **kwargs):
-        zset = self._get_zset(name, "ZADD", create=True)
-
-        pieces = []
+    def zadd(self, name, mapping):
+        # Like redis-py 3.0+, only accept a {member: score} mapping, so that calls using the
+        # older (score, member) signature fail here as they would against redis-py
+        if not isinstance(mapping, dict):
+            raise RedisError("ZADD requires a {member: score} mapping")
 
-        # args
-        if len(args) % 2 != 0:
-            raise RedisError("ZADD requires an equal number of "
-                             "values and scores")
-        for i in xrange(len(args) // 2):
-            # interpretation of args order depends on whether Redis
-            # or StrictRedis is used
-            score = args[2 * i + (0 if self.strict else 1)]
-            member = args[2 * i + (1 if self.strict else 0)]
-            pieces.append((member, score))
-
-        # kwargs
-        pieces.extend(kwargs.items())
+        zset = self._get_zset(name, "ZADD", create=True)
 
         insert_count = lambda member, score: 1 if zset.insert(self._encode(member), float(score)) else 0  # noqa
-        return sum((insert_count(member, score) for member, score in pieces))
+        return sum((insert_count(member, score) for member, score in mapping.items()))
 
     def zcard(self, name):
         zset = self._get_zset(name, "ZCARD")
@@ -36,15 +36,7 @@ class Script(object):
         lua_globals.ARGV = self._python_to_lua(args)
 
         def _call(*call_args):
-            # redis-py and native redis commands are mostly compatible argument
-            # wise, but some exceptions need to be handled here:
-            if str(call_args[0]).lower() == 'lrem':
-                response = client.call(
-                    call_args[0], call_args[1],
-                    call_args[3],  # "count", default is 0
-                    call_args[2])
-            else:
-                response = client.call(*call_args)
+            response = client.call(*call_args)
             return self._python_to_lua(response)
 
         lua_globals.redis = {"call": _call}
@@ -1,6 +1,8 @@
-from collections import namedtuple
+import time
 
-from mockredis import mock_strict_redis_client
+import fakeredis
+import redis
+from mockredis import MockRedis, mock_strict_redis_client
 
 redis_db = mock_strict_redis_client(
     host="0.0.0.0",
@@ -8,6 +10,138 @@ redis_db = mock_strict_redis_client(
     db=0,
     decode_responses=True,
 )
+# mockredis can't run Lua, so anything that runs a script uses fakeredis instead. Its own client
+# classes can't read redis-py's signature on Python 3.6, so only its connections are used
+lua_redis_db = redis.StrictRedis(
+    connection_pool=redis.ConnectionPool(
+        connection_class=fakeredis.FakeConnection,
+        server=fakeredis.FakeServer(),
+        decode_responses=True,
+    ),
+)
+
+
+class FieldExpiryRedisMock(MockRedis):
+    """
+    A mock Redis client that also supports HEXPIRE (sent with execute_command()), which mockredis
+    doesn't
+    """
+    def __init__(self, clock=time.time, **kwargs):
+        super().__init__(strict=True, **kwargs)
+        self.field_clock = clock
+        self.field_expiries = {}
+
+    def execute_command(self, name: str, key: str, ttl_secs: int, *args):
+        assert name == "HEXPIRE"
+        nx = args[0] == "NX"
+        fields = args[args.index("FIELDS") + 2:]
+        self._expire_fields(key)
+        replies = []
+        for field in fields:
+            field = self._encode(field)
+            if field not in self.redis[self._encode(key)]:
+                replies.append(-2)
+            elif nx and (key, field) in self.field_expiries:
+                replies.append(0)
+            else:
+                self.field_expiries[(key, field)] = self.field_clock() + ttl_secs
+                replies.append(1)
+        return replies
+
+    def hget(self, hashkey, attribute):
+        self._expire_fields(hashkey)
+        return super().hget(hashkey, attribute)
+
+    def hsetnx(self, hashkey, attribute, value):
+        self._expire_fields(hashkey)
+        return super().hsetnx(hashkey, attribute, value)
+
+    def _expire_fields(self, key: str):
+        now = self.field_clock()
+        for (expiring_key, field), expires_at in list(self.field_expiries.items()):
+            if expiring_key == key and expires_at <= now:
+                del self.field_expiries[(expiring_key, field)]
+                super().hdel(key, field)
+
+
+class AsyncRedisMock:
+    """
+    Wrap a (mock) Redis client so that its commands can be awaited like redis.asyncio's
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+
+        async def wrapper(*args, **kwargs):
+            return command(*args, **kwargs)
+        return wrapper
+
+    def pipeline(self, transaction: bool = True):
+        return AsyncPipelineMock(self.client.pipeline(transaction))
+
+    def register_script(self, script: str):
+        script = self.client.register_script(script)
+
+        async def wrapper(**kwargs):
+            return script(**kwargs)
+        return wrapper
+
+
+class AsyncPipelineMock:
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    async def execute(self):
+        return self.pipe.execute()
+
+
+class PubSubMock:
+    """
+    Read the messages mockredis records as published to a channel, like a subscription would
+
+    Only messages published after subscribing are seen, and every subscriber sees all of them.
+    """
+    def __init__(self, client, channel: str):
+        self.client = client
+        self.channel = channel
+        self.position = len(client.pubsub[channel])
+        self.closed = False
+
+    def get_message(self, timeout: float = 0):
+        messages = self.client.pubsub[self.channel]
+        if self.position >= len(messages):
+            time.sleep(timeout)
+            return None
+        self.position += 1
+        return {"type": "message", "channel": self.channel, "data": messages[self.position - 1]}
+
+    def close(self):
+        self.closed = True
+
+
+class ProfileMock:
+    """
+    A simple mock we can populate with a textual representation of the user's profile HTML
+    """
+    def __init__(self, text: str, status_code: int = 200, headers: dict = None):
+        self.text = text
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    @property
+    def content(self) -> bytes:
+        return self.text.encode("utf-8")
+
+    def iter_content(self, chunk_size: int = 1):
+        content = self.content
+        for start in range(0, len(content), chunk_size):
+            yield content[start:start + chunk_size]
 
-# A simple mock we can populate with a textual representation of the user's profile HTML
-ProfileMock = namedtuple("ProfileMock", "text")
+    def close(self):
+        self.closed = True
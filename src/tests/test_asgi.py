@@ -0,0 +1,356 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import unittest
+from unittest.mock import ANY, patch
+
+import redis
+
+try:
+    import httpx
+    from src import asgi
+except ImportError:
+    asgi = None
+
+from src import helpers
+from src import server
+from src.credentials import CredentialPool
+from src.tests import mocks
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def simulate_request(app, method: str, path: str, body: bytes = b"", headers: dict = None):
+    """
+    Call an ASGI app and return its (status code, headers, JSON body)
+    """
+    headers = headers or {"Content-Type": "application/json"}
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "headers": [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in headers.items()
+        ],
+    }
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    run(app(scope, receive, send))
+
+    response_headers = {
+        name.decode("latin-1"): value.decode("latin-1")
+        for name, value in sent[0]["headers"]
+    }
+    return sent[0]["status"], response_headers, json.loads(sent[1]["body"].decode("utf-8"))
+
+
+@unittest.skipIf(asgi is None, "httpx and redis>=4.2 are required for the ASGI app")
+class AsgiTestCase(unittest.TestCase):
+    def setUp(self):
+        mocks.redis_db.flushdb()
+        self.profile = "hash_is_not_here"
+        self.status = 200
+        self.fetches = 0
+
+        def get_profile(request):
+            self.fetches += 1
+            return httpx.Response(self.status, content=self.profile.encode("utf-8"))
+
+        sa_client = asgi.AsyncProfileClient(
+            "http://sa/member.php?username=",
+            CredentialPool([{}]),
+            transport=httpx.MockTransport(get_profile),
+        )
+
+        for target, value in [
+            ("src.asgi.redis_db", mocks.AsyncRedisMock(mocks.redis_db)),
+            ("src.asgi.sa_client", sa_client),
+        ]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, path: str, payload: dict):
+        return simulate_request(asgi.app, "POST", path, json.dumps(payload).encode("utf-8"))
+
+    def test_require_json_requests(self):
+        status, _, body = simulate_request(
+            asgi.app,
+            "POST",
+            "/v1/generate_hash/",
+            headers={"Content-Type": "multipart/form-data"},
+        )
+        self.assertEqual(status, 415)
+        self.assertEqual(body["description"], "This API only supports JSON-encoded requests")
+
+    def test_returns_404_for_unknown_route(self):
+        status, _, _ = simulate_request(asgi.app, "GET", "/v1/nothing_here")
+        self.assertEqual(status, 404)
+
+    def test_returns_same_hash_for_same_username(self):
+        status, _, body1 = self.post("/v1/generate_hash/", {"username": "foobar"})
+        _, _, body2 = self.post("/v1/generate_hash/", {"username": "foobar"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body1["hash"], body2["hash"])
+        self.assertEqual(mocks.redis_db.get(helpers.get_hash_key("foobar")), body1["hash"])
+
+    @patch("src.server.AUTO_VERIFY", True)
+    def test_schedules_new_hashes_for_auto_verify(self):
+        self.post("/v1/generate_hash/", {"username": "foobar"})
+        status_key = helpers.get_status_key("foobar")
+        self.assertEqual(json.loads(mocks.redis_db.get(status_key))["status"], "pending")
+        self.assertIsNotNone(mocks.redis_db.zscore(server.auto_verifier.key, "foobar"))
+
+        # The user's existing hash is handed out again without starting over
+        mocks.redis_db.delete(status_key)
+        self.post("/v1/generate_hash/", {"username": "foobar"})
+        self.assertIsNone(mocks.redis_db.get(status_key))
+
+    @patch("src.server.hash_cache")
+    def test_invalidates_cached_hashes_when_issuing(self, hash_cache):
+        self.post("/v1/generate_hash/", {"username": "foobar"})
+        self.post("/v1/generate_hash/", {"username": "foobar"})
+        hash_cache.publish_invalidation.assert_called_once_with(
+            helpers.get_hash_key("foobar"),
+            ANY,
+        )
+
+    def test_require_username(self):
+        status, _, body = self.post("/v1/validate_user/", {})
+        self.assertEqual(status, 400)
+        self.assertEqual(body["title"], "Missing parameter")
+
+    def test_prompt_user_to_generate_hash_when_none_found(self):
+        status, _, body = self.post("/v1/validate_user/", {"username": "foobar"})
+        self.assertEqual(status, 400)
+        self.assertEqual(body["title"], "Hash Missing")
+
+    def test_validate_hash_is_in_user_profile(self):
+        _, _, body = self.post("/v1/generate_hash/", {"username": "foobar"})
+        self.profile = "<html>{}</html>".format(body["hash"])
+
+        status, _, body1 = self.post("/v1/validate_user/", {"username": "foobar"})
+        _, _, body2 = self.post("/v1/validate_user/", {"username": "foobar"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body1, {"validated": True, "cached": False})
+        self.assertEqual(body2, {"validated": True, "cached": True})
+        self.assertEqual(self.fetches, 1)
+
+    def test_validating_records_status(self):
+        _, _, body = self.post("/v1/generate_hash/", {"username": "foobar"})
+        self.profile = "<html>{}</html>".format(body["hash"])
+        status_key = helpers.get_status_key("foobar")
+        published = len(mocks.redis_db.pubsub[status_key])
+
+        self.post("/v1/validate_user/", {"username": "foobar"})
+
+        self.assertEqual(json.loads(mocks.redis_db.get(status_key))["status"], "validated")
+        self.assertEqual(len(mocks.redis_db.pubsub[status_key]), published + 1)
+
+    def test_validate_hash_is_not_in_user_profile(self):
+        self.post("/v1/generate_hash/", {"username": "foobar"})
+
+        status, _, body = self.post("/v1/validate_user/", {"username": "foobar"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body["validated"], False)
+
+    def test_ignores_logged_out_message_written_in_profile(self):
+        self.post("/v1/generate_hash/", {"username": "foobar"})
+        self.profile = "Sorry, you must be a registered forums member to view this page."
+
+        status, _, body = self.post("/v1/validate_user/", {"username": "foobar"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body["validated"], False)
+
+    def test_returns_502_on_error_pages(self):
+        self.post("/v1/generate_hash/", {"username": "foobar"})
+        self.profile = "Service Unavailable"
+        self.status = 503
+
+        status1, _, body = self.post("/v1/validate_user/", {"username": "foobar"})
+        status2, _, _ = self.post("/v1/validate_user/", {"username": "foobar"})
+
+        self.assertEqual(status1, 502)
+        self.assertEqual(body["title"], "Upstream Error")
+        # Nothing was cached, so the profile was fetched again
+        self.assertEqual(status2, 502)
+        self.assertEqual(self.fetches, 2)
+
+    def test_returns_500_on_unexpected_errors(self):
+        def get_count() -> float:
+            return server.metrics.REGISTRY.get_sample_value(
+                "goonauth_requests_total",
+                {"method": "POST", "route": "/v1/validate_user", "status": "500"},
+            ) or 0.0
+
+        before = get_count()
+        with patch.object(mocks.redis_db, "get", side_effect=redis.ConnectionError):
+            with self.assertLogs("src.asgi", "ERROR"):
+                status, _, body = self.post("/v1/validate_user/", {"username": "foobar"})
+
+        self.assertEqual(status, 500)
+        self.assertEqual(body["title"], "500 Internal Server Error")
+        # The response middleware still ran
+        self.assertEqual(get_count() - before, 1)
+
+    def test_closes_clients_on_shutdown(self):
+        closed = []
+
+        class ClientMock:
+            def __init__(self, name: str):
+                self.name = name
+
+            async def close(self, **kwargs):
+                closed.append((self.name, kwargs))
+
+        messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        with patch("src.asgi.sa_client", ClientMock("sa")), \
+                patch("src.asgi.redis_db", ClientMock("redis")):
+            run(asgi.app({"type": "lifespan"}, receive, send))
+
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+        self.assertEqual(closed, [("sa", {}), ("redis", {"close_connection_pool": True})])
+
+    def test_counts_requests_by_route_and_status(self):
+        def get_count(route: str, status: str) -> float:
+            return server.metrics.REGISTRY.get_sample_value(
+                "goonauth_requests_total",
+                {"method": "POST", "route": route, "status": status},
+            ) or 0.0
+
+        counts = [("/v1/generate_hash", "200"), ("/v1/validate_user", "400"), ("unrouted", "404")]
+        before = [get_count(route, status) for route, status in counts]
+
+        self.post("/v1/generate_hash/", {"username": "foobar"})
+        self.post("/v1/validate_user/", {})
+        self.post("/v1/nothing_here", {})
+
+        after = [get_count(route, status) for route, status in counts]
+        self.assertEqual([a - b for a, b in zip(after, before)], [1, 1, 1])
+
+    def test_times_profile_fetches_by_outcome(self):
+        def get_count(outcome: str) -> float:
+            return server.metrics.REGISTRY.get_sample_value(
+                "goonauth_sa_fetch_duration_seconds_count",
+                {"outcome": outcome},
+            ) or 0.0
+
+        outcomes = ["found", "not_found", "error"]
+        before = [get_count(outcome) for outcome in outcomes]
+
+        _, _, body = self.post("/v1/generate_hash/", {"username": "foo"})
+        self.profile = "<html>{}</html>".format(body["hash"])
+        self.post("/v1/validate_user/", {"username": "foo"})
+        self.post("/v1/generate_hash/", {"username": "bar"})
+        self.profile = "hash_is_not_here"
+        self.post("/v1/validate_user/", {"username": "bar"})
+        self.post("/v1/generate_hash/", {"username": "baz"})
+        self.status = 503
+        self.post("/v1/validate_user/", {"username": "baz"})
+
+        after = [get_count(outcome) for outcome in outcomes]
+        self.assertEqual([a - b for a, b in zip(after, before)], [1, 1, 1])
+
+    def test_rejects_oversized_bodies(self):
+        body = json.dumps({"username": "x" * 100}).encode("utf-8")
+        for headers in [
+            {"Content-Type": "application/json", "Content-Length": str(len(body))},
+            {"Content-Type": "application/json"},
+        ]:
+            with patch.object(asgi.app, "max_body_bytes", 50):
+                status, _, response = simulate_request(
+                    asgi.app,
+                    "POST",
+                    "/v1/generate_hash/",
+                    body,
+                    headers,
+                )
+
+            self.assertEqual(status, 413)
+            self.assertEqual(response["title"], "Request Body Too Large")
+
+
+@unittest.skipIf(asgi is None, "httpx and redis>=4.2 are required for the ASGI app")
+class AsyncProfileClientTestCase(unittest.TestCase):
+    def test_does_not_keep_cookies_set_by_sa(self):
+        cookies_seen = []
+
+        def get_profile(request):
+            cookies_seen.append(request.headers.get("Cookie"))
+            return httpx.Response(
+                200,
+                content=b"hash_is_not_here",
+                headers={"Set-Cookie": "sessionhash=abc123; Path=/"},
+            )
+
+        sa_client = asgi.AsyncProfileClient(
+            "http://sa/member.php?username=",
+            CredentialPool([{"sessionid": "1"}, {"sessionid": "2"}]),
+            transport=httpx.MockTransport(get_profile),
+        )
+        run(sa_client.profile_contains("foobar", ["abc123"]))
+        run(sa_client.profile_contains("foobar", ["abc123"]))
+
+        self.assertEqual(cookies_seen, ["sessionid=1", "sessionid=2"])
+
+
+@unittest.skipIf(asgi is None, "httpx and redis>=4.2 are required for the ASGI app")
+class AsgiSettingsTestCase(unittest.TestCase):
+    def start(self, **settings) -> str:
+        """
+        Import the ASGI app in a fresh process with extra settings, and return what it printed
+        """
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        result = subprocess.run(
+            [sys.executable, "-c", "import src.asgi"],
+            env=dict(os.environ, **settings),
+            cwd=root,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        return result.stderr
+
+    def test_refuses_storage_it_cannot_share(self):
+        for settings, error in [
+            ({"HASH_FORMAT": "binary"}, "HASH_FORMAT"),
+            ({"STORAGE_BACKEND": "memory"}, "STORAGE_BACKEND"),
+            ({"REDIS_REPLICA_URLS": "redis://replica:6379"}, "REDIS_REPLICA_URLS"),
+        ]:
+            stderr = self.start(**settings)
+            self.assertIn("RuntimeError", stderr)
+            self.assertIn(error, stderr)
+
+    def test_refuses_sharing_fetches_across_processes(self):
+        stderr = self.start(COALESCE_MODE="redis")
+        self.assertIn("RuntimeError", stderr)
+        self.assertIn("COALESCE_MODE", stderr)
+
+    def test_starts_with_default_settings(self):
+        self.assertEqual(self.start(), "")
@@ -0,0 +1,197 @@
+import json
+import threading
+import unittest
+from unittest.mock import patch
+
+import redis
+import requests
+
+from src import autoverify
+from src import helpers
+from src.autoverify import AutoVerifier
+from src.ratelimit import RateLimiter
+from src.tests import mocks
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class AutoVerifierTestCase(unittest.TestCase):
+    def setUp(self):
+        mocks.redis_db.flushdb()
+        self.clock = FakeClock()
+        self.hashes = {"foobar": ["abc123"]}
+        self.found = False
+        self.checks = 0
+
+    def lookup_hashes(self, usernames):
+        return {username: self.hashes.get(username, []) for username in usernames}
+
+    def check_profile(self, username, user_hashes):
+        self.checks += 1
+        if isinstance(self.found, Exception):
+            raise self.found
+        return self.found, False
+
+    def make_verifier(self, max_secs: float = 20, **kwargs) -> AutoVerifier:
+        return AutoVerifier(
+            lambda: mocks.redis_db,
+            "pending",
+            self.lookup_hashes,
+            self.check_profile,
+            300,
+            base_secs=5,
+            max_secs=max_secs,
+            clock=self.clock,
+            **kwargs
+        )
+
+    def next_check(self):
+        return mocks.redis_db.zscore("pending", "foobar")
+
+    def test_waits_until_first_check_is_due(self):
+        verifier = self.make_verifier()
+        verifier.schedule("foobar")
+
+        self.assertEqual(verifier.run_once(), 0)
+        self.assertEqual(verifier.get_status("foobar")["status"], "pending")
+        self.assertEqual(self.next_check(), 1005)
+
+    def test_records_validation(self):
+        verifier = self.make_verifier()
+        verifier.schedule("foobar")
+        self.found = True
+
+        self.clock.now += 5
+        verifier.run_once()
+
+        status = verifier.get_status("foobar")
+        self.assertEqual(status["status"], "validated")
+        self.assertEqual(status["attempts"], 1)
+        self.assertIsNone(self.next_check())
+
+    def test_backs_off_exponentially(self):
+        verifier = self.make_verifier()
+        verifier.schedule("foobar")
+
+        delays = []
+        for _ in range(4):
+            self.clock.now = self.next_check()
+            verifier.run_once()
+            delays.append(self.next_check() - self.clock.now)
+
+        self.assertEqual(delays, [10, 20, 20, 20])
+        self.assertEqual(verifier.get_status("foobar")["attempts"], 4)
+
+    def test_retries_after_upstream_errors(self):
+        verifier = self.make_verifier()
+        verifier.schedule("foobar")
+        self.found = requests.ConnectionError()
+
+        self.clock.now += 5
+        verifier.run_once()
+
+        self.assertEqual(verifier.get_status("foobar")["status"], "pending")
+        self.assertEqual(self.next_check(), self.clock.now + 10)
+        self.assertEqual(verifier.stats.as_dict()["errors"], 1)
+
+    def test_puts_user_back_after_redis_errors(self):
+        verifier = self.make_verifier()
+        verifier.schedule("foobar")
+        self.found = redis.ConnectionError("Connection reset by peer")
+
+        self.clock.now += 5
+        with self.assertLogs(autoverify.logger, "ERROR"):
+            verifier.run_once()
+
+        self.assertEqual(self.next_check(), self.clock.now + 5)
+        self.assertEqual(verifier.stats.as_dict()["errors"], 1)
+
+    def test_keeps_running_after_redis_errors(self):
+        verifier = self.make_verifier()
+        stop = threading.Event()
+        calls = []
+
+        def run_once():
+            calls.append(None)
+            if len(calls) == 1:
+                raise redis.ConnectionError("Connection refused")
+            stop.set()
+            return 0
+
+        with patch.object(verifier, "run_once", side_effect=run_once):
+            with self.assertLogs(autoverify.logger, "ERROR"):
+                verifier.run(stop, poll_secs=0)
+
+        self.assertEqual(len(calls), 2)
+
+    def test_expires_with_hash(self):
+        verifier = self.make_verifier()
+        verifier.schedule("foobar")
+
+        self.clock.now += 5
+        verifier.run_once()
+        del self.hashes["foobar"]
+        self.clock.now = self.next_check()
+        verifier.run_once()
+
+        self.assertEqual(verifier.get_status("foobar")["status"], "expired")
+        self.assertEqual(self.checks, 1)
+        self.assertIsNone(self.next_check())
+
+    def test_never_checks_past_lifespan(self):
+        verifier = self.make_verifier()
+        verifier.schedule("foobar")
+
+        self.clock.now = 1295
+        verifier.run_once()
+        self.assertEqual(self.next_check(), 1300)
+
+        self.clock.now = 1300
+        verifier.run_once()
+        # Recorded as expired, not just read as expired
+        stored = json.loads(mocks.redis_db.get(helpers.get_status_key("foobar")))
+        self.assertEqual(stored["status"], "expired")
+
+    def test_tracks_users_without_checking_them(self):
+        verifier = self.make_verifier()
+        verifier.track("foobar")
+
+        self.assertIsNone(self.next_check())
+        self.assertEqual(verifier.get_status("foobar")["status"], "pending")
+
+        self.clock.now += 300
+        self.assertEqual(verifier.get_status("foobar")["status"], "expired")
+
+    def test_checks_again_before_hash_expires(self):
+        verifier = self.make_verifier(max_secs=60)
+        verifier.schedule("foobar")
+
+        # The hash only turns up after the check backing off would otherwise have made last
+        while self.next_check() is not None:
+            self.clock.now = self.next_check()
+            self.found = self.clock.now > 1255
+            verifier.run_once()
+
+        self.assertEqual(verifier.get_status("foobar")["status"], "validated")
+        self.assertEqual(self.clock.now, 1295)
+
+    def test_defers_checks_over_budget(self):
+        mocks.lua_redis_db.flushdb()
+        limiter = RateLimiter(lambda: mocks.lua_redis_db, "budget", 1, period_secs=60)
+        verifier = self.make_verifier(limiter=limiter)
+        verifier.schedule("foobar")
+        self.hashes["barfoo"] = ["def456"]
+        verifier.schedule("barfoo")
+
+        self.clock.now += 5
+        verifier.run_once()
+
+        self.assertEqual(self.checks, 1)
+        self.assertEqual(verifier.stats.as_dict()["deferred"], 1)
+        self.assertEqual(mocks.redis_db.zcard("pending"), 2)
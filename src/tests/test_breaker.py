@@ -0,0 +1,102 @@
+import unittest
+from unittest.mock import MagicMock
+
+from src.breaker import CircuitBreaker, CircuitOpenError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(
+            failure_threshold=2,
+            recovery_secs=30,
+            failure_exceptions=(IOError,),
+            clock=self.clock,
+        )
+        self.failing = MagicMock(side_effect=IOError)
+        self.working = MagicMock(return_value="ok")
+
+    def trip(self):
+        for _ in range(2):
+            with self.assertRaises(IOError):
+                self.breaker.call(self.failing)
+
+    def test_passes_calls_through_when_closed(self):
+        self.assertEqual(self.breaker.call(self.working), "ok")
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_opens_after_consecutive_failures(self):
+        self.trip()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        self.clock.now = 10
+        with self.assertRaises(CircuitOpenError) as ctx:
+            self.breaker.call(self.working)
+        self.assertEqual(ctx.exception.retry_after, 20)
+        self.working.assert_not_called()
+
+    def test_success_resets_failure_count(self):
+        with self.assertRaises(IOError):
+            self.breaker.call(self.failing)
+        self.breaker.call(self.working)
+        with self.assertRaises(IOError):
+            self.breaker.call(self.failing)
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_ignores_other_exceptions(self):
+        for _ in range(3):
+            with self.assertRaises(KeyError):
+                self.breaker.call(MagicMock(side_effect=KeyError))
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_closes_after_successful_trial_call(self):
+        self.trip()
+        self.clock.now = 30
+
+        self.assertEqual(self.breaker.call(self.working), "ok")
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_reopens_after_failed_trial_call(self):
+        self.trip()
+        self.clock.now = 30
+
+        with self.assertRaises(IOError):
+            self.breaker.call(self.failing)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        self.clock.now = 59
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.call(self.working)
+
+    def test_limits_trial_calls_while_half_open(self):
+        self.trip()
+        self.clock.now = 30
+
+        def call_again():
+            with self.assertRaises(CircuitOpenError):
+                self.breaker.call(self.working)
+            return "ok"
+
+        self.assertEqual(self.breaker.call(call_again), "ok")
+
+    def test_reports_state_changes(self):
+        self.trip()
+        self.clock.now = 30
+        self.breaker.call(self.working)
+
+        stats = self.breaker.as_dict()
+        self.assertEqual(stats["state"], CircuitBreaker.CLOSED)
+        self.assertEqual(stats["trips"], 1)
+        self.assertEqual(stats["to_open"], 1)
+        self.assertEqual(stats["to_half_open"], 1)
+        self.assertEqual(stats["to_closed"], 1)
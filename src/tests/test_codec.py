@@ -0,0 +1,19 @@
+import json
+import unittest
+
+from src import codec
+
+
+class CodecTestCase(unittest.TestCase):
+    def test_dumps_returns_bytes(self):
+        returned = codec.dumps({"validated": True, "cached": False})
+        self.assertEqual(type(returned), bytes)
+        self.assertDictEqual(json.loads(returned), {"validated": True, "cached": False})
+
+    def test_loads_bytes_and_str(self):
+        self.assertDictEqual(codec.loads(b'{"username": "foo"}'), {"username": "foo"})
+        self.assertDictEqual(codec.loads('{"username": "foo"}'), {"username": "foo"})
+
+    def test_round_trips_unicode(self):
+        payload = {"username": "föö \U0001f600"}
+        self.assertDictEqual(codec.loads(codec.dumps(payload)), payload)
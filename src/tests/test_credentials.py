@@ -0,0 +1,92 @@
+import json
+import tempfile
+import unittest
+
+from src.credentials import CredentialPool, NoCredentialsAvailable, load_cookie_sets
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class LoadCookieSetsTestCase(unittest.TestCase):
+    def test_loads_numbered_environment_variables(self):
+        environ = {
+            "COOKIE_SESSIONID_1": "a",
+            "COOKIE_BBUSERID_1": "1",
+            "COOKIE_SESSIONID_2": "b",
+            "COOKIE_BBUSERID_2": "2",
+        }
+        cookie_sets = load_cookie_sets(environ)
+
+        self.assertEqual(len(cookie_sets), 2)
+        self.assertEqual(cookie_sets[1]["sessionid"], "b")
+        self.assertEqual(cookie_sets[1]["bbuserid"], "2")
+
+    def test_loads_json_file(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as cookie_file:
+            json.dump([{"sessionid": "a"}, {"sessionid": "b"}], cookie_file)
+            cookie_file.flush()
+
+            cookie_sets = load_cookie_sets({}, cookie_file.name)
+
+        self.assertEqual(cookie_sets, [{"sessionid": "a"}, {"sessionid": "b"}])
+
+    def test_returns_empty_list_without_sets(self):
+        self.assertEqual(load_cookie_sets({"COOKIE_SESSIONID": "a"}), [])
+
+
+class CredentialPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make_pool(self, **kwargs) -> CredentialPool:
+        cookie_sets = [{"bbuserid": "1"}, {"bbuserid": "2"}, {"bbuserid": "3"}]
+        return CredentialPool(cookie_sets, recheck_secs=60, clock=self.clock, **kwargs)
+
+    def test_rotates_round_robin(self):
+        pool = self.make_pool()
+        names = [pool.acquire().name for _ in range(4)]
+        self.assertEqual(names, ["1", "2", "3", "1"])
+
+    def test_rotates_least_recently_used(self):
+        pool = self.make_pool(strategy="lru")
+        for now in range(3):
+            self.clock.now = now
+            pool.acquire()
+
+        self.clock.now = 3
+        self.assertEqual(pool.acquire().name, "1")
+
+    def test_skips_logged_out_credentials_until_recheck(self):
+        pool = self.make_pool()
+        pool.report_logged_out(pool.acquire())
+
+        names = [pool.acquire().name for _ in range(3)]
+        self.assertEqual(names, ["2", "3", "2"])
+
+        self.clock.now = 60
+        self.assertIn("1", [pool.acquire().name for _ in range(3)])
+
+    def test_raises_when_every_credential_is_logged_out(self):
+        pool = self.make_pool()
+        for _ in range(3):
+            pool.report_logged_out(pool.acquire())
+
+        with self.assertRaises(NoCredentialsAvailable):
+            pool.acquire()
+
+    def test_reports_per_credential_stats(self):
+        pool = self.make_pool()
+        credential = pool.acquire()
+        pool.report_error(credential)
+
+        stats = pool.as_dict()["1"]
+        self.assertEqual(stats["requests"], 1)
+        self.assertEqual(stats["errors"], 1)
+        self.assertEqual(stats["error_rate"], 1.0)
+        self.assertTrue(stats["healthy"])
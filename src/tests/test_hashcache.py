@@ -0,0 +1,130 @@
+import threading
+import time
+import unittest
+
+import redis
+
+from src.hashcache import HashCache
+from src.tests import mocks
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class HashCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        mocks.redis_db.flushdb()
+        mocks.redis_db.pubsub.clear()
+        self.clock = FakeClock()
+
+    def make_cache(self, pubsub_class=mocks.PubSubMock, **kwargs) -> HashCache:
+        cache = HashCache(
+            lambda: mocks.redis_db,
+            lambda channel: pubsub_class(mocks.redis_db, channel),
+            self.id(),
+            poll_secs=0.01,
+            clock=self.clock,
+            **kwargs
+        )
+        cache.get_many([])
+        self.wait_for(lambda: cache.listening)
+        return cache
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 2
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_serves_repeat_lookups_from_memory(self):
+        cache = self.make_cache()
+        mocks.redis_db.setex("foobar", 300, "abc123")
+
+        self.assertEqual(
+            cache.get_many(["foobar", "nobody"]),
+            {"foobar": "abc123", "nobody": None},
+        )
+        mocks.redis_db.delete("foobar")
+        self.assertEqual(cache.get_many(["foobar"]), {"foobar": "abc123"})
+
+        stats = cache.stats.as_dict()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+        self.assertEqual(len(cache), 1)
+
+    def test_never_outlives_redis_ttl(self):
+        cache = self.make_cache(max_ttl_secs=60)
+        mocks.redis_db.setex("foobar", 10, "abc123")
+        cache.get_many(["foobar"])
+
+        mocks.redis_db.delete("foobar")
+        self.clock.now += 10
+        self.assertEqual(cache.get_many(["foobar"]), {"foobar": None})
+        self.assertEqual(cache.stats.as_dict()["expirations"], 1)
+
+    def test_caps_ttl(self):
+        cache = self.make_cache(max_ttl_secs=5)
+        mocks.redis_db.setex("foobar", 300, "abc123")
+        cache.get_many(["foobar"])
+
+        mocks.redis_db.setex("foobar", 300, "def456")
+        self.clock.now += 5
+        self.assertEqual(cache.get_many(["foobar"]), {"foobar": "def456"})
+
+    def test_evicts_least_recently_used(self):
+        cache = self.make_cache(max_entries=2)
+        for username in ("foo", "bar", "baz"):
+            mocks.redis_db.setex(username, 300, username + "_hash")
+        cache.get_many(["foo", "bar"])
+        cache.get_many(["foo"])
+        cache.get_many(["baz"])
+
+        self.assertEqual(cache.stats.as_dict()["evictions"], 1)
+        mocks.redis_db.delete("bar")
+        self.assertEqual(cache.get_many(["foo", "bar"]), {"foo": "foo_hash", "bar": None})
+
+    def test_invalidates_published_usernames(self):
+        cache = self.make_cache()
+        mocks.redis_db.setex("foobar", 300, "abc123")
+        cache.get_many(["foobar"])
+
+        mocks.redis_db.setex("foobar", 300, "def456")
+        cache.publish_invalidation("foobar")
+        self.wait_for(lambda: cache.stats.as_dict()["invalidations"] == 1)
+
+        self.assertEqual(cache.get_many(["foobar"]), {"foobar": "def456"})
+        self.assertGreaterEqual(cache.stats.as_dict()["invalidation_lag_secs"]["max"], 0)
+
+    def test_empties_on_unreadable_invalidation(self):
+        cache = self.make_cache()
+        mocks.redis_db.setex("foobar", 300, "abc123")
+        cache.get_many(["foobar"])
+
+        mocks.redis_db.publish(self.id(), "not json")
+        self.wait_for(lambda: len(cache) == 0)
+        self.assertTrue(cache.listening)
+
+    def test_empties_and_stops_caching_when_subscription_drops(self):
+        dropped = threading.Event()
+
+        class DroppingPubSub(mocks.PubSubMock):
+            def get_message(self, timeout: float = 0):
+                if dropped.is_set():
+                    raise redis.ConnectionError("Connection lost")
+                return super().get_message(timeout)
+
+        cache = self.make_cache(DroppingPubSub, retry_secs=60)
+        mocks.redis_db.setex("foobar", 300, "abc123")
+        cache.get_many(["foobar"])
+
+        with self.assertLogs("src.hashcache"):
+            dropped.set()
+            self.wait_for(lambda: not cache.listening)
+
+        self.assertEqual(len(cache), 0)
+        cache.get_many(["foobar"])
+        self.assertEqual(len(cache), 0)
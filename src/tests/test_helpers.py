@@ -2,11 +2,29 @@ import unittest
 import re
 import json
 from unittest.mock import MagicMock
-from io import StringIO
+from io import BytesIO, StringIO
 
 import falcon
 
-from src.helpers import get_hash, get_json, get_username
+from src.helpers import (
+    HTTPPayloadTooLarge,
+    KEY_PREFIX,
+    get_channel,
+    get_hash,
+    get_hash_key,
+    get_hash_tag,
+    get_json,
+    get_queue_key,
+    get_rate_limit_key,
+    get_redis_url,
+    get_result_key,
+    get_shard_name,
+    get_time_bucket,
+    get_token,
+    get_username,
+    get_usernames,
+    render_token,
+)
 
 
 class GetHashTestCase(unittest.TestCase):
@@ -23,6 +41,86 @@ class GetHashTestCase(unittest.TestCase):
         regex_alpha_num = re.compile("^[a-zA-Z0-9]*$")
         self.assertTrue(regex_alpha_num.match(returned) is not None)
 
+    def test_derived_hash_is_stable(self):
+        returned1 = get_hash("foobar", "secret", 1)
+        returned2 = get_hash("FooBar", "secret", 1)
+        self.assertEqual(returned1, returned2)
+        self.assertEqual(len(returned1), 32)
+
+    def test_derived_hash_changes_with_bucket_and_secret(self):
+        returned = get_hash("foobar", "secret", 1)
+        self.assertNotEqual(returned, get_hash("foobar", "secret", 2))
+        self.assertNotEqual(returned, get_hash("foobar", "other_secret", 1))
+
+
+class GetTokenTestCase(unittest.TestCase):
+    def test_returns_sixteen_bytes(self):
+        self.assertEqual(len(get_token()), 16)
+        self.assertNotEqual(get_token(), get_token())
+
+    def test_renders_as_hash(self):
+        self.assertEqual(render_token(bytes(range(16))), "000102030405060708090a0b0c0d0e0f")
+        self.assertRegex(render_token(get_token()), "^[a-f0-9]{32}$")
+
+
+class GetHashTagTestCase(unittest.TestCase):
+    def test_user_keys_share_hash_tag(self):
+        self.assertEqual(get_hash_tag(get_hash_key("foobar")), "foobar")
+        self.assertEqual(get_hash_tag(get_result_key("foobar", "abc123")), "foobar")
+
+    def test_follows_redis_cluster_rules(self):
+        self.assertEqual(get_hash_tag("foo{bar}{baz}"), "bar")
+        self.assertEqual(get_hash_tag("foo{}{bar}"), "foo{}{bar}")
+        self.assertEqual(get_hash_tag("foo{bar"), "foo{bar")
+        self.assertEqual(get_hash_tag("foobar"), "foobar")
+
+
+class SharedKeysTestCase(unittest.TestCase):
+    def test_shared_keys_are_namespaced(self):
+        for key in [get_rate_limit_key("sa"), get_queue_key("validations"), get_channel("foo")]:
+            self.assertTrue(key.startswith(KEY_PREFIX + ":"))
+
+        self.assertEqual(get_rate_limit_key("sa"), "goonauth:rate_limit:sa")
+
+
+class GetShardNameTestCase(unittest.TestCase):
+    def test_leaves_out_password(self):
+        self.assertEqual(get_shard_name("redis://:secret@redis-1:6380/2"), "redis-1:6380/2")
+        self.assertEqual(get_shard_name("redis://localhost"), "localhost:6379")
+
+    def test_names_unix_socket_by_path(self):
+        self.assertEqual(get_shard_name("unix:///run/redis.sock?db=1"), "/run/redis.sock")
+
+
+class GetRedisUrlTestCase(unittest.TestCase):
+    def test_defaults_to_db_zero(self):
+        self.assertEqual(get_redis_url("redis://localhost:6379"), "redis://localhost:6379/0")
+        self.assertEqual(get_redis_url("redis://localhost:6379/"), "redis://localhost:6379/0")
+
+    def test_keeps_chosen_db(self):
+        self.assertEqual(get_redis_url("redis://localhost:6379/2"), "redis://localhost:6379/2")
+
+    def test_keeps_unix_socket_url(self):
+        self.assertEqual(get_redis_url("unix:///run/redis.sock"), "unix:///run/redis.sock")
+
+    def test_defaults_empty_url_to_local_server(self):
+        self.assertEqual(get_redis_url(""), "redis://localhost:6379/0")
+
+    def test_picks_requested_db(self):
+        self.assertEqual(get_redis_url("", db=15), "redis://localhost:6379/15")
+        self.assertEqual(get_redis_url("redis://redis:6379/2", db=15), "redis://redis:6379/15")
+        self.assertEqual(
+            get_redis_url("unix:///run/redis.sock?db=2&timeout=1", db=15),
+            "unix:///run/redis.sock?timeout=1&db=15",
+        )
+
+
+class GetTimeBucketTestCase(unittest.TestCase):
+    def test_returns_bucket_number(self):
+        self.assertEqual(get_time_bucket(300, now=0), 0)
+        self.assertEqual(get_time_bucket(300, now=299.9), 0)
+        self.assertEqual(get_time_bucket(300, now=300), 1)
+
 
 class GetJsonTestCase(unittest.TestCase):
     req = MagicMock(spec=falcon.Request)
@@ -56,6 +154,46 @@ class GetJsonTestCase(unittest.TestCase):
             get_json(self.req)
 
 
+class GetJsonFromBytesTestCase(unittest.TestCase):
+    def make_req(self, body: bytes):
+        req = MagicMock(spec=falcon.Request)
+        req.stream.read = MagicMock(return_value=body)
+        return req
+
+    def test_parses_bytes(self):
+        returned = get_json(self.make_req(b'{"username": "f\xc3\xb6\xc3\xb6"}'))
+        self.assertDictEqual({"username": "f\u00f6\u00f6"}, returned)
+
+    def test_rejects_declared_length_over_limit_without_reading(self):
+        req = self.make_req(b'{"username": "foobar"}')
+        req.content_length = 1024 * 1024
+        with self.assertRaises(HTTPPayloadTooLarge):
+            get_json(req, max_bytes=1024)
+        req.stream.read.assert_not_called()
+
+    def test_stops_reading_undeclared_length_over_limit(self):
+        req = MagicMock(spec=falcon.Request)
+        req.content_length = None
+        req.stream = BytesIO(b"[" + b"1, " * 1024 * 1024 + b"1]")
+        with self.assertRaises(HTTPPayloadTooLarge):
+            get_json(req, max_bytes=1024)
+        self.assertEqual(req.stream.tell(), 1025)
+
+    def test_reads_body_within_limit(self):
+        req = MagicMock(spec=falcon.Request)
+        req.content_length = None
+        req.stream = BytesIO(b'{"username": "foobar"}')
+        self.assertDictEqual(get_json(req, max_bytes=22), {"username": "foobar"})
+
+    def test_error_messages_match_stdlib(self):
+        for body in [b"", b"{", b'{"foo": }', b"[1, 2"]:
+            with self.assertRaises(json.JSONDecodeError) as expected:
+                json.loads(body.decode("utf-8"))
+            with self.assertRaises(falcon.HTTPBadRequest) as ctx:
+                get_json(self.make_req(body))
+            self.assertEqual(ctx.exception.description, str(expected.exception))
+
+
 class GetUsernameTestCase(unittest.TestCase):
     def test_returns_str(self):
         returned = get_username({"username": "foobar"})
@@ -78,3 +216,25 @@ class GetUsernameTestCase(unittest.TestCase):
             expected_exception=falcon.HTTPInvalidParam,
         ):
             get_username({"username": ""})
+
+
+class GetUsernamesTestCase(unittest.TestCase):
+    def test_returns_usernames_with_encoded_spaces(self):
+        returned = get_usernames({"usernames": ["foo bar", "baz"]}, 10)
+        self.assertEqual(returned, ["foo%20bar", "baz"])
+
+    def test_raises_400_on_missing_usernames(self):
+        with self.assertRaises(falcon.HTTPMissingParam):
+            get_usernames({}, 10)
+
+    def test_raises_400_on_empty_list(self):
+        with self.assertRaises(falcon.HTTPInvalidParam):
+            get_usernames({"usernames": []}, 10)
+
+    def test_raises_400_on_too_many_usernames(self):
+        with self.assertRaises(falcon.HTTPInvalidParam):
+            get_usernames({"usernames": ["foo", "bar", "baz"]}, 2)
+
+    def test_raises_400_on_non_string_username(self):
+        with self.assertRaises(falcon.HTTPInvalidParam):
+            get_usernames({"usernames": ["foo", 123]}, 10)
@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from src import metrics
+
+# Counts one request the way a gunicorn worker would, in its own process
+WORKER_SCRIPT = """
+from src import metrics
+metrics.requests_total.labels("GET", "/v1/stats", "200").inc()
+"""
+
+
+class RenderTestCase(unittest.TestCase):
+    def test_adds_up_every_process(self):
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=directory)
+            root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            for _ in range(2):
+                subprocess.run(
+                    [sys.executable, "-c", WORKER_SCRIPT],
+                    env=env,
+                    cwd=root,
+                    check=True,
+                )
+
+            with patch.dict(os.environ, {"PROMETHEUS_MULTIPROC_DIR": directory}):
+                content_type, body = metrics.render()
+
+        self.assertTrue(content_type.startswith("text/plain"))
+        self.assertIn(
+            'goonauth_requests_total{method="GET",route="/v1/stats",status="200"} 2.0',
+            body.decode("utf-8"),
+        )
@@ -0,0 +1,61 @@
+import asyncio
+import time
+import unittest
+from unittest.mock import patch
+
+from src.ratelimit import RateLimited, RateLimiter
+from src.tests import mocks
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        mocks.lua_redis_db.flushdb()
+
+    def make_limiter(self, **kwargs) -> RateLimiter:
+        return RateLimiter(lambda: mocks.lua_redis_db, "limit", 10, **kwargs)
+
+    def test_allows_requests_within_limit(self):
+        limiter = self.make_limiter(burst=2)
+        self.assertEqual(limiter.try_acquire(), 0)
+        self.assertEqual(limiter.try_acquire(), 0)
+        self.assertGreater(limiter.try_acquire(), 0)
+
+    def test_shares_bucket_between_limiters(self):
+        self.make_limiter().acquire()
+        with self.assertRaises(RateLimited) as ctx:
+            self.make_limiter().acquire()
+        self.assertLessEqual(ctx.exception.retry_after, 0.1)
+
+    def test_expires_bucket(self):
+        self.make_limiter().acquire()
+        self.assertLessEqual(mocks.lua_redis_db.pttl("limit"), 100)
+
+    # Only the limiter's sleeps, not every thread's
+    @patch("src.ratelimit.time", wraps=time)
+    def test_waits_for_its_turn(self, mock_time):
+        limiter = self.make_limiter(max_wait_secs=1)
+        limiter.acquire()
+
+        # Pretend the wait has passed by emptying the bucket
+        mock_time.sleep.side_effect = lambda secs: mocks.lua_redis_db.delete("limit")
+        limiter.acquire()
+
+        mock_time.sleep.assert_called_once()
+        self.assertEqual(limiter.stats.as_dict(), {"allowed": 1, "delayed": 1, "rejected": 0})
+
+    def test_acquires_asynchronously(self):
+        limiter = self.make_limiter()
+        redis_db = mocks.AsyncRedisMock(mocks.lua_redis_db)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(limiter.acquire_async(redis_db))
+            with self.assertRaises(RateLimited):
+                # The synchronous and asynchronous paths share the same bucket
+                limiter.acquire()
+            with self.assertRaises(RateLimited):
+                loop.run_until_complete(limiter.acquire_async(redis_db))
+        finally:
+            loop.close()
+
+        self.assertEqual(limiter.stats.as_dict(), {"allowed": 1, "delayed": 0, "rejected": 2})
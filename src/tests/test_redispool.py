@@ -0,0 +1,197 @@
+import socketserver
+import threading
+import unittest
+
+import redis
+from redis.crc import key_slot
+
+from src.redispool import MeteredConnectionPool, connect, connect_cluster
+from src.storage import RedisStorage
+
+
+class PongHandler(socketserver.StreamRequestHandler):
+    """
+    Reply PONG to every command, like a Redis server that only knows PING
+    """
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            # Skip the rest of the command's arguments
+            for _ in range(int(line[1:]) * 2):
+                self.rfile.readline()
+            self.wfile.write(b"+PONG\r\n")
+
+
+class ClusterNodeHandler(socketserver.StreamRequestHandler):
+    """
+    Act as the only node of a Redis Cluster that knows GET, SET and MGET, and refuses an MGET of
+    keys in different slots like a real one
+    """
+    # The commands' arity, flags and key positions, as COMMAND describes them
+    commands = (
+        (b"get", 2, 1, 1),
+        (b"set", -3, 1, 1),
+        (b"mget", -2, 1, -1),
+    )
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            self.wfile.write(self.reply(args[0].upper(), args[1:]))
+
+    def reply(self, command: bytes, args: list) -> bytes:
+        values = self.server.values
+        if command == b"INFO":
+            return self.bulk(b"cluster_enabled:1\r\n")
+        if command == b"CLUSTER":
+            host, port = self.server.server_address
+            return b"*1\r\n*3\r\n:0\r\n:16383\r\n*2\r\n" + self.bulk(
+                host.encode()
+            ) + ":{}\r\n".format(port).encode()
+        if command == b"COMMAND":
+            return "*{}\r\n".format(len(self.commands)).encode() + b"".join(
+                b"*6\r\n" + self.bulk(name) + ":{}\r\n*0\r\n:{}\r\n:{}\r\n:1\r\n".format(
+                    arity, first, last
+                ).encode()
+                for name, arity, first, last in self.commands
+            )
+        if command == b"SET":
+            values[args[0]] = args[1]
+            return b"+OK\r\n"
+        if command == b"GET":
+            return self.bulk(values.get(args[0]))
+        if command == b"MGET":
+            if len({key_slot(key) for key in args}) > 1:
+                return b"-CROSSSLOT Keys in request don't hash to the same slot\r\n"
+            return "*{}\r\n".format(len(args)).encode() + b"".join(
+                self.bulk(values.get(key)) for key in args
+            )
+        return b"+PONG\r\n"
+
+    @staticmethod
+    def bulk(value: bytes) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        return "${}\r\n".format(len(value)).encode() + value + b"\r\n"
+
+
+class FakeServerTestCase(unittest.TestCase):
+    """
+    Serve `handler` on a local port for each test, at `self.url`
+    """
+    handler = PongHandler
+
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), self.handler)
+        self.server.daemon_threads = True
+        threading.Thread(
+            target=self.server.serve_forever,
+            kwargs={"poll_interval": 0.01},
+            daemon=True,
+        ).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = "redis://127.0.0.1:{}".format(self.server.server_address[1])
+
+
+class ConnectTestCase(FakeServerTestCase):
+    def test_reports_pool_usage(self):
+        client = connect(self.url, max_connections=2)
+        pool = client.connection_pool
+        self.assertEqual(client.ping(), True)
+
+        connection = pool.get_connection("PING")
+        stats = pool.as_dict()
+        self.assertEqual((stats["open"], stats["in_use"], stats["max_connections"]), (1, 1, 2))
+        pool.release(connection)
+        stats = pool.as_dict()
+        self.assertEqual((stats["checkouts"], stats["in_use"]), (2, 0))
+
+    def test_times_out_waiting_for_free_connection(self):
+        pool = connect(self.url, max_connections=1, wait_secs=0.05).connection_pool
+        connection = pool.get_connection("PING")
+        with self.assertRaises(redis.ConnectionError):
+            pool.get_connection("PING")
+        pool.release(connection)
+
+        stats = pool.as_dict()
+        self.assertEqual((stats["checkouts"], stats["waits"], stats["timeouts"]), (1, 0, 1))
+
+    def test_checks_idle_connections(self):
+        client = connect(self.url, health_check_secs=60)
+        client.ping()
+        connection = client.connection_pool.get_connection("PING")
+        self.assertEqual(connection.health_check_interval, 60)
+        client.connection_pool.release(connection)
+
+    def test_starts_afresh_after_fork(self):
+        client = connect(self.url)
+        pool = client.connection_pool
+        client.ping()
+        inherited = pool.get_connection("PING")
+        pool.release(inherited)
+
+        # Pretend we're a forked child
+        pool.pid = -1
+        connection = pool.get_connection("PING")
+        self.assertIsNot(connection, inherited)
+        # The parent's socket was left alone
+        self.assertIsNotNone(inherited._sock)
+        pool.release(connection)
+
+    def test_times_commands_and_pipelines(self):
+        timings = []
+        client = connect(self.url, observe=lambda command, secs: timings.append(command))
+        client.ping()
+        pipe = client.pipeline(transaction=False)
+        pipe.ping()
+        pipe.ping()
+        pipe.execute()
+        self.assertEqual(timings, ["PING", "PIPELINE"])
+
+
+class ConnectClusterTestCase(FakeServerTestCase):
+    handler = ClusterNodeHandler
+
+    def setUp(self):
+        super().setUp()
+        self.server.values = {}
+
+    def test_uses_metered_pool_for_each_node(self):
+        client = connect_cluster(self.url, max_connections=2, wait_secs=0.05)
+        client.set("foo", "bar")
+        pools = client.connection_pools()
+        self.assertEqual(list(pools), ["127.0.0.1:{}".format(self.server.server_address[1])])
+        pool = next(iter(pools.values()))
+        self.assertIsInstance(pool, MeteredConnectionPool)
+        stats = pool.as_dict()
+        self.assertEqual((stats["max_connections"], stats["checkouts"]), (2, 1))
+        self.assertEqual(pool.timeout, 0.05)
+
+    def test_times_commands_and_pipelines(self):
+        timings = []
+        client = connect_cluster(self.url, observe=lambda command, secs: timings.append(command))
+        del timings[:]
+        client.get("foo")
+        pipe = client.pipeline()
+        pipe.get("foo")
+        pipe.get("bar")
+        pipe.execute()
+        self.assertEqual(timings, ["GET", "PIPELINE"])
+
+    def test_storage_gets_keys_from_different_slots(self):
+        client = connect_cluster(self.url)
+        client.set("foo", "1")
+        client.set("bar", "2")
+        self.assertNotEqual(key_slot(b"foo"), key_slot(b"bar"))
+
+        storage = RedisStorage(lambda: client, cluster=True)
+        self.assertEqual(storage.get_many(["foo", "baz", "bar"]), ["1", None, "2"])
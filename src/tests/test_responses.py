@@ -0,0 +1,39 @@
+import json
+import unittest
+
+import falcon
+
+from src.responses import VALIDATION_BODIES, HashMissing, JSONRequired
+
+
+class ValidationBodiesTestCase(unittest.TestCase):
+    def test_covers_every_outcome(self):
+        for validated in (True, False):
+            for cached in (True, False):
+                self.assertEqual(
+                    json.loads(VALIDATION_BODIES[validated, cached]),
+                    {"validated": validated, "cached": cached},
+                )
+
+
+class ConstantErrorTestCase(unittest.TestCase):
+    def test_serializes_like_falcon(self):
+        self.assertEqual(
+            HashMissing().to_json(),
+            falcon.HTTPBadRequest(
+                "Hash Missing",
+                "A hash does not exist for this username. Run /generate_hash/ first",
+            ).to_json(),
+        )
+        self.assertEqual(
+            JSONRequired().to_json(),
+            falcon.HTTPUnsupportedMediaType(
+                "This API only supports JSON-encoded requests"
+            ).to_json(),
+        )
+
+    def test_serializes_once(self):
+        self.assertIs(HashMissing().to_json(), HashMissing().to_json())
+
+    def test_errors_are_cached_separately(self):
+        self.assertNotEqual(HashMissing().to_json(), JSONRequired().to_json())
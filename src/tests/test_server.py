@@ -1,12 +1,25 @@
 import json
-from unittest.mock import patch
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
 
 from falcon import testing
 import requests
 
 from src.tests import mocks
 
+from src import helpers
 from src import server
+from src import worker
+from src.breaker import CircuitBreaker
+from src.hashcache import HashCache
+from src.ratelimit import RateLimiter
+from src.responses import HashMissing
+from src.storage import BucketedStorage, MemoryStorage, RedisStorage
 
 req_params = {
     "headers": {
@@ -82,6 +95,37 @@ class GenerateHashTestCase(ServerTestCase):
 
         self.assertEqual(resp1.json["hash"], resp2.json["hash"])
 
+    def test_concurrent_requests_get_same_hash(self):
+        mocks.redis_db.flushdb()
+        barrier = threading.Barrier(8)
+        hashes = []
+
+        def generate():
+            barrier.wait()
+            hashes.append(server.issue_hash("foobar"))
+
+        threads = [threading.Thread(target=generate) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(hashes)), 1)
+        self.assertEqual(mocks.redis_db.get(helpers.get_hash_key("foobar")), hashes[0])
+
+    def test_hash_expires_after_lifespan(self):
+        mocks.redis_db.flushdb()
+        self.simulate_post(
+            self.url,
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        self.assertAlmostEqual(
+            mocks.redis_db.ttl(helpers.get_hash_key("foobar")),
+            server.HASH_LIFESPAN_MINS * 60,
+            delta=1,
+        )
+
 
 @patch("src.server.redis_db", mocks.redis_db)
 class ValidateUserResourceTestCase(ServerTestCase):
@@ -100,6 +144,16 @@ class ValidateUserResourceTestCase(ServerTestCase):
         self.assertEqual(resp.json["title"], "Missing parameter")
         self.assertEqual(resp.json["description"], "The \"username\" parameter is required.")
 
+    @patch("src.server.MAX_BODY_BYTES", 64)
+    def test_rejects_oversized_body(self):
+        resp = self.simulate_post(
+            self.url,
+            body=json.dumps({"username": "x" * 64}),
+            **req_params,
+        )
+        self.assertEqual(resp.status_code, 413)
+        self.assertEqual(resp.json["title"], "Request Body Too Large")
+
     def test_prompt_user_to_generate_hash_when_none_found(self):
         resp = self.simulate_post(
             self.url,
@@ -158,3 +212,820 @@ class ValidateUserResourceTestCase(ServerTestCase):
 
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.json["validated"], False)
+
+    @patch.object(requests.Session, "get")
+    def test_caches_successful_validation(self, mock_get):
+        username = "foobar"
+        resp1 = self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": username}),
+            **req_params,
+        )
+        mock_get.return_value = mocks.ProfileMock(text=resp1.json["hash"])
+
+        resp2 = self.simulate_post(self.url, body=json.dumps({"username": username}), **req_params)
+        resp3 = self.simulate_post(self.url, body=json.dumps({"username": username}), **req_params)
+
+        self.assertEqual(resp2.json, {"validated": True, "cached": False})
+        self.assertEqual(resp3.json, {"validated": True, "cached": True})
+        self.assertEqual(mock_get.call_count, 1)
+
+        result_key = helpers.get_result_key(username, resp1.json["hash"])
+        self.assertAlmostEqual(
+            mocks.redis_db.ttl(result_key),
+            server.RESULT_CACHE_POSITIVE_SECS,
+            delta=1,
+        )
+
+    @patch.object(requests.Session, "get")
+    def test_caches_failed_validation_briefly(self, mock_get):
+        username = "foobar"
+        resp1 = self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": username}),
+            **req_params,
+        )
+        mock_get.return_value = mocks.ProfileMock(text="hash_is_not_here")
+
+        self.simulate_post(self.url, body=json.dumps({"username": username}), **req_params)
+        resp = self.simulate_post(self.url, body=json.dumps({"username": username}), **req_params)
+
+        self.assertEqual(resp.json, {"validated": False, "cached": True})
+        result_key = helpers.get_result_key(username, resp1.json["hash"])
+        self.assertAlmostEqual(
+            mocks.redis_db.ttl(result_key),
+            server.RESULT_CACHE_NEGATIVE_SECS,
+            delta=1,
+        )
+
+    @patch("src.server.COALESCE_MODE", "redis")
+    @patch.object(requests.Session, "get")
+    def test_validates_with_cross_worker_coalescing(self, mock_get):
+        username = "foobar"
+        resp1 = self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": username}),
+            **req_params,
+        )
+        mock_get.return_value = mocks.ProfileMock(text=resp1.json["hash"])
+
+        resp2 = self.simulate_post(self.url, body=json.dumps({"username": username}), **req_params)
+
+        self.assertEqual(resp2.json["validated"], True)
+        self.assertEqual(mock_get.call_count, 1)
+
+    @patch.object(requests.Session, "get")
+    def test_returns_502_on_upstream_error(self, mock_get):
+        self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        mock_get.side_effect = requests.Timeout
+
+        resp = self.simulate_post(self.url, body=json.dumps({"username": "foobar"}), **req_params)
+
+        self.assertEqual(resp.status_code, 502)
+        self.assertEqual(resp.json["title"], "Upstream Error")
+
+    @patch.object(requests.Session, "get")
+    def test_returns_503_while_breaker_is_open(self, mock_get):
+        self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        mock_get.side_effect = requests.ConnectionError
+
+        breaker = CircuitBreaker(
+            failure_threshold=1,
+            recovery_secs=30,
+            failure_exceptions=(requests.RequestException,),
+        )
+        with patch("src.server.sa_breaker", breaker):
+            resp1 = self.simulate_post(
+                self.url,
+                body=json.dumps({"username": "foobar"}),
+                **req_params,
+            )
+            resp2 = self.simulate_post(
+                self.url,
+                body=json.dumps({"username": "foobar"}),
+                **req_params,
+            )
+
+        self.assertEqual(resp1.status_code, 502)
+        self.assertEqual(resp2.status_code, 503)
+        self.assertEqual(resp2.json["title"], "Upstream Unavailable")
+        self.assertEqual(resp2.headers["Retry-After"], "30")
+        self.assertEqual(mock_get.call_count, 1)
+
+    @patch.object(requests.Session, "get")
+    def test_counts_error_pages_as_upstream_failures(self, mock_get):
+        resp1 = self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        mock_get.return_value = mocks.ProfileMock(text="Service Unavailable", status_code=503)
+
+        breaker = CircuitBreaker(
+            failure_threshold=1,
+            recovery_secs=30,
+            failure_exceptions=(requests.RequestException,),
+        )
+        with patch("src.server.sa_breaker", breaker):
+            resp2 = self.simulate_post(
+                self.url,
+                body=json.dumps({"username": "foobar"}),
+                **req_params,
+            )
+
+        self.assertEqual(resp2.status_code, 502)
+        self.assertEqual(breaker.state, "open")
+        result_key = helpers.get_result_key("foobar", resp1.json["hash"])
+        self.assertIsNone(mocks.redis_db.get(result_key))
+
+    @patch("src.server.RESULT_CACHE_NEGATIVE_SECS", 0)
+    @patch.object(requests.Session, "get")
+    def test_returns_503_when_rate_limited(self, mock_get):
+        self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        mock_get.return_value = mocks.ProfileMock(text="hash_is_not_here")
+
+        mocks.lua_redis_db.flushdb()
+        limiter = RateLimiter(lambda: mocks.lua_redis_db, helpers.get_rate_limit_key("sa"), 1, 60)
+        with patch("src.server.sa_limiter", limiter):
+            resp1 = self.simulate_post(
+                self.url,
+                body=json.dumps({"username": "foobar"}),
+                **req_params,
+            )
+            resp2 = self.simulate_post(
+                self.url,
+                body=json.dumps({"username": "foobar"}),
+                **req_params,
+            )
+
+        self.assertEqual(resp1.status_code, 200)
+        self.assertEqual(resp2.status_code, 503)
+        self.assertEqual(resp2.json["title"], "Upstream Busy")
+        self.assertIn("Retry-After", resp2.headers)
+        self.assertEqual(mock_get.call_count, 1)
+
+    @patch("src.server.RESULT_CACHE_POSITIVE_SECS", 0)
+    @patch("src.server.RESULT_CACHE_NEGATIVE_SECS", 0)
+    @patch.object(requests.Session, "get")
+    def test_skips_cache_when_disabled(self, mock_get):
+        username = "foobar"
+        self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": username}),
+            **req_params,
+        )
+        mock_get.return_value = mocks.ProfileMock(text="hash_is_not_here")
+
+        self.simulate_post(self.url, body=json.dumps({"username": username}), **req_params)
+        resp = self.simulate_post(self.url, body=json.dumps({"username": username}), **req_params)
+
+        self.assertEqual(resp.json["cached"], False)
+        self.assertEqual(mock_get.call_count, 2)
+
+
+@patch("src.server.redis_db", mocks.redis_db)
+@patch("src.server.STATELESS_HASHES", True)
+@patch("src.server.HASH_SECRET", "secret")
+class StatelessHashTestCase(ServerTestCase):
+    def setUp(self):
+        super(StatelessHashTestCase, self).setUp()
+        mocks.redis_db.flushdb()
+
+    def test_generate_hash_does_not_store_hash(self):
+        resp = self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["hash"], server.get_stateless_hash("foobar"))
+        # Only the user's status is kept
+        self.assertEqual(mocks.redis_db.keys(), [helpers.get_status_key("foobar")])
+
+    @patch.object(requests.Session, "get")
+    def test_validates_hash_from_previous_bucket(self, mock_get):
+        # The user's hash was issued just before the current time bucket started
+        mock_get.return_value = mocks.ProfileMock(text=server.get_stateless_hash("foobar", 1))
+
+        resp = self.simulate_post(
+            "/v1/validate_user/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["validated"], True)
+
+    @patch.object(requests.Session, "get")
+    def test_rejects_expired_hash(self, mock_get):
+        mock_get.return_value = mocks.ProfileMock(text=server.get_stateless_hash("foobar", 2))
+
+        resp = self.simulate_post(
+            "/v1/validate_user/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        self.assertEqual(resp.json["validated"], False)
+
+
+@patch("src.server.redis_db", mocks.redis_db)
+class ValidateUsersResourceTestCase(ServerTestCase):
+    def setUp(self):
+        super(ValidateUsersResourceTestCase, self).setUp()
+        self.url = "/v1/validate_users/"
+        mocks.redis_db.flushdb()
+
+    def generate_hash(self, username):
+        resp = self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": username}),
+            **req_params,
+        )
+        return resp.json["hash"]
+
+    def test_require_usernames(self):
+        resp = self.simulate_post(
+            self.url,
+            body=json.dumps({}),
+            **req_params,
+        )
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json["title"], "Missing parameter")
+
+    @patch.object(requests.Session, "get")
+    def test_returns_result_per_user(self, mock_get):
+        hashes = {
+            "foo": self.generate_hash("foo"),
+            "bar": self.generate_hash("bar"),
+        }
+
+        # Only "foo" has put their hash in their profile
+        def get_profile(url, **kwargs):
+            if url.endswith("foo"):
+                return mocks.ProfileMock(text=hashes["foo"])
+            return mocks.ProfileMock(text="hash_is_not_here")
+        mock_get.side_effect = get_profile
+
+        resp = self.simulate_post(
+            self.url,
+            body=json.dumps({"usernames": ["foo", "bar", "baz"]}),
+            **req_params,
+        )
+
+        self.assertEqual(resp.status_code, 200)
+        results = resp.json["results"]
+        self.assertEqual(results[0], {"username": "foo", "validated": True, "cached": False})
+        self.assertEqual(results[1], {"username": "bar", "validated": False, "cached": False})
+        self.assertEqual(results[2]["username"], "baz")
+        self.assertEqual(
+            results[2]["error"],
+            {"title": HashMissing().title, "description": HashMissing().description},
+        )
+
+    @patch.object(requests.Session, "get")
+    def test_reports_upstream_errors_per_user(self, mock_get):
+        self.generate_hash("foo")
+        mock_get.side_effect = requests.ConnectionError
+
+        resp = self.simulate_post(
+            self.url,
+            body=json.dumps({"usernames": ["foo"]}),
+            **req_params,
+        )
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["results"][0]["error"]["title"], "Upstream Error")
+
+
+@patch("src.server.redis_db", mocks.redis_db)
+class ValidationJobTestCase(ServerTestCase):
+    def setUp(self):
+        super(ValidationJobTestCase, self).setUp()
+        mocks.redis_db.flushdb()
+
+    def submit(self, username):
+        return self.simulate_post(
+            "/v1/validate_user/",
+            query_string="async=1",
+            body=json.dumps({"username": username}),
+            **req_params,
+        )
+
+    def test_async_validation_returns_pending_job(self):
+        self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+
+        resp = self.submit("foobar")
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json["status"], "pending")
+        self.assertEqual(resp.headers["location"], "/v1/validations/" + resp.json["job_id"])
+        self.assertEqual(mocks.redis_db.lrange(server.JOB_QUEUE, 0, -1), [resp.json["job_id"]])
+
+        resp2 = self.simulate_get("/v1/validations/" + resp.json["job_id"])
+        self.assertEqual(resp2.status_code, 200)
+        self.assertEqual(resp2.json["status"], "pending")
+
+    def test_async_validation_requires_hash(self):
+        resp = self.submit("foobar")
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json["title"], "Hash Missing")
+
+    def test_unknown_job_returns_404(self):
+        resp = self.simulate_get("/v1/validations/nope")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.json["title"], "Job Not Found")
+
+    @patch("src.server.JOB_POLL_SECS", 0.01)
+    @patch.object(requests.Session, "get")
+    def test_long_poll_waits_for_result(self, mock_get):
+        resp1 = self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        mock_get.return_value = mocks.ProfileMock(text=resp1.json["hash"])
+        job_id = self.submit("foobar").json["job_id"]
+
+        # A worker picks up the job while we're waiting
+        timer = threading.Timer(0.1, worker.process_job, args=(job_id,))
+        timer.start()
+        resp = self.simulate_get("/v1/validations/" + job_id, query_string="wait=5")
+        timer.join()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["status"], "done")
+        self.assertEqual(resp.json["validated"], True)
+
+
+@patch("src.server.redis_db", mocks.redis_db)
+class ValidationStatusTestCase(ServerTestCase):
+    def setUp(self):
+        super(ValidationStatusTestCase, self).setUp()
+        mocks.redis_db.flushdb()
+
+    @patch("src.server.AUTO_VERIFY", True)
+    def test_generating_hash_schedules_auto_verification(self):
+        self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foo bar"}),
+            **req_params,
+        )
+
+        self.assertEqual(mocks.redis_db.zcard(server.auto_verifier.key), 1)
+        resp = self.simulate_get("/v1/validation_status/foo bar")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["username"], "foo%20bar")
+        self.assertEqual(resp.json["status"], "pending")
+        self.assertEqual(resp.json["attempts"], 0)
+
+    @patch.object(requests.Session, "get")
+    def test_validating_user_records_status(self, mock_get):
+        resp1 = self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        mock_get.return_value = mocks.ProfileMock(text=resp1.json["hash"])
+        status_key = helpers.get_status_key("foobar")
+        mocks.redis_db.pubsub.clear()
+
+        for _ in range(2):
+            self.simulate_post(
+                "/v1/validate_user/",
+                body=json.dumps({"username": "foobar"}),
+                **req_params,
+            )
+
+        resp2 = self.simulate_get("/v1/validation_status/foobar")
+        self.assertEqual(resp2.status_code, 200)
+        self.assertEqual(resp2.json["status"], "validated")
+        self.assertEqual(resp2.json["attempts"], 0)
+        # Only the change was published
+        published = [json.loads(message) for message in mocks.redis_db.pubsub[status_key]]
+        self.assertEqual([status["status"] for status in published], ["validated"])
+
+    @patch("src.server.AUTO_VERIFY", True)
+    @patch.object(requests.Session, "get")
+    def test_validating_user_stops_auto_verification(self, mock_get):
+        resp1 = self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        mock_get.return_value = mocks.ProfileMock(text=resp1.json["hash"])
+
+        self.simulate_post(
+            "/v1/validate_user/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+
+        status = server.auto_verifier.get_status("foobar")
+        self.assertEqual(status["status"], "validated")
+        self.assertIsNotNone(status["expires_at"])
+        self.assertEqual(mocks.redis_db.zcard(server.auto_verifier.key), 0)
+
+    @patch("src.server.AUTO_VERIFY", True)
+    def test_generating_same_hash_keeps_auto_verification_going(self):
+        self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        # The scheduler has already checked the user once
+        status = server.auto_verifier.get_status("foobar")
+        status["attempts"] = 1
+        mocks.redis_db.set(helpers.get_status_key("foobar"), json.dumps(status))
+        next_check = mocks.redis_db.zscore(server.auto_verifier.key, "foobar")
+
+        self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+
+        self.assertEqual(server.auto_verifier.get_status("foobar")["attempts"], 1)
+        self.assertEqual(mocks.redis_db.zscore(server.auto_verifier.key, "foobar"), next_check)
+
+    def test_generating_hash_records_pending_status(self):
+        self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+
+        # Without AUTO_VERIFY the user is only tracked, not checked
+        self.assertEqual(mocks.redis_db.zcard(server.auto_verifier.key), 0)
+        resp = self.simulate_get("/v1/validation_status/foobar")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["status"], "pending")
+
+    def test_untracked_hash_reads_as_expired(self):
+        server.auto_verifier.track("foobar")
+        expires_at = server.auto_verifier.get_status("foobar")["expires_at"]
+
+        with patch.object(server.auto_verifier, "clock", return_value=expires_at):
+            resp = self.simulate_get("/v1/validation_status/foobar")
+        self.assertEqual(resp.json["status"], "expired")
+
+    def test_unknown_username_returns_404(self):
+        resp = self.simulate_get("/v1/validation_status/foobar")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.json["title"], "Status Not Found")
+
+
+@patch("src.server.redis_db", mocks.redis_db)
+@patch("src.server.subscribe", lambda channel: mocks.PubSubMock(mocks.redis_db, channel))
+class ValidationEventsTestCase(ServerTestCase):
+    def setUp(self):
+        super(ValidationEventsTestCase, self).setUp()
+        mocks.redis_db.flushdb()
+        self.url = "/v1/validation_events/foobar"
+
+    def parse_events(self, body):
+        return [
+            json.loads(event.split("data: ", 1)[1])
+            for event in body.split("\n\n")
+            if event.startswith("event: status")
+        ]
+
+    def test_unknown_username_returns_404(self):
+        resp = self.simulate_get(self.url)
+        self.assertEqual(resp.status_code, 404)
+
+    @patch("src.server.EVENTS_KEEPALIVE_SECS", 0.01)
+    def test_streams_status_changes_until_final(self):
+        server.auto_verifier.schedule("foobar")
+        mocks.redis_db.pubsub.clear()
+        mocks.redis_db.set(helpers.get_hash_key("foobar"), "abc123")
+        mocks.redis_db.zadd(server.auto_verifier.key, {"foobar": 0})
+
+        # The scheduler finds the user's hash while they're listening
+        check_profile = patch.object(
+            server.auto_verifier,
+            "check_profile",
+            return_value=(True, False),
+        )
+        with check_profile:
+            timer = threading.Timer(0.05, server.auto_verifier.run_once)
+            timer.start()
+            resp = self.simulate_get(self.url)
+            timer.join()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["content-type"], "text/event-stream")
+        events = self.parse_events(resp.text)
+        self.assertEqual([event["status"] for event in events], ["pending", "validated"])
+        self.assertEqual(events[1]["username"], "foobar")
+
+    @patch("src.server.EVENTS_KEEPALIVE_SECS", 0.01)
+    @patch.object(requests.Session, "get")
+    def test_streams_validation_without_auto_verify(self, mock_get):
+        resp1 = self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        mock_get.return_value = mocks.ProfileMock(text=resp1.json["hash"])
+
+        # The user validates themselves while they're listening
+        timer = threading.Timer(0.05, server.check_profile, ["foobar", [resp1.json["hash"]]])
+        timer.start()
+        resp2 = self.simulate_get(self.url)
+        timer.join()
+
+        self.assertEqual(resp2.status_code, 200)
+        events = self.parse_events(resp2.text)
+        self.assertEqual([event["status"] for event in events], ["pending", "validated"])
+
+    @patch("src.server.EVENTS_IDLE_SECS", 0.05)
+    @patch("src.server.EVENTS_KEEPALIVE_SECS", 0.01)
+    def test_closes_idle_streams(self):
+        server.auto_verifier.schedule("foobar")
+        mocks.redis_db.pubsub.clear()
+
+        resp = self.simulate_get(self.url)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(self.parse_events(resp.text)), 1)
+        self.assertIn(": keep-alive", resp.text)
+
+
+@patch("src.server.redis_db", mocks.redis_db)
+class HashCacheTestCase(ServerTestCase):
+    def setUp(self):
+        super(HashCacheTestCase, self).setUp()
+        mocks.redis_db.flushdb()
+        hash_cache = HashCache(
+            lambda: mocks.redis_db,
+            lambda channel: mocks.PubSubMock(mocks.redis_db, channel),
+            helpers.get_channel("hash_invalidations"),
+            poll_secs=0.01,
+        )
+        patcher = patch("src.server.hash_cache", hash_cache)
+        self.hash_cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch.object(requests.Session, "get")
+    def test_validations_reuse_cached_hash(self, mock_get):
+        resp1 = self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        # Issuing a new hash tells every worker to forget the old one
+        self.assertEqual(len(mocks.redis_db.pubsub[helpers.get_channel("hash_invalidations")]), 1)
+
+        mock_get.return_value = mocks.ProfileMock(text=resp1.json["hash"])
+        self.hash_cache.get_many([])
+        deadline = time.monotonic() + 2
+        while not self.hash_cache.listening and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        for _ in range(2):
+            resp2 = self.simulate_post(
+                "/v1/validate_user/",
+                body=json.dumps({"username": "foobar"}),
+                **req_params,
+            )
+            self.assertEqual(resp2.json["validated"], True)
+
+        stats = self.simulate_get("/v1/stats").json["hash_cache"]
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (1, 1, 1))
+
+
+@patch("src.server.redis_db", mocks.redis_db)
+class HashFormatTestCase(ServerTestCase):
+    def setUp(self):
+        super(HashFormatTestCase, self).setUp()
+        mocks.redis_db.flushdb()
+        self.bytes_db = mocks.FieldExpiryRedisMock()
+
+    @patch.object(requests.Session, "get")
+    def assert_validates(self, hash_storage, mock_get):
+        with patch("src.server.hash_storage", hash_storage):
+            resp1 = self.simulate_post(
+                "/v1/generate_hash/",
+                body=json.dumps({"username": "foobar"}),
+                **req_params,
+            )
+            self.assertRegex(resp1.json["hash"], "^[a-f0-9]{32}$")
+            # Issuing again returns the same hash
+            resp2 = self.simulate_post(
+                "/v1/generate_hash/",
+                body=json.dumps({"username": "foobar"}),
+                **req_params,
+            )
+            self.assertEqual(resp2.json["hash"], resp1.json["hash"])
+
+            mock_get.return_value = mocks.ProfileMock(text=resp1.json["hash"])
+            resp3 = self.simulate_post(
+                "/v1/validate_user/",
+                body=json.dumps({"username": "foobar"}),
+                **req_params,
+            )
+            self.assertEqual(resp3.json, {"validated": True, "cached": False})
+            return bytes.fromhex(resp1.json["hash"])
+
+    @patch("src.server.HASH_FORMAT", "binary")
+    def test_binary_hashes(self):
+        token = self.assert_validates(RedisStorage(lambda: self.bytes_db))
+        self.assertEqual(self.bytes_db.get(helpers.get_hash_key("foobar")), token)
+
+    @patch("src.server.HASH_FORMAT", "bucketed")
+    def test_bucketed_hashes(self):
+        token = self.assert_validates(BucketedStorage(lambda: self.bytes_db, buckets=16))
+        (bucket,) = self.bytes_db.keys()
+        field = helpers.get_hash_key("foobar").encode("utf-8")
+        self.assertEqual(self.bytes_db.hgetall(bucket), {field: token})
+
+
+@patch("src.server.redis_db", None)
+class MemoryStorageTestCase(ServerTestCase):
+    @patch("src.server.record_statuses", False)
+    @patch("src.server.storage", MemoryStorage())
+    @patch("src.server.hash_storage", MemoryStorage())
+    @patch.object(requests.Session, "get")
+    def test_validates_without_redis(self, mock_get):
+        resp1 = self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        mock_get.return_value = mocks.ProfileMock(text=resp1.json["hash"])
+
+        for cached in (False, True):
+            resp2 = self.simulate_post(
+                "/v1/validate_user/",
+                body=json.dumps({"username": "foobar"}),
+                **req_params,
+            )
+            self.assertEqual(resp2.json, {"validated": True, "cached": cached})
+
+    @patch("src.server.hashes_shared", False)
+    @patch("src.server.record_statuses", False)
+    @patch("src.server.storage", MemoryStorage())
+    @patch("src.server.hash_storage", MemoryStorage())
+    @patch("src.server.enqueue_validation")
+    def test_refuses_async_validations(self, mock_enqueue):
+        self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        resp = self.simulate_post(
+            "/v1/validate_user/",
+            query_string="async=1",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        self.assertEqual(resp.status_code, 501)
+        mock_enqueue.assert_not_called()
+
+
+class ServerSettingsTestCase(unittest.TestCase):
+    def start(self, **settings) -> str:
+        """
+        Import the server in a fresh process with extra settings, and return what it printed
+        """
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        result = subprocess.run(
+            [sys.executable, "-c", "import src.server"],
+            env=dict(os.environ, **settings),
+            cwd=root,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        return result.stderr
+
+    def test_refuses_auto_verify_with_unshared_hashes(self):
+        stderr = self.start(AUTO_VERIFY="1", STORAGE_BACKEND="memory")
+        self.assertIn("RuntimeError", stderr)
+        self.assertIn("AUTO_VERIFY", stderr)
+
+        stderr = self.start(
+            AUTO_VERIFY="1",
+            STORAGE_BACKEND="memory",
+            STATELESS_HASHES="1",
+            HASH_SECRET="secret",
+        )
+        self.assertNotIn("RuntimeError", stderr)
+
+    def test_refuses_hash_cache_with_other_storage(self):
+        for settings in [
+            {"STORAGE_BACKEND": "memory"},
+            {"STORAGE_BACKEND": "sharded", "REDIS_SHARD_URLS": "redis://redis-1:6379/0"},
+            {"STORAGE_BACKEND": "cluster", "REDIS_CLUSTER_URL": "redis://redis-1:6379"},
+            {"HASH_FORMAT": "bucketed"},
+        ]:
+            stderr = self.start(HASH_CACHE_ENTRIES="100", **settings)
+            self.assertIn("RuntimeError", stderr)
+            self.assertIn("HASH_CACHE_ENTRIES", stderr)
+
+
+class StatsResourceTestCase(ServerTestCase):
+    def test_reports_sa_pool_stats(self):
+        resp = self.simulate_get("/v1/stats")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(set(resp.json["sa_pool"]), {"opened", "reused", "waits"})
+        self.assertEqual(set(resp.json["result_cache"]), {"hits", "misses", "hit_ratio"})
+
+    def test_reports_each_cluster_nodes_pool(self):
+        pool = MagicMock()
+        pool.as_dict.return_value = {"checkouts": 3}
+        cluster = MagicMock()
+        cluster.connection_pools.return_value = {"10.0.0.1:7000": pool}
+        with patch.dict("src.server.redis_clusters", {" (bytes)": cluster}):
+            resp = self.simulate_get("/v1/stats")
+        self.assertEqual(resp.json["redis_pools"]["10.0.0.1:7000 (bytes)"], {"checkouts": 3})
+
+
+@patch("src.server.redis_db", mocks.redis_db)
+class MetricsResourceTestCase(ServerTestCase):
+    def setUp(self):
+        super(MetricsResourceTestCase, self).setUp()
+        mocks.redis_db.flushdb()
+
+    def get_metric(self, name: str, **labels) -> float:
+        return server.metrics.REGISTRY.get_sample_value(name, labels) or 0.0
+
+    def test_counts_requests_by_route_and_status(self):
+        counts = [
+            ("POST", "/v1/generate_hash", "200"),
+            ("POST", "/v1/validate_user", "400"),
+            # RequireJSON turns the request away before it's routed
+            ("POST", "unrouted", "415"),
+            ("GET", "unrouted", "404"),
+        ]
+        before = [
+            self.get_metric("goonauth_requests_total", method=method, route=route, status=status)
+            for method, route, status in counts
+        ]
+        before_count = self.get_metric(
+            "goonauth_request_duration_seconds_count",
+            method="POST",
+            route="/v1/generate_hash",
+        )
+
+        self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        self.simulate_post("/v1/validate_user/", body=json.dumps({}), **req_params)
+        self.simulate_post("/v1/generate_hash/", body="", headers={"Content-Type": "text/plain"})
+        self.simulate_get("/v1/nothing_here")
+
+        after = [
+            self.get_metric("goonauth_requests_total", method=method, route=route, status=status)
+            for method, route, status in counts
+        ]
+        self.assertEqual(after, [count + 1 for count in before])
+        self.assertEqual(
+            self.get_metric(
+                "goonauth_request_duration_seconds_count",
+                method="POST",
+                route="/v1/generate_hash",
+            ),
+            before_count + 1,
+        )
+
+    @patch.object(requests.Session, "get")
+    def test_times_sa_fetches(self, mock_get):
+        before = self.get_metric("goonauth_sa_fetch_duration_seconds_count", outcome="not_found")
+        mock_get.return_value = mocks.ProfileMock(text="nothing to see here")
+        self.simulate_post(
+            "/v1/generate_hash/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        self.simulate_post(
+            "/v1/validate_user/",
+            body=json.dumps({"username": "foobar"}),
+            **req_params,
+        )
+        self.assertEqual(
+            self.get_metric("goonauth_sa_fetch_duration_seconds_count", outcome="not_found"),
+            before + 1,
+        )
+
+    def test_serves_prometheus_text(self):
+        resp = self.simulate_get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.headers["content-type"].startswith("text/plain"))
+        self.assertIn("# TYPE goonauth_requests_total counter", resp.text)
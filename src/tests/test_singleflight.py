@@ -0,0 +1,94 @@
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+from src.singleflight import RedisSingleFlight, SingleFlight
+from src.tests import mocks
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def test_concurrent_calls_share_one_result(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        fetch = MagicMock(side_effect=lambda: release.wait() and "result")
+        results = []
+
+        def call():
+            results.append(flights.do("foobar", fetch))
+
+        threads = [threading.Thread(target=call) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+
+        # Wait until every follower is queued up behind the leader
+        while flights.stats.as_dict()["followers"] < 4:
+            pass
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(results, ["result"] * 5)
+        self.assertEqual(flights.stats.as_dict(), {"leaders": 1, "followers": 4})
+
+    def test_sequential_calls_are_not_coalesced(self):
+        flights = SingleFlight()
+        fetch = MagicMock(return_value=True)
+        flights.do("foobar", fetch)
+        flights.do("foobar", fetch)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_raises_leader_error(self):
+        flights = SingleFlight()
+        with self.assertRaises(ValueError):
+            flights.do("foobar", MagicMock(side_effect=ValueError))
+        # The failed call shouldn't stick around
+        self.assertEqual(flights.do("foobar", MagicMock(return_value=True)), True)
+
+
+class RedisSingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        mocks.redis_db.flushdb()
+        self.flights = RedisSingleFlight(lambda: mocks.redis_db, wait_secs=0.2, poll_secs=0.01)
+
+    def test_leader_publishes_result_and_releases_lock(self):
+        result = self.flights.do("foobar", MagicMock(return_value=True))
+
+        self.assertEqual(result, True)
+        (result_key,) = mocks.redis_db.keys("foobar:flight:*")
+        self.assertEqual(mocks.redis_db.get(result_key), "true")
+        self.assertFalse(mocks.redis_db.exists("foobar:lock"))
+
+    def test_follower_uses_leaders_result(self):
+        # Another worker holds the lock and has published its result
+        mocks.redis_db.set("foobar:lock", "other_worker")
+        mocks.redis_db.set("foobar:flight:other_worker", "false")
+        fetch = MagicMock(return_value=True)
+
+        result = self.flights.do("foobar", fetch)
+
+        self.assertEqual(result, False)
+        fetch.assert_not_called()
+        self.assertEqual(self.flights.stats.as_dict(), {"leaders": 0, "followers": 1})
+
+    def test_follower_fetches_after_waiting_too_long(self):
+        mocks.redis_db.set("foobar:lock", "other_worker")
+        fetch = MagicMock(return_value=True)
+
+        result = self.flights.do("foobar", fetch)
+
+        self.assertEqual(result, True)
+        fetch.assert_called_once_with()
+        # Someone else's lock is left alone
+        self.assertEqual(mocks.redis_db.get("foobar:lock"), "other_worker")
+
+    def test_follower_ignores_earlier_flights_result(self):
+        # An earlier flight's result is still around while a new leader is working
+        mocks.redis_db.set("foobar:flight:earlier_worker", "false")
+        mocks.redis_db.set("foobar:lock", "other_worker")
+        fetch = MagicMock(return_value=True)
+
+        result = self.flights.do("foobar", fetch)
+
+        self.assertEqual(result, True)
+        fetch.assert_called_once_with()
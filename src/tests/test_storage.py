@@ -0,0 +1,266 @@
+import unittest
+
+from mockredis import mock_strict_redis_client
+
+from src import helpers
+from src.storage import (
+    BucketedStorage,
+    HashRing,
+    MemoryStorage,
+    RedisStorage,
+    ReplicatedStorage,
+    ShardedStorage,
+    Storage,
+)
+from src.tests import mocks
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeReplica(Storage):
+    """
+    A replica that takes `secs` on the clock to answer, or fails if `down` is set
+    """
+    def __init__(self, clock: FakeClock, secs: float = 0.001):
+        self.clock = clock
+        self.secs = secs
+        self.down = False
+        self.values = {}
+        self.reads = 0
+
+    def get_many(self, keys: list) -> list:
+        self.reads += 1
+        self.clock.now += self.secs
+        if self.down:
+            raise ConnectionError("Replica is down")
+        return [self.values.get(key) for key in keys]
+
+
+class MemoryStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.storage = MemoryStorage(clock=self.clock)
+
+    def test_add_keeps_existing_value(self):
+        self.assertEqual(self.storage.add("foobar", "abc123", 300), (True, "abc123"))
+        self.assertEqual(self.storage.add("foobar", "def456", 300), (False, "abc123"))
+        self.assertEqual(self.storage.get("foobar"), "abc123")
+
+    def test_get_many(self):
+        self.storage.set("foo", "1", 300)
+        self.storage.set("bar", "0", 300)
+        self.assertEqual(self.storage.get_many(["foo", "baz", "bar"]), ["1", None, "0"])
+
+    def test_never_returns_expired_values(self):
+        self.storage.set("foobar", "abc123", 10)
+        self.clock.now += 9.9
+        self.assertEqual(self.storage.get("foobar"), "abc123")
+        self.clock.now += 0.1
+        self.assertIsNone(self.storage.get("foobar"))
+        self.assertEqual(self.storage.add("foobar", "def456", 10), (True, "def456"))
+
+    def test_sweeps_expired_keys(self):
+        for number in range(100):
+            self.storage.set("user{}".format(number), "abc123", 10 + number / 10)
+        self.clock.now += 15
+        self.storage.set("other", "abc123", 300)
+        self.assertEqual(len(self.storage), 51)
+        self.clock.now += 10
+        self.storage.set("other", "abc123", 300)
+        self.assertEqual(len(self.storage), 1)
+
+    def test_sweep_keeps_keys_stored_again(self):
+        self.storage.set("foobar", "abc123", 10)
+        self.storage.set("foobar", "def456", 300)
+        self.clock.now += 20
+        self.storage.set("other", "abc123", 300)
+        self.assertEqual(self.storage.get("foobar"), "def456")
+
+
+class RedisStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        mocks.redis_db.flushdb()
+        self.storage = RedisStorage(lambda: mocks.redis_db)
+
+    def test_add_keeps_existing_value(self):
+        self.assertEqual(self.storage.add("foobar", "abc123", 300), (True, "abc123"))
+        self.assertEqual(self.storage.add("foobar", "def456", 300), (False, "abc123"))
+        self.assertAlmostEqual(mocks.redis_db.ttl("foobar"), 300, delta=1)
+
+    def test_set_and_get_many(self):
+        self.storage.set("foo", "1", 300)
+        self.assertEqual(self.storage.get_many(["foo", "bar"]), ["1", None])
+        self.assertAlmostEqual(mocks.redis_db.ttl("foo"), 300, delta=1)
+
+    def test_counts_commands(self):
+        self.storage.set("foo", "1", 300)
+        self.storage.get("foo")
+        stats = self.storage.as_dict()
+        self.assertEqual((stats["commands"], stats["errors"]), (2, 0))
+
+
+class BucketedStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.redis_db = mocks.FieldExpiryRedisMock(clock=self.clock)
+        self.storage = BucketedStorage(lambda: self.redis_db, buckets=4)
+        self.key = helpers.get_hash_key("foobar")
+
+    def test_add_keeps_existing_value(self):
+        self.assertEqual(self.storage.add(self.key, b"abc123", 300), (True, b"abc123"))
+        self.clock.now += 100
+        self.assertEqual(self.storage.add(self.key, b"def456", 300), (False, b"abc123"))
+        # The field's expiry wasn't pushed back either
+        self.clock.now += 200
+        self.assertIsNone(self.storage.get(self.key))
+
+    def test_set_replaces_value_and_expiry(self):
+        self.storage.add(self.key, b"abc123", 300)
+        self.storage.set(self.key, b"def456", 600)
+        self.clock.now += 300
+        self.assertEqual(self.storage.get(self.key), b"def456")
+
+    def test_packs_keys_into_buckets(self):
+        keys = [helpers.get_hash_key("user{}".format(number)) for number in range(40)]
+        for key in keys:
+            self.storage.set(key, key.encode("utf-8"), 300)
+        self.assertEqual(self.storage.get_many(keys), [key.encode("utf-8") for key in keys])
+        self.assertEqual(len(self.redis_db.keys()), 4)
+        self.assertEqual(sum(self.redis_db.hlen(bucket) for bucket in self.redis_db.keys()), 40)
+
+    def test_keeps_keys_sharing_a_hash_tag_apart(self):
+        keys = [helpers.get_hash_key(username) for username in ["ab", "ab}cd", "ab}zz"]]
+        for key in keys:
+            self.assertEqual(self.storage.add(key, key.encode("utf-8"), 300)[0], True)
+        self.assertEqual(self.storage.get_many(keys), [key.encode("utf-8") for key in keys])
+
+
+class HashRingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.keys = [helpers.get_hash_key("user{}".format(number)) for number in range(3000)]
+
+    def test_spreads_keys_evenly(self):
+        ring = HashRing(["a", "b", "c"])
+        counts = [0, 0, 0]
+        for key in self.keys:
+            counts[ring.get_node(key)] += 1
+        for count in counts:
+            self.assertAlmostEqual(count, 1000, delta=250)
+
+    def test_adding_a_node_only_moves_its_share(self):
+        before = HashRing(["a", "b", "c"])
+        after = HashRing(["a", "b", "c", "d"])
+        moved = [key for key in self.keys if before.get_node(key) != after.get_node(key)]
+        # Only keys now on the new node have moved
+        self.assertTrue(all(after.get_node(key) == 3 for key in moved))
+        self.assertLess(len(moved), len(self.keys) / 2)
+
+    def test_keys_with_same_hash_tag_share_a_node(self):
+        ring = HashRing(["a", "b", "c"])
+        for number in range(100):
+            username = "user{}".format(number)
+            self.assertEqual(
+                ring.get_node(helpers.get_hash_key(username)),
+                ring.get_node(helpers.get_result_key(username, "abc123")),
+            )
+
+
+class ShardedStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.shards = {
+            name: mock_strict_redis_client(decode_responses=True) for name in ("a", "b", "c")
+        }
+        self.storage = ShardedStorage({
+            name: RedisStorage(lambda shard_db=shard_db: shard_db)
+            for name, shard_db in self.shards.items()
+        })
+
+    def test_stores_each_key_on_one_shard(self):
+        keys = [helpers.get_hash_key("user{}".format(number)) for number in range(30)]
+        for key in keys:
+            self.assertEqual(self.storage.add(key, key.upper(), 300), (True, key.upper()))
+
+        for key in keys:
+            holders = [name for name, shard_db in self.shards.items() if shard_db.get(key)]
+            self.assertEqual(len(holders), 1)
+        # Thirty keys should land on more than one shard
+        self.assertGreater(len([db for db in self.shards.values() if db.keys()]), 1)
+
+    def test_get_many_keeps_order(self):
+        keys = [helpers.get_hash_key("user{}".format(number)) for number in range(30)]
+        for key in keys[::2]:
+            self.storage.set(key, key.upper(), 300)
+        self.assertEqual(
+            self.storage.get_many(keys),
+            [key.upper() if position % 2 == 0 else None for position, key in enumerate(keys)],
+        )
+
+    def test_reports_each_shard(self):
+        self.storage.set(helpers.get_hash_key("foobar"), "abc123", 300)
+        self.assertEqual(set(self.storage.as_dict()["shards"]), {"a", "b", "c"})
+
+
+class ReplicatedStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.primary = MemoryStorage(clock=self.clock)
+        self.fast = FakeReplica(self.clock, secs=0.001)
+        self.slow = FakeReplica(self.clock, secs=0.05)
+        self.storage = ReplicatedStorage(
+            self.primary,
+            {"fast": self.fast, "slow": self.slow},
+            retry_miss=helpers.is_hash_key,
+            retry_secs=5,
+            clock=self.clock,
+        )
+        self.hash_key = helpers.get_hash_key("foobar")
+        self.result_key = helpers.get_result_key("foobar", "abc123")
+
+    def test_reads_from_replicas(self):
+        self.fast.values[self.hash_key] = self.slow.values[self.hash_key] = "abc123"
+        self.assertEqual(self.storage.get(self.hash_key), "abc123")
+        self.assertEqual(self.storage.stats.as_dict()["primary_reads"], 0)
+
+    def test_writes_to_primary(self):
+        self.assertEqual(self.storage.add(self.hash_key, "abc123", 300), (True, "abc123"))
+        self.storage.set(self.result_key, "1", 300)
+        self.assertEqual(self.primary.get_many([self.hash_key, self.result_key]), ["abc123", "1"])
+
+    def test_retries_missing_hash_on_primary(self):
+        self.storage.add(self.hash_key, "abc123", 300)
+        self.storage.set(self.result_key, "1", 300)
+        self.assertEqual(self.storage.get(self.hash_key), "abc123")
+        # Cached results aren't worth a second read
+        self.assertIsNone(self.storage.get(self.result_key))
+        self.assertEqual(self.storage.stats.as_dict()["miss_retries"], 1)
+
+    def test_prefers_faster_replica(self):
+        for _ in range(2):
+            self.storage.get(self.result_key)
+        reads = (self.fast.reads, self.slow.reads)
+        for _ in range(10):
+            self.storage.get(self.result_key)
+        self.assertEqual(self.fast.reads - reads[0], 10)
+        self.assertEqual(self.slow.reads, reads[1])
+
+    def test_skips_failed_replica_until_retry(self):
+        self.primary.set(self.result_key, "1", 300)
+        self.fast.down = self.slow.down = True
+        self.assertEqual(self.storage.get(self.result_key), "1")
+        self.assertEqual(self.storage.get(self.result_key), "1")
+        self.assertEqual(self.fast.reads + self.slow.reads, 2)
+
+        self.storage.get(self.result_key)
+        self.assertEqual(self.fast.reads + self.slow.reads, 2)
+        self.assertFalse(self.storage.as_dict()["replicas"]["fast"]["healthy"])
+
+        self.clock.now += 5
+        self.fast.down = self.slow.down = False
+        self.storage.get(self.result_key)
+        self.assertEqual(self.fast.reads + self.slow.reads, 3)
@@ -0,0 +1,322 @@
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from unittest.mock import patch
+
+from src.credentials import CredentialPool, NoCredentialsAvailable
+from src.upstream import (
+    DeadlineExceeded,
+    ProfileCache,
+    ProfileClient,
+    UpstreamError,
+    find_in_stream,
+)
+
+
+class FindInStreamTestCase(unittest.TestCase):
+    def test_finds_needle_in_single_chunk(self):
+        found = find_in_stream([b"<b>abc123</b>"], [b"abc123"], 100)
+        self.assertEqual(found, b"abc123")
+
+    def test_finds_needle_split_across_chunks(self):
+        chunks = [b"<b>ab", b"c1", b"23</b>"]
+        found = find_in_stream(chunks, [b"abc123"], 100)
+        self.assertEqual(found, b"abc123")
+
+    def test_stops_reading_once_found(self):
+        read = []
+
+        def chunks():
+            for chunk in [b"abc123", b"more", b"content"]:
+                read.append(chunk)
+                yield chunk
+
+        find_in_stream(chunks(), [b"abc123"], 100)
+        self.assertEqual(read, [b"abc123"])
+
+    def test_returns_none_when_missing(self):
+        found = find_in_stream([b"nothing", b"here"], [b"abc123"], 100)
+        self.assertIsNone(found)
+
+    def test_stops_scanning_at_max_bytes(self):
+        chunks = [b"0123456789", b"abc123"]
+        found = find_in_stream(chunks, [b"abc123"], 12)
+        self.assertIsNone(found)
+
+
+class ProfileCacheTestCase(unittest.TestCase):
+    def test_remembers_scan_results(self):
+        cache = ProfileCache(10000)
+        cache.store("url", {"ETag": "\"v1\""}, None, ["abc123"], "abc123")
+
+        entry = cache.get("url")
+        self.assertEqual(entry.lookup(["abc123"]), True)
+        self.assertEqual(entry.lookup(["def456"]), None)
+        self.assertEqual(entry.conditional_headers(), {"If-None-Match": "\"v1\""})
+
+    def test_remembers_misses(self):
+        cache = ProfileCache(10000)
+        cache.store("url", {"Last-Modified": "yesterday"}, "digest", ["abc123"], None)
+
+        self.assertEqual(cache.get("url").lookup(["abc123"]), False)
+
+    def test_ignores_pages_without_validators(self):
+        cache = ProfileCache(10000)
+        cache.store("url", {}, "digest", ["abc123"], None)
+        self.assertIsNone(cache.get("url"))
+
+    def test_keeps_results_for_unchanged_pages(self):
+        cache = ProfileCache(10000)
+        cache.store("url", {"ETag": "v1"}, "digest", ["abc123"], None)
+        cache.store("url", {"ETag": "v2"}, "digest", ["def456"], None)
+
+        self.assertEqual(cache.get("url").lookup(["abc123", "def456"]), False)
+        self.assertEqual(cache.stats.as_dict()["unchanged"], 1)
+
+    def test_evicts_least_recently_used_when_full(self):
+        cache = ProfileCache(ProfileCache.ENTRY_OVERHEAD * 2 + 500)
+        for url in ["url1", "url2", "url3"]:
+            cache.store(url, {"ETag": "v1"}, None, ["abc123"], None)
+            self.assertLessEqual(cache.size, cache.max_bytes)
+
+        self.assertIsNone(cache.get("url1"))
+        self.assertIsNotNone(cache.get("url3"))
+        self.assertEqual(cache.stats.as_dict()["evictions"], 1)
+
+
+class ProfileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    body = b"<html>profile</html>"
+    status = 200
+    etag = None
+    logged_out_cookie = None
+    cookies_seen = []
+    # Seconds to wait before sending the headers, and between each byte of the body, to simulate
+    # a slow connection
+    header_drip_secs = 0
+    drip_secs = 0
+
+    def do_GET(self):
+        cookie = self.headers.get("Cookie")
+        self.cookies_seen.append(cookie)
+
+        if self.logged_out_cookie is not None and cookie == self.logged_out_cookie:
+            body = (
+                b"<p>Sorry, you must be a registered forums member to view this page.</p>"
+                b"<form method=\"post\" action=\"account.php\">"
+                b"<input type=\"hidden\" name=\"action\" value=\"login\">"
+                b"</form>"
+            )
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if self.etag is not None and self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        time.sleep(self.header_drip_secs)
+        try:
+            self.send_response(self.status)
+            self.send_header("Content-Length", str(len(self.body)))
+            if self.etag is not None:
+                self.send_header("ETag", self.etag)
+            self.end_headers()
+            if not self.drip_secs:
+                self.wfile.write(self.body)
+                return
+
+            self.wfile.flush()
+            for byte in self.body:
+                time.sleep(self.drip_secs)
+                self.wfile.write(bytes([byte]))
+                self.wfile.flush()
+        except ConnectionError:
+            # The client gave up waiting
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class ProfileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ProfileServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ProfileServer(("127.0.0.1", 0), ProfileHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}/member.php?username=".format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_client(self, **kwargs) -> ProfileClient:
+        credentials = CredentialPool(kwargs.pop("cookie_sets", [{}]))
+        client = ProfileClient(self.url, credentials, **kwargs)
+        self.addCleanup(lambda: client.session.close())
+        return client
+
+
+class ProfileClientTestCase(ProfileServerTestCase):
+    def test_reuses_connections(self):
+        client = self.make_client()
+        for _ in range(3):
+            client.profile_contains("foobar", ["abc123"])
+
+        stats = client.stats.as_dict()
+        self.assertEqual(stats["opened"], 1)
+        self.assertEqual(stats["reused"], 2)
+        self.assertEqual(stats["waits"], 0)
+
+    def test_closes_connections_without_keep_alive(self):
+        client = self.make_client(keep_alive=False)
+        for _ in range(2):
+            client.profile_contains("foobar", ["abc123"])
+
+        self.assertEqual(client.stats.as_dict()["opened"], 2)
+
+    def test_sends_credential_cookies(self):
+        ProfileHandler.cookies_seen = []
+        client = self.make_client(cookie_sets=[{"bbuserid": "1"}, {"bbuserid": "2"}])
+        for _ in range(3):
+            client.profile_contains("foobar", ["abc123"])
+
+        self.assertEqual(ProfileHandler.cookies_seen, ["bbuserid=1", "bbuserid=2", "bbuserid=1"])
+
+    def test_skips_logged_out_credentials(self):
+        ProfileHandler.body = b"<html>abc123</html>"
+        ProfileHandler.logged_out_cookie = "bbuserid=1"
+        self.addCleanup(setattr, ProfileHandler, "body", b"<html>profile</html>")
+        self.addCleanup(setattr, ProfileHandler, "logged_out_cookie", None)
+
+        client = self.make_client(cookie_sets=[{"bbuserid": "1"}, {"bbuserid": "2"}])
+        self.assertTrue(client.profile_contains("foobar", ["abc123"]))
+        self.assertTrue(client.profile_contains("foobar", ["abc123"]))
+
+        stats = client.credentials.as_dict()
+        self.assertEqual(stats["1"]["requests"], 1)
+        self.assertEqual(stats["1"]["logged_out"], 1)
+        self.assertFalse(stats["1"]["healthy"])
+        self.assertEqual(stats["2"]["requests"], 2)
+
+    def test_ignores_logged_out_message_written_in_profile(self):
+        ProfileHandler.body = (
+            b"<html>Sorry, you must be a registered forums member to view this page.</html>"
+        )
+        self.addCleanup(setattr, ProfileHandler, "body", b"<html>profile</html>")
+
+        client = self.make_client(cookie_sets=[{"bbuserid": "1"}])
+        for stream in [True, False]:
+            client.stream = stream
+            self.assertFalse(client.profile_contains("foobar", ["abc123"]))
+
+        stats = client.credentials.as_dict()
+        self.assertEqual(stats["1"]["logged_out"], 0)
+        self.assertTrue(stats["1"]["healthy"])
+
+    def test_raises_when_every_credential_is_logged_out(self):
+        ProfileHandler.logged_out_cookie = "bbuserid=1"
+        self.addCleanup(setattr, ProfileHandler, "logged_out_cookie", None)
+
+        client = self.make_client(cookie_sets=[{"bbuserid": "1"}])
+        for _ in range(2):
+            with self.assertRaises(NoCredentialsAvailable):
+                client.profile_contains("foobar", ["abc123"])
+
+    def test_rebuilds_session_after_fork(self):
+        client = self.make_client()
+        session = client.session
+        self.assertIs(client.session, session)
+
+        with patch("src.upstream.os.getpid", return_value=-1):
+            self.assertIsNot(client.session, session)
+
+    def test_profile_contains_hash(self):
+        ProfileHandler.body = b"<html>" + b"x" * 20000 + b"abc123</html>"
+        self.addCleanup(setattr, ProfileHandler, "body", b"<html>profile</html>")
+
+        for stream in [True, False]:
+            client = self.make_client(stream=stream, chunk_size=1000)
+            self.assertTrue(client.profile_contains("foobar", ["abc123"]))
+            self.assertTrue(client.profile_contains("foobar", ["def456", "abc123"]))
+            self.assertFalse(client.profile_contains("foobar", ["def456"]))
+
+    def test_reuses_scan_result_when_profile_unchanged(self):
+        ProfileHandler.body = b"<html>abc123</html>"
+        ProfileHandler.etag = "\"v1\""
+        self.addCleanup(setattr, ProfileHandler, "body", b"<html>profile</html>")
+        self.addCleanup(setattr, ProfileHandler, "etag", None)
+
+        client = self.make_client(cache_bytes=10000)
+        self.assertTrue(client.profile_contains("foobar", ["abc123"]))
+        self.assertTrue(client.profile_contains("foobar", ["abc123"]))
+        # We haven't scanned the page for this one before, so the page has to be downloaded
+        self.assertFalse(client.profile_contains("foobar", ["def456"]))
+
+        stats = client.profile_cache.stats.as_dict()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+
+    def test_reuses_connections_for_unchanged_profiles(self):
+        ProfileHandler.body = b"<html>abc123</html>"
+        ProfileHandler.etag = "\"v1\""
+        self.addCleanup(setattr, ProfileHandler, "body", b"<html>profile</html>")
+        self.addCleanup(setattr, ProfileHandler, "etag", None)
+
+        for stream in [True, False]:
+            client = self.make_client(stream=stream, cache_bytes=10000)
+            for _ in range(3):
+                self.assertTrue(client.profile_contains("foobar", ["abc123"]))
+
+            self.assertEqual(client.profile_cache.stats.as_dict()["hits"], 2)
+            self.assertEqual(client.stats.as_dict()["opened"], 1)
+
+    def test_raises_on_error_pages(self):
+        ProfileHandler.body = b"<html>Service Unavailable</html>"
+        ProfileHandler.status = 503
+        self.addCleanup(setattr, ProfileHandler, "body", b"<html>profile</html>")
+        self.addCleanup(setattr, ProfileHandler, "status", 200)
+
+        client = self.make_client(cache_bytes=10000)
+        with self.assertRaises(UpstreamError):
+            client.profile_contains("foobar", ["abc123"])
+
+        self.assertEqual(client.credentials.as_dict()["1"]["errors"], 1)
+        self.assertEqual(len(client.profile_cache), 0)
+
+    def test_gives_up_after_deadline(self):
+        for stream in [True, False]:
+            client = self.make_client(stream=stream, deadline_secs=0)
+            with self.assertRaises(DeadlineExceeded):
+                client.profile_contains("foobar", ["abc123"])
+
+    def test_gives_up_on_slow_downloads_at_deadline(self):
+        self.addCleanup(setattr, ProfileHandler, "drip_secs", 0)
+        ProfileHandler.drip_secs = 0.25
+
+        for stream in [True, False]:
+            client = self.make_client(stream=stream, deadline_secs=1, read_timeout=10)
+            started = time.monotonic()
+            with self.assertRaises(DeadlineExceeded):
+                client.profile_contains("foobar", ["abc123"])
+            self.assertLess(time.monotonic() - started, 2)
+
+    def test_gives_up_on_slow_responses_at_deadline(self):
+        self.addCleanup(setattr, ProfileHandler, "header_drip_secs", 0)
+        ProfileHandler.header_drip_secs = 3
+
+        client = self.make_client(deadline_secs=1, read_timeout=10)
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            client.profile_contains("foobar", ["abc123"])
+        self.assertLess(time.monotonic() - started, 2)
@@ -0,0 +1,127 @@
+import json
+import threading
+import unittest
+from unittest.mock import patch
+
+import redis
+import requests
+
+from src.tests import mocks
+
+from src import helpers
+from src import server
+from src import worker
+
+
+@patch("src.server.redis_db", mocks.redis_db)
+class ProcessJobTestCase(unittest.TestCase):
+    def setUp(self):
+        mocks.redis_db.flushdb()
+
+    def queue_job(self, username):
+        mocks.redis_db.set(helpers.get_hash_key(username), "abc123")
+        return server.enqueue_validation(username)["job_id"]
+
+    @patch.object(requests.Session, "get")
+    def test_stores_validation_result(self, mock_get):
+        mock_get.return_value = mocks.ProfileMock(text="abc123")
+        job_id = self.queue_job("foobar")
+
+        worker.process_job(job_id)
+
+        job = json.loads(mocks.redis_db.get(helpers.get_job_key(job_id)))
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["username"], "foobar")
+        self.assertEqual(job["validated"], True)
+        self.assertEqual(job["cached"], False)
+        self.assertAlmostEqual(
+            mocks.redis_db.ttl(helpers.get_job_key(job_id)),
+            server.JOB_RESULT_SECS,
+            delta=1,
+        )
+
+    @patch.object(requests.Session, "get")
+    def test_stores_upstream_errors(self, mock_get):
+        mock_get.side_effect = requests.ConnectionError
+        job_id = self.queue_job("foobar")
+
+        job = worker.process_job(job_id)
+
+        self.assertEqual(job["status"], "failed")
+        self.assertEqual(job["error"]["title"], "Upstream Error")
+
+    def test_fails_when_hash_expired(self):
+        job_id = self.queue_job("foobar")
+        mocks.redis_db.delete(helpers.get_hash_key("foobar"))
+
+        job = worker.process_job(job_id)
+
+        self.assertEqual(job["status"], "failed")
+        self.assertEqual(job["error"]["title"], "Hash Missing")
+
+    def test_skips_expired_jobs(self):
+        self.assertIsNone(worker.process_job("nope"))
+
+    @patch.object(requests.Session, "get")
+    def test_skips_finished_jobs(self, mock_get):
+        mock_get.return_value = mocks.ProfileMock(text="abc123")
+        job_id = self.queue_job("foobar")
+        worker.process_job(job_id)
+
+        job = worker.process_job(job_id)
+
+        self.assertEqual(job["status"], "done")
+        mock_get.assert_called_once()
+
+    def test_consume_processes_queued_jobs(self):
+        job_id = self.queue_job("foobar")
+
+        stop = threading.Event()
+        with patch.object(worker, "process_job", side_effect=lambda _: stop.set()) as process:
+            worker.consume(stop, "worker-1")
+
+        process.assert_called_once_with(job_id)
+        self.assertFalse(mocks.redis_db.exists(server.JOB_QUEUE))
+        self.assertFalse(mocks.redis_db.exists(worker.get_processing_key("worker-1")))
+
+    @patch.object(worker, "RETRY_SECS", 0)
+    def test_consume_survives_redis_errors(self):
+        job_id = self.queue_job("foobar")
+        brpoplpush = mocks.redis_db.brpoplpush
+        results = iter([redis.ConnectionError("Connection reset by peer")])
+
+        def flaky_brpoplpush(*args, **kwargs):
+            error = next(results, None)
+            if error is not None:
+                raise error
+            return brpoplpush(*args, **kwargs)
+
+        stop = threading.Event()
+        with patch.object(worker, "process_job", side_effect=lambda _: stop.set()) as process:
+            with patch.object(mocks.redis_db, "brpoplpush", side_effect=flaky_brpoplpush):
+                with self.assertLogs(worker.logger, "ERROR"):
+                    worker.consume(stop, "worker-1")
+
+        process.assert_called_once_with(job_id)
+
+    def test_requeues_jobs_of_stopped_workers(self):
+        job_id = self.queue_job("foobar")
+        worker.heartbeat("worker-1")
+
+        # The worker dies while it's carrying out the job
+        stop = threading.Event()
+        with patch.object(worker, "process_job", side_effect=SystemExit):
+            with self.assertRaises(SystemExit):
+                worker.consume(stop, "worker-1")
+        self.assertFalse(mocks.redis_db.exists(server.JOB_QUEUE))
+
+        # Nothing happens while its heartbeat is still going
+        self.assertEqual(worker.requeue_abandoned_jobs(), 0)
+
+        mocks.redis_db.delete(worker.get_heartbeat_key("worker-1"))
+        with self.assertLogs(worker.logger, "WARNING"):
+            self.assertEqual(worker.requeue_abandoned_jobs(), 1)
+
+        self.assertEqual(mocks.redis_db.lrange(server.JOB_QUEUE, 0, -1), [job_id])
+        self.assertFalse(mocks.redis_db.exists(worker.get_processing_key("worker-1")))
+        self.assertEqual(mocks.redis_db.smembers(worker.get_workers_key()), set())
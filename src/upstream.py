@@ -0,0 +1,492 @@
+import hashlib
+import http.cookiejar
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .credentials import LOGGED_OUT_MARKER, Credential, CredentialPool, NoCredentialsAvailable
+from .stats import CacheStats, Counters
+
+
+class PoolStats(Counters):
+    """
+    Counters describing how the upstream connection pool is being used
+    """
+    names = ("checkouts", "opened", "waits")
+
+    def as_dict(self) -> dict:
+        stats = super().as_dict()
+        return {
+            "opened": stats["opened"],
+            "reused": max(stats["checkouts"] - stats["opened"], 0),
+            "waits": stats["waits"],
+        }
+
+
+class DeadlineExceeded(requests.Timeout):
+    """
+    Raised when a profile takes longer than the client's deadline to download
+    """
+
+
+class UpstreamError(requests.RequestException):
+    """
+    Raised when SA responds with something other than a profile page
+    """
+
+
+class LoggedOut(requests.RequestException):
+    """
+    Raised when SA shows us its "not logged in" page instead of a profile
+    """
+
+
+class StreamScanner:
+    """
+    Scan byte chunks for any of `needles` as they arrive
+
+    A tail of the previous chunk is carried over so that a needle split across two chunks is
+    still found. No more than `max_bytes` bytes will be scanned.
+    """
+    def __init__(self, needles: list, max_bytes: int):
+        self.needles = needles
+        self.max_bytes = max_bytes
+        self.overlap = max(len(needle) for needle in needles) - 1
+        self.scanned = 0
+        self._tail = b""
+
+    @property
+    def exhausted(self) -> bool:
+        return self.scanned >= self.max_bytes
+
+    def feed(self, chunk: bytes):
+        """
+        Scan the next chunk. Returns the needle that was found, or None
+        """
+        chunk = chunk[:self.max_bytes - self.scanned]
+        self.scanned += len(chunk)
+        window = self._tail + chunk
+
+        for needle in self.needles:
+            if needle in window:
+                return needle
+
+        self._tail = window[-self.overlap:] if self.overlap else b""
+        return None
+
+
+def find_in_stream(chunks, needles: list, max_bytes: int):
+    """
+    Scan an iterable of byte chunks for any of `needles`, stopping as soon as one is found
+
+    Returns the needle that was found, or None.
+    """
+    scanner = StreamScanner(needles, max_bytes)
+
+    for chunk in chunks:
+        if scanner.exhausted:
+            break
+
+        found = scanner.feed(chunk)
+        if found is not None:
+            return found
+
+    return None
+
+
+def _counting_pool(pool_cls, stats: PoolStats):
+    """
+    Subclass a urllib3 connection pool so that it reports into `stats`
+    """
+    class CountingConnection(pool_cls.ConnectionCls):
+        def connect(self):
+            stats.incr("opened")
+            return super().connect()
+
+    class CountingConnectionPool(pool_cls):
+        ConnectionCls = CountingConnection
+
+        def _get_conn(self, timeout=None):
+            stats.incr("checkouts")
+            # Every slot is checked out, so we'll have to wait for one to free up
+            if self.pool is not None and self.pool.empty():
+                stats.incr("waits")
+            return super()._get_conn(timeout)
+
+    return CountingConnectionPool
+
+
+class CountingAdapter(HTTPAdapter):
+    """
+    A requests adapter whose connection pools keep track of opened and reused connections
+    """
+    def __init__(self, stats: PoolStats, socket_options: list = None, **kwargs):
+        self.stats = stats
+        self.socket_options = socket_options
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options is not None:
+            kwargs["socket_options"] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _counting_pool(HTTPConnectionPool, self.stats),
+            "https": _counting_pool(HTTPSConnectionPool, self.stats),
+        }
+
+
+class ProfileCacheStats(CacheStats):
+    """
+    Hit and miss counts for the profile cache, plus how often it had to evict entries and how often
+    a re-downloaded page turned out to be unchanged
+    """
+    names = ("hits", "misses", "evictions", "unchanged")
+
+
+class ProfileCacheEntry:
+    __slots__ = ("etag", "last_modified", "digest", "results", "size")
+
+    def __init__(self, etag: str, last_modified: str, digest: str, results: dict, size: int):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.digest = digest
+        self.results = results
+        self.size = size
+
+    def lookup(self, user_hashes: list):
+        """
+        Return whether the cached page contained any of `user_hashes`, or None if we don't know
+        """
+        if any(self.results.get(user_hash) for user_hash in user_hashes):
+            return True
+        if all(self.results.get(user_hash) is False for user_hash in user_hashes):
+            return False
+        return None
+
+    def conditional_headers(self) -> dict:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ProfileCache:
+    """
+    A bounded LRU of the validators and scan results of recently fetched profile pages
+
+    Pages themselves aren't kept, just enough to send a conditional request and reuse the previous
+    scan result if SA says the page hasn't changed. Entries are evicted once their estimated size
+    exceeds `max_bytes`.
+    """
+    # A rough estimate of the fixed cost of each entry and each result it holds
+    ENTRY_OVERHEAD = 256
+    RESULT_OVERHEAD = 96
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.stats = ProfileCacheStats()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, url: str):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def store(self, url: str, headers, digest: str, user_hashes: list, found: str):
+        """
+        Remember the outcome of scanning a freshly downloaded page for `user_hashes`
+        """
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        previous = self.get(url)
+
+        results = {}
+        if previous is not None and digest is not None and previous.digest == digest:
+            # The page hasn't changed, so whatever we learned about it last time still holds
+            self.stats.incr("unchanged")
+            results.update(previous.results)
+
+        if found is not None:
+            results[found] = True
+        else:
+            results.update((user_hash, False) for user_hash in user_hashes)
+
+        # Without a validator we can't ask SA whether the page has changed
+        if not etag and not last_modified:
+            self.discard(url)
+            return
+
+        size = (
+            self.ENTRY_OVERHEAD
+            + len(url)
+            + len(etag or "")
+            + len(last_modified or "")
+            + len(digest or "")
+            + sum(len(user_hash) + self.RESULT_OVERHEAD for user_hash in results)
+        )
+        entry = ProfileCacheEntry(etag, last_modified, digest, results, size)
+
+        with self._lock:
+            replaced = self._entries.pop(url, None)
+            if replaced is not None:
+                self.size -= replaced.size
+            self._entries[url] = entry
+            self.size += size
+
+            while self.size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+                self.stats.incr("evictions")
+
+    def discard(self, url: str):
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is not None:
+                self.size -= entry.size
+
+
+def _check_deadline(deadline: float, cause: Exception = None):
+    """
+    Raise DeadlineExceeded (from `cause`, if it's the error we got while waiting) if the
+    `deadline` has passed
+    """
+    if deadline is not None and time.monotonic() >= deadline:
+        raise DeadlineExceeded("Profile took too long to download") from cause
+
+
+def _abort_response(response: requests.Response):
+    """
+    Shut down the connection a response is being read from, waking up whichever thread is
+    blocked reading it
+    """
+    connection = response.raw.connection
+    sock = getattr(connection, "sock", None)
+    if sock is None:
+        # The whole page has already been read and the connection handed back to the pool
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class ProfileClient:
+    """
+    A long-lived, pooled HTTP client for fetching SA profile pages
+
+    The underlying session is created lazily and re-created after a fork so that each gunicorn
+    worker gets its own connections.
+    """
+    def __init__(
+        self,
+        profile_url: str,
+        credentials: CredentialPool,
+        pool_size: int = 10,
+        pool_block: bool = True,
+        keep_alive: bool = True,
+        stream: bool = True,
+        chunk_size: int = 8192,
+        max_bytes: int = 1024 * 1024,
+        cache_bytes: int = 0,
+        connect_timeout: float = None,
+        read_timeout: float = None,
+        deadline_secs: float = None,
+    ):
+        self.profile_url = profile_url
+        self.credentials = credentials
+        self.pool_size = pool_size
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.timeout = (connect_timeout, read_timeout)
+        self.deadline_secs = deadline_secs
+        self.stats = PoolStats()
+        self.profile_cache = ProfileCache(cache_bytes) if cache_bytes else None
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._session = self._build_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _build_session(self) -> requests.Session:
+        session = requests.Session()
+
+        socket_options = None
+        if self.keep_alive:
+            socket_options = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            ]
+        else:
+            session.headers["Connection"] = "close"
+
+        adapter = CountingAdapter(
+            self.stats,
+            socket_options=socket_options,
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            pool_block=self.pool_block,
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        # Each request brings its own credential's cookies, so don't let SA's responses set any
+        # that would then be sent along with another credential's
+        session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        return session
+
+    def profile_contains(self, username: str, user_hashes: list) -> bool:
+        """
+        Check whether the user's profile page contains any of their hashes
+
+        If we've scanned the page for these hashes before, SA is asked to only send the page again
+        if it's changed since then. If a credential turns out to be logged out, the next one is
+        tried instead.
+        """
+        for _ in range(len(self.credentials)):
+            credential = self.credentials.acquire()
+            try:
+                found = self._search_profile(username, user_hashes, credential)
+            except LoggedOut:
+                self.credentials.report_logged_out(credential)
+                continue
+            except requests.RequestException:
+                self.credentials.report_error(credential)
+                raise
+
+            self.credentials.report_success(credential)
+            return found
+
+        raise NoCredentialsAvailable("Every set of SA cookies has been logged out")
+
+    def _search_profile(self, username: str, user_hashes: list, credential: Credential) -> bool:
+        url = self.profile_url + username
+        entry = self.profile_cache.get(url) if self.profile_cache is not None else None
+        known = entry.lookup(user_hashes) if entry is not None else None
+        headers = entry.conditional_headers() if known is not None else {}
+
+        deadline = None
+        if self.deadline_secs is not None:
+            deadline = time.monotonic() + self.deadline_secs
+
+        try:
+            raw_profile = self.session.get(
+                url,
+                headers=headers,
+                cookies=credential.cookies,
+                # Always stream, so that the deadline applies to whole-page downloads as well
+                stream=True,
+                timeout=self._timeout_until(deadline),
+            )
+        except requests.Timeout as ex:
+            _check_deadline(deadline, ex)
+            raise
+
+        # Socket timeouts only limit each read, and a page that arrives a few bytes at a time
+        # would never trip them, so cut the connection off once the deadline passes
+        watchdog = None
+        if deadline is not None:
+            watchdog = threading.Timer(deadline - time.monotonic(), _abort_response, [raw_profile])
+            watchdog.daemon = True
+            watchdog.start()
+
+        try:
+            if known is not None and raw_profile.status_code == 304:
+                self.profile_cache.stats.incr("hits")
+                # Read the empty body so that closing the response puts the connection back in
+                # the pool instead of tearing it down
+                try:
+                    raw_profile.content
+                except requests.RequestException as ex:
+                    _check_deadline(deadline, ex)
+                    raise
+                return known
+            # An error page isn't the user's profile, so it's a failure rather than a miss
+            if not 200 <= raw_profile.status_code < 300:
+                raise UpstreamError("SA responded with HTTP {}".format(raw_profile.status_code))
+
+            found, digest = self._scan(raw_profile, user_hashes, deadline)
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            # Don't bother reading the rest of the page
+            raw_profile.close()
+
+        if self.profile_cache is not None:
+            self.profile_cache.stats.incr("misses")
+            self.profile_cache.store(url, raw_profile.headers, digest, user_hashes, found)
+
+        return found is not None
+
+    def _timeout_until(self, deadline: float) -> tuple:
+        """
+        Shorten the connect and read timeouts so that neither waits past the `deadline`
+        """
+        if deadline is None:
+            return self.timeout
+
+        _check_deadline(deadline)
+        remaining = deadline - time.monotonic()
+        return tuple(
+            remaining if timeout is None else min(timeout, remaining) for timeout in self.timeout
+        )
+
+    def _scan(self, raw_profile: requests.Response, user_hashes: list, deadline: float) -> tuple:
+        """
+        Search a profile page for the user's hashes, giving up if we're still reading it after the
+        `deadline` (a time.monotonic() value)
+
+        Returns a (found, digest) tuple, where `found` is the hash that was found (if any) and
+        `digest` is a digest of the page (or None if we stopped reading it early)
+        """
+        digest = hashlib.sha1()
+        needles = [user_hash.encode("utf-8") for user_hash in user_hashes]
+        needles.append(LOGGED_OUT_MARKER)
+
+        def chunks():
+            try:
+                for chunk in raw_profile.iter_content(self.chunk_size):
+                    _check_deadline(deadline)
+                    digest.update(chunk)
+                    yield chunk
+            except requests.RequestException as ex:
+                _check_deadline(deadline, ex)
+                raise
+            # The watchdog cutting the connection off looks like the end of the page
+            _check_deadline(deadline)
+
+        if self.stream:
+            found = find_in_stream(chunks(), needles, self.max_bytes)
+        else:
+            content = b"".join(chunks())
+            found = find_in_stream([content], needles, len(content))
+
+        if found == LOGGED_OUT_MARKER:
+            raise LoggedOut("SA's cookies have been logged out")
+        if found is not None:
+            return found.decode("utf-8"), None
+        return None, digest.hexdigest()
@@ -0,0 +1,197 @@
+"""
+Carry out the validations queued with `POST /v1/validate_user?async=1`
+
+Runs WORKER_THREADS threads that each pop jobs off the JOB_QUEUE list in Redis, check the user's
+profile the same way ValidateUserResource does, and store the result for
+`GET /v1/validations/<id>` to pick up. Run as many of these as SA's rate limit allows:
+
+    $> pipenv run worker
+"""
+import json
+import logging
+import signal
+import socket
+import threading
+import uuid
+
+import falcon
+
+from . import helpers
+from . import server
+
+logger = logging.getLogger(__name__)
+
+# The number of seconds each thread blocks waiting for a job before checking whether to stop
+# (Redis only accepts whole seconds)
+POP_TIMEOUT_SECS = 1
+# The number of seconds each thread waits before trying Redis again after it failed
+RETRY_SECS = 2
+# The number of seconds a worker can go without a heartbeat before the jobs it was carrying out
+# are queued again for another worker
+HEARTBEAT_SECS = 10
+
+
+def get_workers_key() -> str:
+    """
+    Return the Redis key of the set of every worker's id
+    """
+    return "{}:workers".format(server.JOB_QUEUE)
+
+
+def get_processing_key(worker_id: str) -> str:
+    """
+    Return the Redis key of the list of jobs a worker is carrying out
+    """
+    return "{}:processing:{}".format(server.JOB_QUEUE, worker_id)
+
+
+def get_heartbeat_key(worker_id: str) -> str:
+    """
+    Return the Redis key that exists for as long as a worker is alive
+    """
+    return "{}:alive:{}".format(server.JOB_QUEUE, worker_id)
+
+
+def process_job(job_id: str) -> dict:
+    """
+    Validate the user a job was queued for and store the result
+
+    Returns the finished job, or None if it expired before we got to it.
+    """
+    job_key = helpers.get_job_key(job_id)
+    job = server.redis_db.get(job_key)
+    if job is None:
+        return None
+
+    job = json.loads(job)
+    # It was queued again after its worker went quiet, but that worker finished it after all
+    if job["status"] != "pending":
+        return job
+
+    try:
+        user_hashes = server.require_hashes(job["username"])
+        job["validated"], job["cached"] = server.validate_profile(job["username"], user_hashes)
+        job["status"] = "done"
+    except falcon.HTTPError as ex:
+        job["error"] = {"title": ex.title, "description": ex.description}
+        job["status"] = "failed"
+
+    server.redis_db.setex(job_key, server.JOB_RESULT_SECS, json.dumps(job))
+    return job
+
+
+def consume(stop: threading.Event, worker_id: str):
+    """
+    Process jobs as they're queued until `stop` is set
+
+    Each job is moved onto the worker's processing list as it's popped, and only removed once it's
+    been processed, so it can be queued again if the worker dies in between.
+    """
+    processing_key = get_processing_key(worker_id)
+    while not stop.is_set():
+        try:
+            job_id = server.redis_db.brpoplpush(
+                server.JOB_QUEUE,
+                processing_key,
+                timeout=POP_TIMEOUT_SECS,
+            )
+        except Exception:
+            logger.exception("Couldn't pop a validation job from %s", server.JOB_QUEUE)
+            stop.wait(RETRY_SECS)
+            continue
+
+        if job_id is None:
+            continue
+
+        try:
+            process_job(job_id)
+        except Exception:
+            logger.exception("Validation job %s could not be processed", job_id)
+
+        try:
+            server.redis_db.lrem(processing_key, 1, job_id)
+        except Exception:
+            logger.exception("Couldn't finish validation job %s", job_id)
+
+
+def heartbeat(worker_id: str):
+    """
+    Let the other workers know this one is still alive
+    """
+    pipe = server.redis_db.pipeline()
+    # Set the heartbeat first so that no other worker can see this one without it
+    pipe.set(get_heartbeat_key(worker_id), 1, ex=HEARTBEAT_SECS)
+    pipe.sadd(get_workers_key(), worker_id)
+    pipe.execute()
+
+
+def requeue_jobs(worker_id: str) -> int:
+    """
+    Queue every job a worker was carrying out again, and forget about the worker
+
+    Returns the number of jobs that were queued again.
+    """
+    requeued = 0
+    # Each job is moved atomically, so two workers requeueing the same jobs can't duplicate them
+    while server.redis_db.rpoplpush(get_processing_key(worker_id), server.JOB_QUEUE) is not None:
+        requeued += 1
+    server.redis_db.srem(get_workers_key(), worker_id)
+    return requeued
+
+
+def requeue_abandoned_jobs() -> int:
+    """
+    Queue the jobs of every worker whose heartbeat has stopped again
+
+    Returns the number of jobs that were queued again.
+    """
+    requeued = 0
+    for worker_id in server.redis_db.smembers(get_workers_key()):
+        if not server.redis_db.exists(get_heartbeat_key(worker_id)):
+            count = requeue_jobs(worker_id)
+            if count:
+                logger.warning("Queued %d jobs from stopped worker %s again", count, worker_id)
+            requeued += count
+    return requeued
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+
+    worker_id = "{}:{}".format(socket.gethostname(), uuid.uuid4().hex)
+    heartbeat(worker_id)
+
+    threads = [
+        threading.Thread(
+            target=consume,
+            args=(stop, worker_id),
+            name="worker-{}".format(number),
+        )
+        for number in range(server.WORKER_THREADS)
+    ]
+    for thread in threads:
+        thread.start()
+    logger.info("Processing validation jobs from %s as %s", server.JOB_QUEUE, worker_id)
+
+    try:
+        while not stop.wait(POP_TIMEOUT_SECS):
+            try:
+                heartbeat(worker_id)
+                requeue_abandoned_jobs()
+            except Exception:
+                logger.exception("Couldn't check on the other workers")
+    except KeyboardInterrupt:
+        stop.set()
+
+    for thread in threads:
+        thread.join()
+
+    # Hand back anything that couldn't be finished
+    requeue_jobs(worker_id)
+    server.redis_db.delete(get_heartbeat_key(worker_id))
+
+
+if __name__ == "__main__":
+    main()